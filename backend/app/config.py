@@ -12,6 +12,12 @@ class Settings(BaseSettings):
     api_key: str = secrets.token_urlsafe(32)
 
     db_echo: bool = False
+    db_async: bool = False  # asyncpg or aiosqlite sessions in the routers, else sync sessions in the thread pool
+    db_pool_size: int = 5  # connections kept open per worker, per engine
+    db_max_overflow: int = 10  # connections opened past db_pool_size under load, closed when returned
+    db_pool_timeout: float = 30.0  # seconds to wait for a connection before erroring
+    db_pool_recycle: int = 1800  # seconds before a connection is replaced, -1 to keep them
+    db_pool_pre_ping: bool = True  # check connections on checkout, replacing dropped ones
     postgres_server: str = ""
     postgres_user: str = ""
     postgres_password: str = ""
@@ -33,23 +39,80 @@ class Settings(BaseSettings):
         )
 
     openai_api_key: str = ""
+    scrape_snapshot_path: str = ""
 
+    lm_backend: str = "openai"  # openai, fake
+    lm_initial_concurrency: int = 16
+    lm_max_concurrency: int = 64
+    lm_target_latency: float = 30.0  # seconds, concurrency backs off above this
+    lm_requests_per_minute: int = 0  # 0 for no limit
+    lm_tokens_per_minute: int = 0
+    fake_lm_seed: int = 0
+    fake_lm_latency: str = "constant"  # constant, normal, lognormal, exponential
+    fake_lm_latency_mean: float = 0.0  # seconds
+    fake_lm_latency_std: float = 0.0
+    fake_lm_error_rate: float = 0.0
+    fake_lm_completion_tokens: int = 0  # 0 to estimate from the completion
+    fake_lm_max_concurrency: int = 0  # concurrent calls before 429s, 0 for no limit
+
+    password_hash_rounds: int = 12  # bcrypt work factor, hashes with another one are updated on login
+    password_hash_workers: int = 0  # processes hashing passwords, 0 for one per core
+    password_hash_max_queue: int = 64  # hashes waiting for a process before requests get 503s
     jwt_secret: str = secrets.token_urlsafe(32)
     access_token_expire_minutes: int = 0
     refresh_token_expire_minutes: int = 0
     verify_code_expire_minutes: int = 0
     recovery_code_expire_minutes: int = 0
+    auth_code_sweep_interval: float = 300.0  # seconds between sweeps of expired auth codes
+    auth_code_sweep_batch_size: int = 1000
+    auth_code_retention_days: int = 30  # after expiry, before auth codes are deleted
 
     smtp_ssl_host: str = ""
     smtp_ssl_port: int = 0
     smtp_ssl_sender: str = ""
     smtp_ssl_login: str = ""
     smtp_ssl_password: str = ""
+    smtp_starttls: bool = True
+    smtp_idle_timeout: float = 60.0  # seconds before the sender closes its idle SMTP connection
+    email_batch_size: int = 50
+    email_poll_interval: float = 5.0  # seconds between outbox checks, commits that queue emails wake the sender
+    email_max_attempts: int = 8
+    email_retry_delay: float = 10.0  # seconds before the first retry, doubled per attempt
 
     frontend_url: str = ""
     google_client_id: str = ""
     google_client_secret: str = ""
     google_redirect_uri: str = ""
+    google_auth_url: str = "https://accounts.google.com/o/oauth2/v2/auth"
+    google_token_url: str = "https://www.googleapis.com/oauth2/v4/token"
+    google_userinfo_url: str = "https://www.googleapis.com/oauth2/v1/userinfo"
+    google_token_cache_ttl: int = 300  # seconds, also bounded by the token's expiry when known
+    google_token_negative_cache_ttl: int = 30
+
+    http_timeout: float = 10.0  # seconds per outbound provider call
+    http_connect_timeout: float = 3.0
+    http_max_retries: int = 2
+    http_max_connections: int = 100  # per provider and worker
+    http_circuit_failure_threshold: int = 5  # consecutive failed calls before failing fast
+    http_circuit_reset_timeout: float = 30.0  # seconds before trying a provider again
+
+    cache_path: str = "cache.db"  # SQLite file shared by the workers of a host
+    user_cache_ttl: int = 60  # seconds, per worker
+    user_cache_size: int = 10000
+    user_cache_sync_interval: float = 0.1  # seconds between reads of the other workers' invalidations
+
+    rate_limit_enabled: bool = True
+    rate_limit_shared: bool = False  # count in CACHE_PATH, so limits hold across the workers of a host
+    rate_limit_window: float = 60.0  # seconds
+    rate_limit_per_ip: int = 20  # requests per window to each limited route, 0 for no limit
+    rate_limit_per_email: int = 5
+    rate_limit_per_api_key: int = 0  # the frontend sends one key for every user, so off unless clients get their own
+
+    metrics_enabled: bool = True  # per-route request metrics
+    metrics_flush_interval: float = 10.0  # seconds between writes of a worker's metrics to CACHE_PATH
+    profile_sample_rate: float = 0.0  # share of requests profiled, besides those with the X-Profile header
+    profile_interval: float = 0.005  # seconds between stack samples of a profiled request
+    profile_buffer_size: int = 100  # latest profiles kept in CACHE_PATH
 
     openai_api_key: str = ""
 
@@ -1,15 +1,244 @@
 """Database engine and helper functions."""
+import os
+import threading
+import time
+from collections.abc import AsyncIterator
+from typing import Any
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
 from app.config import get_settings
+from app.dependencies.metrics import OPERATION_SECONDS, Histogram
 
 SETTINGS = get_settings()
-engine = create_engine(
-    url=SETTINGS.database_uri,
-    echo=SETTINGS.db_echo,
-)
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+POOL_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)  # seconds
+
+
+class InstrumentedPoolMixin:
+    """
+    Mixin for queue pools that records checkout waits, timeouts and new connections.
+
+    Checkouts are timed from the request for a connection until it's handed
+    over, so they include waiting for a free connection, opening a new one
+    and pre-pinging it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = {"checkouts": 0, "timeouts": 0, "connects": 0}
+        self.lock = threading.Lock()  # checkouts happen in any thread of the thread pool
+        self.wait = Histogram(POOL_WAIT_BUCKETS)
+
+    def _count(self, name: str) -> None:
+        with self.lock:
+            self.counts[name] += 1
+
+    def connect(self) -> Any:
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            self._count("timeouts")
+            raise
+        finally:
+            self.wait.observe(time.perf_counter() - start)
+        self._count("checkouts")
+        return connection
+
+    def _create_connection(self) -> Any:
+        self._count("connects")
+        return super()._create_connection()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            "overflow": self.overflow(),
+            **counts,
+            "wait": self.wait.snapshot(),
+        }
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    """Instrumented pool of sync connections."""
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    """Instrumented pool of async connections."""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+    context.query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _observe_query_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+    OPERATION_SECONDS.observe(time.perf_counter() - context.query_start, operation="db")  # every engine, async ones too
+
+
+def get_pool_options(database_uri: str, is_async: bool = False) -> dict:
+    """
+    Get the pool settings of an engine.
+
+    Parameters
+    ----------
+    database_uri : str
+        URI
+    is_async : bool, optional
+        Whether the engine is async, by default False
+
+    Returns
+    -------
+    dict
+        Arguments of `create_engine`, with no pool for in-memory SQLite
+    """
+    if database_uri.startswith("sqlite") and database_uri.split("://", 1)[1] in ("", "/:memory:"):
+        return {}  # one connection per thread, which can't be pooled
+    return {
+        "poolclass": InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool,
+        "pool_size": SETTINGS.db_pool_size,
+        "max_overflow": SETTINGS.db_max_overflow,
+        "pool_timeout": SETTINGS.db_pool_timeout,
+        "pool_recycle": SETTINGS.db_pool_recycle,
+        "pool_pre_ping": SETTINGS.db_pool_pre_ping,
+    }
+
+
+def create_database_engine(database_uri: str, **kwargs) -> Engine:
+    return create_engine(database_uri, **{**get_pool_options(database_uri), **kwargs})
+
+
+engine = create_database_engine(SETTINGS.database_uri, echo=SETTINGS.db_echo)
+
+
+def get_async_database_uri(database_uri: str) -> str:
+    """
+    Get the URI of a database with its async driver.
+
+    Parameters
+    ----------
+    database_uri : str
+        URI, with or without a sync driver
+
+    Returns
+    -------
+    str
+        URI with asyncpg for Postgres, or aiosqlite for SQLite
+    """
+    scheme, rest = database_uri.split("://", 1)
+    return f"{ASYNC_DRIVERS[scheme.split('+')[0]]}://{rest}"
+
+
+def create_async_database_engine(database_uri: str, **kwargs) -> AsyncEngine:
+    return create_async_engine(
+        get_async_database_uri(database_uri), **{**get_pool_options(database_uri, is_async=True), **kwargs}
+    )
+
+
+async_engine = create_async_database_engine(SETTINGS.database_uri, echo=SETTINGS.db_echo) if SETTINGS.db_async else None
+
+
+def dispose_pools() -> None:
+    """Drop the pooled connections inherited from a parent process, without closing them under the parent."""
+    engine.dispose(close=False)
+    if async_engine is not None:
+        async_engine.sync_engine.dispose(close=False)
+
+
+def get_pool_metrics() -> dict[str, dict]:
+    """
+    Get the metrics of this worker's connection pools.
+
+    Returns
+    -------
+    dict[str, dict]
+        Per-engine pool size, checked out and overflow connections, counts
+        of checkouts, timeouts and new connections, and checkout wait histogram
+    """
+    engines = {"sync": engine}
+    if async_engine is not None:
+        engines["async"] = async_engine.sync_engine
+    return {
+        name: db_engine.pool.metrics()
+        for name, db_engine in engines.items()
+        if isinstance(db_engine.pool, InstrumentedPoolMixin)
+    }
+
+
+os.register_at_fork(after_in_child=dispose_pools)  # e.g. gunicorn --preload
+
+
+class ThreadedSession:
+    """
+    Sync session behind the interface of `AsyncSession`, running its round trips in the thread pool.
+
+    Lets the routers await the database the same way whether `DB_ASYNC` is
+    set or not. Results are read on the event loop, which doesn't block
+    since psycopg2 and SQLite fetch them with the query.
+    """
+
+    def __init__(self, session: Session):
+        self.sync_session = session
+
+    @property
+    def bind(self) -> Engine:
+        return self.sync_session.bind
+
+    @property
+    def info(self) -> dict:
+        return self.sync_session.info
+
+    def add(self, instance: Any) -> None:
+        self.sync_session.add(instance)
+
+    async def exec(self, statement: Any, **kwargs) -> Any:
+        return await run_in_threadpool(self.sync_session.exec, statement, **kwargs)
+
+    async def get(self, entity: Any, ident: Any) -> Any:
+        return await run_in_threadpool(self.sync_session.get, entity, ident)
+
+    async def merge(self, instance: Any, load: bool = True) -> Any:
+        return await run_in_threadpool(self.sync_session.merge, instance, load=load)
+
+    async def delete(self, instance: Any) -> None:
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def commit(self) -> None:
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def refresh(self, instance: Any) -> None:
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def rollback(self) -> None:
+        await run_in_threadpool(self.sync_session.rollback)
+
+
+DBSession = AsyncSession | ThreadedSession
 
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+async def get_db_session() -> AsyncIterator[DBSession]:
+    if async_engine is not None:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+    else:
+        session = Session(engine, expire_on_commit=False)
+        try:
+            yield ThreadedSession(session)
+        finally:
+            await run_in_threadpool(session.close)  # returning the connection rolls it back
@@ -0,0 +1,281 @@
+"""Dependencies for bulk exports and imports of users."""
+
+import codecs
+import csv
+import io
+import json
+from collections import defaultdict
+from collections.abc import AsyncIterator, Iterable
+from datetime import datetime
+from uuid import UUID, uuid4
+
+from pydantic import ValidationError
+from sqlalchemy import bindparam, insert, select
+from sqlalchemy.engine import Engine, Row
+from starlette.concurrency import run_in_threadpool
+
+from app.dependencies import users
+from app.dependencies.users import get_user_cache_key
+from app.models.users import User, UserImport, UserRead
+
+EXPORT_BATCH_SIZE = 1000  # rows fetched from the server-side cursor per round trip
+IMPORT_BATCH_SIZE = 1000  # rows upserted per transaction
+MAX_IMPORT_ERRORS = 10  # invalid rows described in the import summary
+EXPORT_COLUMNS = list(UserRead.model_fields)
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+USER_TABLE = User.__table__
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+def encode_rows(rows: Iterable[Row], format: str) -> str:
+    """
+    Encode exported rows as NDJSON or CSV lines.
+
+    Parameters
+    ----------
+    rows : Iterable[Row]
+        Rows with the `EXPORT_COLUMNS`
+    format : str
+        "ndjson" or "csv"
+
+    Returns
+    -------
+    str
+        One line per row
+    """
+    if format == "ndjson":
+        return "".join(
+            json.dumps({column: _encode(value) for column, value in zip(EXPORT_COLUMNS, row, strict=True)}) + "\n"
+            for row in rows
+        )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_encode(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+
+async def export_users(engine: Engine, format: str = "ndjson") -> AsyncIterator[str]:
+    """
+    Stream every user, oldest first, from a server-side cursor.
+
+    Rows are fetched `EXPORT_BATCH_SIZE` at a time in the thread pool, and
+    each batch is encoded and sent before the next is fetched, so memory
+    stays constant however many users there are.
+
+    Parameters
+    ----------
+    engine : Engine
+        Sync engine, used in the thread pool whether `DB_ASYNC` is set or not
+    format : str, optional
+        "ndjson" or "csv" with a header, by default "ndjson"
+
+    Yields
+    ------
+    str
+        Encoded batch of users
+    """
+    statement = (
+        select(*(USER_TABLE.c[column] for column in EXPORT_COLUMNS))
+        .order_by(USER_TABLE.c.id)
+        .execution_options(stream_results=True, max_row_buffer=EXPORT_BATCH_SIZE)
+    )
+    conn = await run_in_threadpool(engine.connect)
+    try:
+        result = await run_in_threadpool(conn.execute, statement)
+        if format == "csv":
+            yield ",".join(EXPORT_COLUMNS) + "\r\n"
+        while rows := await run_in_threadpool(result.fetchmany, EXPORT_BATCH_SIZE):
+            yield encode_rows(rows, format)
+    finally:
+        await run_in_threadpool(conn.close)  # also when the client disconnects mid-stream
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a byte stream into its non-empty lines, without reading all of it."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line.decode()
+    if buffer.strip():
+        yield buffer.decode()
+
+
+async def read_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[list[str]]:
+    """
+    Parse a CSV byte stream into its non-empty rows, without reading all of it.
+
+    The stream is decoded incrementally and lines are joined until their
+    quotes balance, so quoted fields may span lines.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = record = ""
+    quotes = 0
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            record += line + "\n"
+            quotes += line.count('"')
+            if quotes % 2 == 0:  # escaped quotes are doubled, so only an open field leaves one unmatched
+                if record.strip():
+                    yield next(csv.reader(io.StringIO(record)))
+                record, quotes = "", 0
+    record += buffer + decoder.decode(b"", final=True)
+    if record.strip():
+        yield next(csv.reader(io.StringIO(record)))
+
+
+async def read_records(chunks: AsyncIterator[bytes], format: str) -> AsyncIterator[tuple[int, dict | None]]:
+    """
+    Parse an NDJSON or CSV stream into records.
+
+    Parameters
+    ----------
+    chunks : AsyncIterator[bytes]
+        Body, e.g. `request.stream()`
+    format : str
+        "ndjson", or "csv" with a header row; empty CSV fields are left unset
+
+    Yields
+    ------
+    tuple[int, dict | None]
+        Line number, counting CSV rows as one line, and record, or None if the line doesn't parse
+    """
+    if format == "csv":
+        header = None
+        number = 0
+        async for values in read_csv_rows(chunks):
+            number += 1
+            if header is None:
+                header = values
+                continue
+            yield number, {column: value for column, value in zip(header, values, strict=False) if value != ""}
+        return
+
+    number = 0
+    async for line in read_lines(chunks):
+        number += 1
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def upsert_users(engine: Engine, rows: list[UserImport]) -> tuple[int, int]:
+    """
+    Insert new users and update existing ones, matched by email and provider, in one transaction.
+
+    Existing users are looked up in one indexed query, then inserted and
+    updated with one `executemany` each. Updates only set the fields a row
+    has, so importing the same rows again changes nothing. New users get
+    the model's defaults for the fields they don't have. Cached users are
+    invalidated in every worker.
+
+    Parameters
+    ----------
+    engine : Engine
+        Sync engine
+    rows : list[UserImport]
+        Rows, the last one winning for an email and provider
+
+    Returns
+    -------
+    tuple[int, int]
+        Number of users inserted and updated
+    """
+    by_key = {(row.email, row.provider): row for row in rows}
+    with engine.begin() as conn:
+        emails = list({email for email, _ in by_key})
+        query = select(USER_TABLE.c.email, USER_TABLE.c.provider).where(USER_TABLE.c.email.in_(emails))
+        existing = {tuple(row) for row in conn.execute(query)} & by_key.keys()
+
+        now = datetime.utcnow()
+        new_users = [
+            {**user.model_dump(), "uuid": user.uuid or uuid4(), "join_date": user.join_date or now}
+            for key, user in by_key.items()
+            if key not in existing
+        ]
+        if new_users:
+            conn.execute(insert(USER_TABLE), new_users)
+
+        updates = defaultdict(list)  # fields -> rows, one executemany per set of fields
+        for email, provider in existing:
+            user = by_key[email, provider]
+            fields = frozenset(user.model_fields_set - {"email", "provider", "uuid", "join_date"})
+            if fields:
+                updates[fields].append(
+                    {"match_email": email, "match_provider": provider, **user.model_dump(include=fields)}
+                )
+        for update_rows in updates.values():
+            conn.execute(
+                USER_TABLE.update().where(
+                    USER_TABLE.c.email == bindparam("match_email"),
+                    USER_TABLE.c.provider == bindparam("match_provider"),
+                ),
+                update_rows,
+            )
+
+        keys = {get_user_cache_key(email, provider) for email, provider in existing}
+        for key in keys:
+            users.USER_CACHE.invalidate(key)
+    for key in keys:
+        users.USER_CACHE.invalidate(key)  # again, in case a worker cached the old row while the transaction was open
+    return len(new_users), len(existing)
+
+
+async def import_users(engine: Engine, chunks: AsyncIterator[bytes], format: str = "ndjson") -> dict:
+    """
+    Upsert users from an NDJSON or CSV stream, `IMPORT_BATCH_SIZE` rows per transaction.
+
+    Invalid rows are skipped and counted. Batches already committed stay
+    committed if a later one fails, and importing the stream again is safe.
+
+    Parameters
+    ----------
+    engine : Engine
+        Sync engine, used in the thread pool
+    chunks : AsyncIterator[bytes]
+        Body, e.g. `request.stream()`
+    format : str, optional
+        "ndjson" or "csv", by default "ndjson"
+
+    Returns
+    -------
+    dict
+        Counts of inserted, updated and invalid rows, and the first errors
+    """
+    summary = {"inserted": 0, "updated": 0, "invalid": 0, "errors": []}
+    batch = []
+
+    async def flush():
+        inserted, updated = await run_in_threadpool(upsert_users, engine, batch)
+        summary["inserted"] += inserted
+        summary["updated"] += updated
+        batch.clear()
+
+    async for number, record in read_records(chunks, format):
+        try:
+            if record is None:
+                raise ValueError(f"not a {format} record")
+            batch.append(UserImport.model_validate(record))
+        except (ValidationError, ValueError) as e:
+            summary["invalid"] += 1
+            if len(summary["errors"]) < MAX_IMPORT_ERRORS:
+                summary["errors"].append(f"line {number}: {e}")
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+    if batch:
+        await flush()
+    return summary
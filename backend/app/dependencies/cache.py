@@ -0,0 +1,278 @@
+"""Dependencies for caches shared by the workers of a host."""
+
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from app.config import get_settings
+
+SETTINGS = get_settings()
+CACHE_PATH = SETTINGS.cache_path
+
+PURGE_RATE = 0.001  # share of writes that also delete expired entries
+BUSY_TIMEOUT = 5.0  # seconds to wait for another worker's write
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS invalidations (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    at REAL NOT NULL
+);
+"""
+INVALIDATION_RETENTION = 3600.0  # seconds an invalidation stays in the log
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SharedCache:
+    """
+    TTL cache in a SQLite file, so every worker on a host sees the same entries.
+
+    Values are stored as JSON. `None` is a valid value, for negative caching,
+    so `get` tells hits and misses apart.
+    """
+
+    def __init__(self, namespace: str, path: str = CACHE_PATH):
+        self.namespace = namespace
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "sets": 0, "deletes": 0}
+        self._get_conn().executescript(SCHEMA)
+
+    def _get_conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = _connect(self.path)
+        return conn
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """
+        Get a value.
+
+        Parameters
+        ----------
+        key : str
+            Key
+
+        Returns
+        -------
+        tuple[bool, Any]
+            Whether the key was found unexpired, and its value
+        """
+        row = (
+            self._get_conn()
+            .execute(
+                "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires > ?",
+                (self.namespace, key, time.time()),
+            )
+            .fetchone()
+        )
+        with self.lock:
+            self.counts["hits" if row else "misses"] += 1
+        return (True, json.loads(row[0])) if row else (False, None)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        Set a value.
+
+        Parameters
+        ----------
+        key : str
+            Key
+        value : Any
+            JSON-serializable value
+        ttl : float
+            Seconds until the value expires
+        """
+        conn = self._get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), time.time() + ttl),
+        )
+        with self.lock:
+            self.counts["sets"] += 1
+        if random.random() < PURGE_RATE:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+
+    def delete(self, key: str) -> None:
+        """
+        Delete a value, for every worker.
+
+        Parameters
+        ----------
+        key : str
+            Key
+        """
+        self._get_conn().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+        with self.lock:
+            self.counts["deletes"] += 1
+
+    def clear(self) -> None:
+        """Delete every value of the namespace."""
+        self._get_conn().execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+
+class LocalCache:
+    """
+    Per-process LRU cache with a TTL, invalidated in every worker through a log in a SQLite file.
+
+    `get` first applies the invalidations other workers logged since the
+    last sync, which is a single indexed read of a local file, at most every
+    `sync_interval` seconds: other workers' updates show up within that
+    interval, this worker's own ones at once. `set` takes the
+    log position from before the value was read from its source, and drops
+    the value if the key was invalidated since then, so a slow reader can't
+    cache a value that an update already replaced.
+    """
+
+    def __init__(self, namespace: str, ttl: float, max_size: int, path: str = CACHE_PATH, sync_interval: float = 0.0):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.sync_interval = sync_interval
+        self.synced = 0.0  # monotonic time of the last sync
+        self.entries = OrderedDict()
+        self.invalidated = OrderedDict()  # key -> seq of its last invalidation, the latest `max_size` keys
+        self.forgotten = 0  # seq of the latest invalidation dropped from `invalidated`
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counts = {"hits": 0, "misses": 0, "sets": 0, "invalidations": 0}
+
+        conn = self._get_conn()
+        conn.executescript(SCHEMA)
+        self.seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM invalidations").fetchone()[0]
+
+    def _get_conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = _connect(self.path)
+        return conn
+
+    def sync(self) -> int:
+        """
+        Apply the invalidations logged since the last sync.
+
+        Returns
+        -------
+        int
+            Log position, to pass to `set`
+        """
+        with self.lock:
+            self.synced, last_seq = time.monotonic(), self.seq
+        rows = (
+            self._get_conn()
+            .execute(
+                "SELECT seq, key FROM invalidations WHERE seq > ? AND namespace = ? ORDER BY seq",
+                (last_seq, self.namespace),
+            )
+            .fetchall()
+        )
+        with self.lock:
+            for seq, key in rows:
+                self._mark_invalidated(key, seq)
+                self.seq = max(self.seq, seq)
+            return self.seq
+
+    def _mark_invalidated(self, key: str, seq: int) -> None:
+        # Called with the lock held. Only the latest invalidations are kept, so bulk updates don't grow memory
+        self.entries.pop(key, None)
+        self.invalidated[key] = max(self.invalidated.get(key, 0), seq)
+        self.invalidated.move_to_end(key)
+        while len(self.invalidated) > self.max_size:
+            _, forgotten = self.invalidated.popitem(last=False)
+            self.forgotten = max(self.forgotten, forgotten)
+
+    def needs_sync(self) -> bool:
+        """Whether `get` would read the log, i.e. `sync_interval` has passed since the last sync."""
+        return time.monotonic() - self.synced >= self.sync_interval
+
+    def get(self, key: str, sync: bool = True) -> Any | None:
+        """
+        Get a value.
+
+        Parameters
+        ----------
+        key : str
+            Key
+        sync : bool, optional
+            Whether to sync first if it's due, by default True. Pass False
+            to stay in memory, e.g. on the event loop after syncing in a thread
+
+        Returns
+        -------
+        Any | None
+            Value, or None on a miss
+        """
+        if sync and self.needs_sync():
+            self.sync()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.counts["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts["hits"] += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any, seq: int) -> None:
+        """
+        Set a value, unless the key was invalidated after `seq`.
+
+        Parameters
+        ----------
+        key : str
+            Key
+        value : Any
+            Value
+        seq : int
+            Log position from `sync`, taken before the value was read
+        """
+        self.sync()
+        with self.lock:
+            if self.invalidated.get(key, self.forgotten) > seq:  # unknown keys may have been invalidated since `seq`
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.counts["sets"] += 1
+
+    def invalidate(self, key: str) -> None:
+        """
+        Invalidate a key, in this worker now and in the others on their next access.
+
+        Parameters
+        ----------
+        key : str
+            Key
+        """
+        conn = self._get_conn()
+        now = time.time()
+        cursor = conn.execute(
+            "INSERT INTO invalidations (namespace, key, at) VALUES (?, ?, ?)", (self.namespace, key, now)
+        )
+        with self.lock:
+            self._mark_invalidated(key, cursor.lastrowid)
+            self.counts["invalidations"] += 1
+        if random.random() < PURGE_RATE:
+            conn.execute("DELETE FROM invalidations WHERE at < ?", (now - INVALIDATION_RETENTION,))
@@ -0,0 +1,367 @@
+"""Dependencies for sending emails through an outbox."""
+
+import html
+import json
+import logging
+import random
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formataddr
+from functools import lru_cache
+from uuid import uuid4
+
+from markdown import markdown
+from sqlalchemy import event, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from app.config import get_settings
+from app.database import DBSession, engine
+from app.dependencies.metrics import Histogram
+from app.models.emails import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = get_settings()
+
+SMTP_SSL_HOST = SETTINGS.smtp_ssl_host
+SMTP_SSL_PORT = SETTINGS.smtp_ssl_port
+SMTP_SSL_SENDER = SETTINGS.smtp_ssl_sender
+SMTP_SSL_LOGIN = SETTINGS.smtp_ssl_login
+SMTP_SSL_PASSWORD = SETTINGS.smtp_ssl_password
+SMTP_STARTTLS = SETTINGS.smtp_starttls
+SMTP_TIMEOUT = 30.0  # seconds
+SMTP_IDLE_TIMEOUT = SETTINGS.smtp_idle_timeout
+
+EMAIL_BATCH_SIZE = SETTINGS.email_batch_size
+EMAIL_POLL_INTERVAL = SETTINGS.email_poll_interval
+EMAIL_MAX_ATTEMPTS = SETTINGS.email_max_attempts
+EMAIL_RETRY_DELAY = SETTINGS.email_retry_delay
+EMAIL_MAX_RETRY_DELAY = 3600.0
+EMAIL_LEASE = 300.0  # seconds a sender holds claimed emails before another may retry them
+
+EMAIL_TEMPLATES = {
+    "verify": (
+        "Verify Email",
+        """
+## Welcome!
+
+Head back to the website and enter the following code to continue:
+
+## {code}
+
+If you did not request this code, please ignore this email.
+        """,
+    ),
+    "verify_update": (
+        "Verify Email",
+        """
+## You've requested to update your email.
+
+Head back to the website and enter the following code to continue:
+
+## {code}
+
+If you did not request this code, please ignore this email.
+        """,
+    ),
+    "recovery": (
+        "Password Recovery",
+        """
+## You've requested a password reset.
+
+Head back to the website and enter the following code to continue:
+
+## {code}
+
+If you did not request this code, please ignore this email.
+        """,
+    ),
+}
+
+
+@lru_cache
+def render_template(template: str) -> tuple[str, str, str]:
+    """
+    Render a template's markdown to HTML, once, leaving its fields to fill.
+
+    Parameters
+    ----------
+    template : str
+        Template name
+
+    Returns
+    -------
+    tuple[str, str, str]
+        Subject, plain text body and HTML body
+    """
+    subject, body = EMAIL_TEMPLATES[template]
+    return subject, body, markdown(body)
+
+
+def build_message(email: str, template: str, context: dict) -> MIMEMultipart:
+    """
+    Build the message of an email.
+
+    Parameters
+    ----------
+    email : str
+        Recipient
+    template : str
+        Template name
+    context : dict
+        Template fields
+
+    Returns
+    -------
+    MIMEMultipart
+        Message with plain text and HTML parts
+    """
+    subject, body, html_body = render_template(template)
+    msg = MIMEMultipart("alternative")
+    msg["From"] = formataddr((SMTP_SSL_SENDER, SMTP_SSL_LOGIN))
+    msg["To"] = email
+    msg["Subject"] = subject
+    msg.attach(MIMEText(body.format(**context), "plain"))
+    msg.attach(MIMEText(html_body.format(**{key: html.escape(str(value)) for key, value in context.items()}), "html"))
+    return msg
+
+
+def queue_email(session: DBSession, email: str, template: str, **context) -> OutboxEmail:
+    """
+    Add an email to the outbox, to send once the session commits.
+
+    Parameters
+    ----------
+    session : Session
+        Session
+    email : str
+        Recipient
+    template : str
+        Template name
+    **context
+        Template fields
+
+    Returns
+    -------
+    OutboxEmail
+        Queued email
+    """
+    if template not in EMAIL_TEMPLATES:
+        raise ValueError(f"Unknown email template: {template}")
+    outbox_email = OutboxEmail(email=email, template=template, context=json.dumps(context))
+    session.add(outbox_email)
+    session.info["emails_queued"] = True
+    return outbox_email
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_email_sender(session: Session) -> None:
+    if session.info.pop("emails_queued", False):
+        EMAIL_SENDER.wake.set()
+
+
+class EmailSender:
+    """
+    Background thread that sends the outbox over one persistent SMTP connection.
+
+    Each round claims a batch of due emails by pushing their next attempt
+    past a lease, so senders in other workers skip them, and a sender that
+    dies mid-batch only delays them. Failed sends are retried with jittered
+    exponential backoff until `max_attempts`. The connection is reused
+    across batches and closed after `idle_timeout` seconds without sends.
+    """
+
+    def __init__(
+        self,
+        engine: Engine = engine,
+        host: str = SMTP_SSL_HOST,
+        port: int = SMTP_SSL_PORT,
+        starttls: bool = SMTP_STARTTLS,
+        batch_size: int = EMAIL_BATCH_SIZE,
+        poll_interval: float = EMAIL_POLL_INTERVAL,
+        max_attempts: int = EMAIL_MAX_ATTEMPTS,
+        retry_delay: float = EMAIL_RETRY_DELAY,
+        idle_timeout: float = SMTP_IDLE_TIMEOUT,
+    ):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.smtp = None
+        self.last_used = 0.0
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.counts = {"sent": 0, "retried": 0, "failed": 0, "connections": 0}
+        self.send_latency = Histogram()
+        self.delivery_latency = Histogram()  # from queueing to sending
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        smtp.ehlo()
+        if self.starttls:
+            smtp.starttls()
+            smtp.ehlo()
+        if SMTP_SSL_PASSWORD:
+            smtp.login(SMTP_SSL_LOGIN, SMTP_SSL_PASSWORD)
+        self.counts["connections"] += 1
+        return smtp
+
+    def close(self) -> None:
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def send(self, message: MIMEMultipart) -> None:
+        """
+        Send a message over the pooled connection, reconnecting once if it went stale.
+
+        Parameters
+        ----------
+        message : MIMEMultipart
+            Message
+        """
+        if self.smtp is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self.close()
+        for attempt in range(2):
+            if self.smtp is None:
+                self.smtp = self._connect()
+            try:
+                self.smtp.send_message(message)
+                break
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self.close()
+                if attempt:
+                    raise
+        self.last_used = time.monotonic()
+
+    def claim(self, session: Session) -> list[OutboxEmail]:
+        """
+        Claim a batch of due emails.
+
+        Parameters
+        ----------
+        session : Session
+            Session
+
+        Returns
+        -------
+        list[OutboxEmail]
+            Claimed emails, oldest due first
+        """
+        claim, now = uuid4().hex, datetime.utcnow()
+        due = (
+            select(OutboxEmail.id)
+            .where(OutboxEmail.status == "pending")
+            .where(OutboxEmail.next_attempt_date <= now)
+            .order_by(OutboxEmail.next_attempt_date)
+            .limit(self.batch_size)
+        )
+        session.exec(
+            update(OutboxEmail)
+            .where(OutboxEmail.id.in_(due))
+            .where(OutboxEmail.next_attempt_date <= now)  # rechecked if another sender claimed it concurrently
+            .values(claim=claim, next_attempt_date=now + timedelta(seconds=EMAIL_LEASE))
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return list(session.exec(select(OutboxEmail).where(OutboxEmail.claim == claim)))
+
+    def run_once(self) -> int:
+        """
+        Send one batch of due emails.
+
+        Returns
+        -------
+        int
+            Number of emails claimed
+        """
+        with Session(self.engine) as session:
+            outbox_emails = self.claim(session)
+            for outbox_email in outbox_emails:
+                start = time.perf_counter()
+                try:
+                    self.send(
+                        build_message(outbox_email.email, outbox_email.template, json.loads(outbox_email.context))
+                    )
+                except Exception as e:
+                    outbox_email.attempts += 1
+                    outbox_email.last_error = repr(e)[:1000]
+                    if outbox_email.attempts >= self.max_attempts:
+                        outbox_email.status = "failed"
+                        outbox_email.context = "{}"  # the codes are never needed again
+                        self.counts["failed"] += 1
+                        logger.error(
+                            f"Gave up on email {outbox_email.id} after {outbox_email.attempts} attempts: {e!r}"
+                        )
+                    else:
+                        delay = min(self.retry_delay * 2 ** (outbox_email.attempts - 1), EMAIL_MAX_RETRY_DELAY)
+                        outbox_email.next_attempt_date = datetime.utcnow() + timedelta(
+                            seconds=delay * random.uniform(0.5, 1.0)
+                        )
+                        self.counts["retried"] += 1
+                else:
+                    now = datetime.utcnow()
+                    outbox_email.status = "sent"
+                    outbox_email.sent_date = now
+                    outbox_email.context = "{}"
+                    outbox_email.attempts += 1
+                    self.counts["sent"] += 1
+                    self.send_latency.observe(time.perf_counter() - start)
+                    self.delivery_latency.observe((now - outbox_email.request_date).total_seconds())
+                outbox_email.claim = None
+                session.add(outbox_email)
+                session.commit()  # per email, so a crash never resends the sent ones
+            return len(outbox_emails)
+
+    def _run(self) -> None:
+        while not self.stopping.is_set():
+            self.wake.clear()
+            try:
+                claimed = self.run_once()
+            except Exception:
+                logger.exception("Email sender round failed")
+                claimed = 0
+            if claimed < self.batch_size:
+                if self.smtp is not None and time.monotonic() - self.last_used > self.idle_timeout:
+                    self.close()
+                self.wake.wait(self.poll_interval)
+        self.close()
+
+    def start(self) -> "EmailSender":
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="email-sender", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.stopping.set()
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+
+    def metrics(self) -> dict:
+        return {
+            **self.counts,
+            "connected": self.smtp is not None,
+            "send_latency": self.send_latency.snapshot(),
+            "delivery_latency": self.delivery_latency.snapshot(),
+        }
+
+
+EMAIL_SENDER = EmailSender()
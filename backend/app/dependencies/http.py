@@ -0,0 +1,206 @@
+"""Dependencies for outbound HTTP calls to providers."""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+
+import httpx
+
+from app.config import get_settings
+from app.dependencies.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = get_settings()
+HTTP_TIMEOUT = SETTINGS.http_timeout
+HTTP_CONNECT_TIMEOUT = SETTINGS.http_connect_timeout
+HTTP_MAX_RETRIES = SETTINGS.http_max_retries
+HTTP_MAX_CONNECTIONS = SETTINGS.http_max_connections
+HTTP_KEEPALIVE_EXPIRY = 30.0  # seconds an idle pooled connection stays open
+HTTP_RETRY_DELAY = 0.2  # seconds, doubled per retry, with full jitter
+HTTP_MAX_RETRY_DELAY = 2.0
+CIRCUIT_FAILURE_THRESHOLD = SETTINGS.http_circuit_failure_threshold
+CIRCUIT_RESET_TIMEOUT = SETTINGS.http_circuit_reset_timeout
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailableError(Exception):
+    """Raised when a provider can't be reached, or its circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker that fails calls fast after consecutive failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    calls fail without being made. After `reset_timeout` seconds one call
+    is let through: its success closes the circuit, its failure reopens it.
+    """
+
+    def __init__(
+        self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None  # monotonic time the circuit opened, None when closed
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.reset_timeout or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def release_probe(self):
+        """Let another call probe, after a call that ended without a verdict, e.g. when it was cancelled."""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened is None or self.probing:
+                    logger.warning(f"Circuit opened after {self.failures} consecutive failures")
+                self.opened = time.monotonic()
+                self.probing = False
+
+
+class HTTPClient:
+    """
+    Pooled async HTTP client with timeouts, jittered retries and a circuit breaker.
+
+    Connections are kept alive across calls. Transport errors, timeouts and
+    retryable statuses are retried up to `max_retries` times; once retries
+    are exhausted, or the circuit is open, `UpstreamUnavailableError` is
+    raised. Other responses, including 4xx, are returned as they are. The
+    underlying `httpx.AsyncClient` is bound to an event loop, so one is made
+    per loop.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = HTTP_TIMEOUT,
+        connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+        max_retries: int = HTTP_MAX_RETRIES,
+        max_connections: int = HTTP_MAX_CONNECTIONS,
+        breaker: CircuitBreaker | None = None,
+    ):
+        self.name = name
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        self.breaker = breaker or CircuitBreaker()
+        self.clients = {}  # event loop -> client
+        self.counts = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0}
+        self.latency = Histogram()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self.clients.get(loop)
+        if client is None:
+            for other in [other for other in self.clients if other.is_closed()]:
+                del self.clients[other]
+            client = self.clients[loop] = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Make a request, retrying transient failures.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method
+        url : str
+            URL
+        **kwargs
+            Arguments of `httpx.AsyncClient.request`
+
+        Returns
+        -------
+        httpx.Response
+            Response
+
+        Raises
+        ------
+        UpstreamUnavailableError
+            If the circuit is open, or every attempt failed
+        """
+        if not self.breaker.allow():
+            self.counts["short_circuited"] += 1
+            raise UpstreamUnavailableError(f"{self.name} circuit is open")
+
+        try:
+            return await self._request(method, url, **kwargs)
+        except BaseException:
+            self.breaker.release_probe()  # e.g. cancelled, so a later call can probe again
+            raise
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        client = self._get_client()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.counts["retries"] += 1
+                await asyncio.sleep(random.uniform(0, min(HTTP_RETRY_DELAY * 2 ** (attempt - 1), HTTP_MAX_RETRY_DELAY)))
+            self.counts["requests"] += 1
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError as e:  # includes timeouts
+                error = e
+                continue
+            finally:
+                self.latency.observe(time.perf_counter() - start)
+            if response.status_code not in RETRY_STATUS_CODES:
+                self.breaker.record_success()
+                return response
+            error = httpx.HTTPStatusError(
+                f"{response.status_code} from {url}", request=response.request, response=response
+            )
+
+        self.counts["failures"] += 1
+        self.breaker.record_failure()
+        raise UpstreamUnavailableError(
+            f"{self.name} failed after {self.max_retries + 1} attempts: {error!r}"
+        ) from error
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def metrics(self) -> dict:
+        return {**self.counts, "circuit": self.breaker.state, "latency": self.latency.snapshot()}
+
+    async def aclose(self):
+        """Close the client of the running event loop."""
+        client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
@@ -1,9 +1,16 @@
 """Dependencies for items endpoints."""
 
+import glob
+import hashlib
+import json
 import logging
 import math
+import os
 import random
+import re
 import signal
+import statistics
+import time
 import traceback
 from contextlib import contextmanager
 from datetime import datetime
@@ -15,12 +22,14 @@ from homeharvest import scrape_property
 from pydantic import BaseModel, Field
 
 from app.config import get_settings
+from app.dependencies.lm import LM_METRICS, count_tokens, get_lm
+from app.dependencies.metrics import OPERATION_SECONDS
 from app.models.items import Property, SearchRequest, SearchResult
 
 logger = logging.getLogger(__name__)
 
 SETTINGS = get_settings()
-OPENAI_API_KEY = SETTINGS.openai_api_key
+SCRAPE_SNAPSHOT_PATH = SETTINGS.scrape_snapshot_path
 
 DEFAULT_MAX_POPUPS = 10
 
@@ -31,9 +40,41 @@ DEFAULT_DELTA = 0.0001
 DEFAULT_MAX_RETRIES = 3
 DEFAULT_TIMEOUT = 10  # seconds
 
+SCRAPE_PARAMS = {"location", "listing_type", "radius", "mls_only", "past_days", "date_from", "date_to", "foreclosure"}
+SNAPSHOT_MANIFEST = "manifest.json"
+SNAPSHOT_VERSION_PATTERN = re.compile(r"^v(\d+)$")
+
+DEFAULT_PROMPT_FIELDS = [
+    "status",
+    "street",
+    "unit",
+    "city",
+    "state",
+    "zip_code",
+    "style",
+    "beds",
+    "full_baths",
+    "half_baths",
+    "sqft",
+    "lot_sqft",
+    "year_built",
+    "stories",
+    "list_price",
+    "sold_price",
+    "price_per_sqft",
+    "hoa_fee",
+    "list_date",
+    "last_sold_date",
+    "days_on_mls",
+    "parking_garage",
+    "neighborhoods",
+]
+DEFAULT_MAX_PROMPT_TOKENS = 1500
+SUMMARY_FIELDS = ["list_price", "sold_price", "beds", "sqft", "year_built"]
+
 
 # Timeout handling
-class TimeoutException(Exception):
+class TimeoutException(TimeoutError):
     """Exception raised when a timeout occurs."""
 
     pass
@@ -52,20 +93,107 @@ def time_limit(seconds):
         signal.alarm(0)
 
 
+# Scrape snapshots
+def get_scrape_key(request: SearchRequest) -> str:
+    """
+    Get the snapshot key of a search request.
+
+    Parameters
+    ----------
+    request : SearchRequest
+        Search request
+
+    Returns
+    -------
+    str
+        Hash of the parameters passed to `scrape_property`
+    """
+    params = request.model_dump(include=SCRAPE_PARAMS)
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_latest_snapshot_path(examples_path: str) -> str | None:
+    """
+    Get the latest snapshot version of a dataset.
+
+    Parameters
+    ----------
+    examples_path : str
+        Path to the dataset CSV
+
+    Returns
+    -------
+    str | None
+        Path to the latest snapshot version, if any
+    """
+    versions = {}
+    for path in glob.glob(os.path.join(os.path.splitext(examples_path)[0], "v*", SNAPSHOT_MANIFEST)):
+        match = SNAPSHOT_VERSION_PATTERN.match(os.path.basename(os.path.dirname(path)))
+        if match:  # skip e.g. "v2-backup"
+            versions[int(match.group(1))] = os.path.dirname(path)
+    return versions[max(versions)] if versions else None
+
+
+class ScrapeSnapshot:
+    """Scraped frames stored as Parquet, keyed by search parameters."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, SNAPSHOT_MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+    def get(self, request: SearchRequest) -> pd.DataFrame | None:
+        frame = self.manifest["frames"].get(get_scrape_key(request))
+        if frame is None:
+            return None
+        return pd.read_parquet(os.path.join(self.path, frame["file"]))
+
+
+scrape_snapshot = ScrapeSnapshot(SCRAPE_SNAPSHOT_PATH) if SCRAPE_SNAPSHOT_PATH else None
+
+
+def use_snapshot(path: str | None) -> None:
+    """
+    Serve scrapes from a snapshot instead of live requests.
+
+    Parameters
+    ----------
+    path : str | None
+        Path to the snapshot version, or None to scrape live
+    """
+    global scrape_snapshot
+    scrape_snapshot = ScrapeSnapshot(path) if path else None
+
+
+def scrape(request: SearchRequest) -> pd.DataFrame:
+    """
+    Scrape properties, from the active snapshot if it has the request.
+
+    Parameters
+    ----------
+    request : SearchRequest
+        Search request
+
+    Returns
+    -------
+    pd.DataFrame
+        Scraped properties
+    """
+    if scrape_snapshot is not None:
+        properties = scrape_snapshot.get(request)
+        if properties is not None:
+            return properties
+        logger.warning(f"Snapshot miss for {request.location}, scraping live.")
+    with OPERATION_SECONDS.time(operation="scrape"):
+        return scrape_property(**request.model_dump(include=SCRAPE_PARAMS))
+
+
 # Search properties
 def search_properties(request: SearchRequest) -> SearchResult:
     """Search properties."""
-    properties = scrape_property(
-        location=request.location,
-        listing_type=request.listing_type,
-        radius=request.radius,
-        mls_only=request.mls_only,
-        past_days=request.past_days,
-        date_from=request.date_from,
-        date_to=request.date_to,
-        foreclosure=request.foreclosure,
-    )
+    properties = scrape(request)
 
+    start = time.perf_counter()
     list_properties = []
     for _, row in properties.iterrows():
         list_properties.append(
@@ -132,6 +260,8 @@ def search_properties(request: SearchRequest) -> SearchResult:
             )
         )
 
+    OPERATION_SECONDS.observe(time.perf_counter() - start, operation="dataframe")
+
     lats = [p.latitude for p in list_properties if p.latitude]
     longs = [p.longitude for p in list_properties if p.longitude]
 
@@ -146,6 +276,101 @@ def search_properties(request: SearchRequest) -> SearchResult:
     return search_result
 
 
+# Prompt serialization
+class SerializedProperties(BaseModel):
+    """Properties rendered for a prompt."""
+
+    text: str
+    tokens: int
+    full_tokens: int
+    num_properties: int
+    num_shown: int
+
+
+def _format_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def serialize_properties(
+    properties: list[Property],
+    fields: list[str] = DEFAULT_PROMPT_FIELDS,
+    max_tokens: int = DEFAULT_MAX_PROMPT_TOKENS,
+) -> SerializedProperties:
+    """
+    Render properties as a compact table that fits a token budget.
+
+    Only the given fields that are set for at least one property become columns.
+    When the table is over budget, an evenly spaced sample of rows is kept and
+    the rest is summarized.
+
+    Parameters
+    ----------
+    properties : list[Property]
+        Properties
+    fields : list[str]
+        Fields to include
+    max_tokens : int
+        Token budget
+
+    Returns
+    -------
+    SerializedProperties
+        Rendered properties and their token counts
+    """
+    columns = [field for field in fields if any(getattr(p, field) is not None for p in properties)]
+    header = "|".join(columns)
+    rows = ["|".join(_format_value(getattr(p, field)) for field in columns) for p in properties]
+    full_text = "\n".join([f"{len(properties)} properties", header, *rows])
+    full_tokens = count_tokens(full_text)
+    if full_tokens <= max_tokens:
+        return SerializedProperties(
+            text=full_text,
+            tokens=full_tokens,
+            full_tokens=full_tokens,
+            num_properties=len(properties),
+            num_shown=len(properties),
+        )
+
+    summary = []
+    for field in SUMMARY_FIELDS:
+        values = [getattr(p, field) for p in properties if getattr(p, field) is not None]
+        if values:
+            summary.append(
+                f"{field} {_format_value(min(values))}-{_format_value(max(values))}"
+                f" (median {_format_value(float(statistics.median(values)))})"
+            )
+    summary = "Summary: " + "; ".join(summary)
+
+    budget = max_tokens - count_tokens(
+        "\n".join([f"{len(properties)} properties (showing {len(rows)})", header, summary])
+    )
+    row_tokens = sorted(count_tokens(row) + 1 for row in rows)
+    num_shown = 0
+    while num_shown < len(rows) and budget >= row_tokens[num_shown]:
+        budget -= row_tokens[num_shown]
+        num_shown += 1
+    while num_shown:  # sampled rows aren't necessarily the shortest
+        shown = [rows[i * len(rows) // num_shown] for i in range(num_shown)]
+        text = "\n".join([f"{len(properties)} properties (showing {num_shown})", header, *shown, summary])
+        if count_tokens(text) <= max_tokens:
+            break
+        num_shown -= 1
+    if not num_shown:
+        text = "\n".join([f"{len(properties)} properties (showing 0)", summary])
+
+    return SerializedProperties(
+        text=text,
+        tokens=count_tokens(text),
+        full_tokens=full_tokens,
+        num_properties=len(properties),
+        num_shown=num_shown,
+    )
+
+
 # Location checker
 class Input(BaseModel):
     """Input model."""
@@ -193,7 +418,7 @@ class LocationReplacer(dspy.Module):
     ):
         super().__init__()
 
-        self.lm = dspy.OpenAI(model=model, api_key=OPENAI_API_KEY, model_type="chat")
+        self.lm = get_lm(model)
         self.max_hops = max_hops
         self.temperature = temperature
         self.delta = delta
@@ -208,7 +433,7 @@ class LocationReplacer(dspy.Module):
 
         for hop in range(self.max_hops):
             try:
-                with time_limit(self.gen_timeout):
+                with time_limit(self.gen_timeout), LM_METRICS.track("ReplaceLocation"):
                     with dspy.context(lm=self.lm):
                         replacements = self.generate_replace[hop](
                             input=Input(
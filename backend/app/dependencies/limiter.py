@@ -0,0 +1,168 @@
+"""Dependencies for limiting outbound calls."""
+
+import logging
+import random
+import threading
+import time
+from collections.abc import Callable
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKOFF = 0.5  # multiplicative decrease
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_DELAY = 0.5  # seconds, doubled per retry
+DEFAULT_MAX_RETRY_DELAY = 30.0
+DEFAULT_LOG_INTERVAL = 30.0  # seconds
+LATENCY_SMOOTHING = 0.2
+
+
+class TokenBucket:
+    """Token bucket that lets callers borrow against future refills and wait them out."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1.0) -> float:
+        """Take tokens, sleeping until the bucket covers them. Returns the time waited."""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def refund(self, amount: float):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter that adapts to the provider with AIMD.
+
+    The limit grows by one per limit's worth of fast successful calls and is
+    cut by `backoff` (at most once per smoothed latency) when a call is
+    throttled or slower than `target_latency`. Throttled calls are retried
+    with jittered exponential backoff. Optional token buckets cap requests
+    and tokens per minute.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        max_limit: int,
+        min_limit: int = 1,
+        target_latency: float = float("inf"),
+        backoff: float = DEFAULT_BACKOFF,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        throttle_errors: tuple[type[Exception], ...] = (),
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        name: str = "limiter",
+        log_interval: float = DEFAULT_LOG_INTERVAL,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self.throttle_errors = throttle_errors
+        self.max_retries = max_retries
+        self.name = name
+        self.log_interval = log_interval
+
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency = 0.0
+        self.last_decrease = 0.0
+        self.last_log = time.monotonic()
+        self.counts = {"calls": 0, "throttled": 0, "errors": 0, "slow": 0, "decreases": 0}
+        self.wait_time = 0.0
+
+    def acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            self.waiting += 1
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+            self.wait_time += time.monotonic() - start
+
+    def release(self, latency: float, throttled: bool = False, failed: bool = False):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            self.counts["calls"] += 1
+            if throttled:
+                self.counts["throttled"] += 1
+            elif failed:
+                self.counts["errors"] += 1
+            elif self.latency:
+                self.latency = LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+            else:
+                self.latency = latency
+
+            slow = not throttled and not failed and latency > self.target_latency
+            self.counts["slow"] += slow
+            if throttled or slow:
+                if now - self.last_decrease > self.latency:  # one decrease per congestion event
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_decrease = now
+                    self.counts["decreases"] += 1
+            elif not failed:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+            if now - self.last_log > self.log_interval:
+                self.last_log = now
+                logger.info(f"{self.name}: {self.metrics()}")
+
+    def call(self, fn: Callable[[], Any], tokens: int = 0) -> Any:
+        """Call `fn` within the limits, retrying when it is throttled."""
+        for attempt in range(self.max_retries + 1):
+            waited = self.requests.take() if self.requests else 0.0
+            waited += self.tokens.take(tokens) if self.tokens else 0.0
+            with self.cond:
+                self.wait_time += waited
+            self.acquire()
+            start = time.monotonic()
+            try:
+                result = fn()
+            except self.throttle_errors:
+                self.release(time.monotonic() - start, throttled=True)
+                if attempt == self.max_retries:
+                    raise
+                delay = min(DEFAULT_MAX_RETRY_DELAY, DEFAULT_RETRY_DELAY * 2**attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                continue
+            except Exception:
+                self.release(time.monotonic() - start, failed=True)
+                raise
+            self.release(time.monotonic() - start)
+            return result
+
+    def metrics(self) -> dict[str, float]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "latency": round(self.latency, 4),
+            "wait_time": round(self.wait_time, 2),
+            **self.counts,
+        }
@@ -0,0 +1,395 @@
+"""Dependencies for language models."""
+
+import json
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any
+
+import dspy
+import httpx
+import openai
+from dsp.modules.lm import LM
+
+from app.config import get_settings
+from app.dependencies.limiter import AdaptiveLimiter
+from app.dependencies.metrics import OPERATION_SECONDS, Histogram
+
+SETTINGS = get_settings()
+OPENAI_API_KEY = SETTINGS.openai_api_key
+LM_BACKEND = SETTINGS.lm_backend
+
+FAKE_LM_URL = "http://fake-lm/v1/chat/completions"
+FORMAT_HEADER = "Follow the following format.\n\n"
+JSON_SCHEMA_MARKER = "JSON Schema: "
+CHARS_PER_TOKEN = 4  # rough estimate for English text
+THROTTLED_LATENCY = 0.005  # seconds before the fake LM answers with a 429
+
+LM_LIMITER = AdaptiveLimiter(
+    initial=SETTINGS.lm_initial_concurrency,
+    max_limit=SETTINGS.lm_max_concurrency,
+    target_latency=SETTINGS.lm_target_latency,
+    requests_per_minute=SETTINGS.lm_requests_per_minute,
+    tokens_per_minute=SETTINGS.lm_tokens_per_minute,
+    throttle_errors=(openai.RateLimitError,),
+    name="lm",
+)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in a text.
+
+    Parameters
+    ----------
+    text : str
+        Text
+
+    Returns
+    -------
+    int
+        Estimated number of tokens
+    """
+    return len(text) // CHARS_PER_TOKEN
+
+
+class LMMetrics:
+    """
+    Per-signature metrics of LM calls.
+
+    Predictors attribute their calls with `track`. Calls beyond the first in
+    a prediction are retries after outputs that failed to parse, and a
+    prediction that raises a ValueError after the LM answered gave up on
+    parsing its outputs, counted as a parse failure.
+    """
+
+    def __init__(self):
+        self.signatures = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _get(self, signature: str) -> dict:
+        if signature not in self.signatures:
+            self.signatures[signature] = {
+                "latency": Histogram(),
+                "predictions": 0,
+                "calls": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "retries": 0,
+                "parse_failures": 0,
+                "throttled": 0,
+                "timeouts": 0,
+                "errors": 0,
+            }
+        return self.signatures[signature]
+
+    @contextmanager
+    def track(self, signature: str):
+        """Attribute the LM calls in the block to a signature, unless an outer block already does."""
+        if getattr(self.local, "signature", None):
+            yield
+            return
+        self.local.signature, self.local.calls = signature, 0
+        parse_failed = False
+        try:
+            yield
+        except ValueError:  # TypedPredictor has no exception type of its own for outputs it can't parse
+            parse_failed = self.local.calls > 0
+            raise
+        finally:
+            with self.lock:
+                stats = self._get(signature)
+                stats["predictions"] += 1
+                stats["retries"] += max(0, self.local.calls - 1)
+                stats["parse_failures"] += parse_failed
+            self.local.signature = None
+
+    def record(self, latency: float, response: dict[str, Any] | None = None, error: Exception | None = None):
+        """Record a call to the provider."""
+        signature = getattr(self.local, "signature", None) or "untracked"
+        with self.lock:
+            stats = self._get(signature)
+            if isinstance(error, openai.RateLimitError):
+                stats["throttled"] += 1
+            elif isinstance(error, TimeoutError | openai.APITimeoutError):
+                stats["timeouts"] += 1
+            elif error is not None:
+                stats["errors"] += 1
+            else:
+                self.local.calls = getattr(self.local, "calls", 0) + 1
+                usage = response.get("usage") or {}
+                stats["calls"] += 1
+                stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                stats["completion_tokens"] += usage.get("completion_tokens", 0)
+        if error is None:
+            stats["latency"].observe(latency)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self.lock:
+            signatures = {name: dict(stats) for name, stats in self.signatures.items()}
+        return {name: {**stats, "latency": stats["latency"].snapshot()} for name, stats in sorted(signatures.items())}
+
+
+LM_METRICS = LMMetrics()
+
+
+class LimitedLM(LM):
+    """
+    Mixin recording the requests of a language model and routing them through a limiter.
+
+    Put it before the model's class, e.g. `class LimitedOpenAI(LimitedLM, dspy.OpenAI)`,
+    so `copy()`, which DSPy uses for per-call settings such as the temperature,
+    keeps the limiter and the metrics. The limiter retries throttled requests,
+    so DSPy's own backoff in `request` is skipped.
+    """
+
+    def __init__(self, *args, limiter: AdaptiveLimiter | None = None, metrics: LMMetrics | None = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+        self.metrics = metrics
+
+    def copy(self, **kwargs):
+        return super().copy(limiter=self.limiter, metrics=self.metrics, **kwargs)
+
+    def request(self, prompt: str, **kwargs) -> dict[str, Any]:
+        kwargs.pop("model_type", None)
+        return self.basic_request(prompt, **kwargs)
+
+    def basic_request(self, prompt: str, **kwargs) -> dict[str, Any]:
+        if self.limiter is None:
+            return self._attempt(prompt, **kwargs)
+        estimate = count_tokens(prompt) + kwargs.get("max_tokens", self.kwargs.get("max_tokens", 0))
+        response = self.limiter.call(lambda: self._attempt(prompt, **kwargs), tokens=estimate)
+        if self.limiter.tokens and response.get("usage"):
+            self.limiter.tokens.refund(estimate - response["usage"]["total_tokens"])
+        return response
+
+    def _attempt(self, prompt: str, **kwargs) -> dict[str, Any]:
+        if self.metrics is None:
+            return super().basic_request(prompt, **kwargs)
+        start = time.perf_counter()
+        try:
+            response = super().basic_request(prompt, **kwargs)
+        except Exception as e:
+            self.metrics.record(time.perf_counter() - start, error=e)
+            raise
+        finally:
+            OPERATION_SECONDS.observe(time.perf_counter() - start, operation="lm")
+        self.metrics.record(time.perf_counter() - start, response)
+        return response
+
+
+class LimitedOpenAI(LimitedLM, dspy.OpenAI):
+    """OpenAI model, instrumented and limited."""
+
+
+def get_lm(model: str) -> LM:
+    """
+    Get the language model for the configured backend, instrumented and limited by `LM_LIMITER`.
+
+    Parameters
+    ----------
+    model : str
+        Model name
+
+    Returns
+    -------
+    LM
+        Language model
+    """
+    if LM_BACKEND == "openai":
+        return LimitedOpenAI(
+            model=model, api_key=OPENAI_API_KEY, model_type="chat", limiter=LM_LIMITER, metrics=LM_METRICS
+        )
+    if LM_BACKEND == "fake":
+        return LimitedFakeLM(
+            model=model,
+            seed=SETTINGS.fake_lm_seed,
+            latency=SETTINGS.fake_lm_latency,
+            latency_mean=SETTINGS.fake_lm_latency_mean,
+            latency_std=SETTINGS.fake_lm_latency_std,
+            error_rate=SETTINGS.fake_lm_error_rate,
+            completion_tokens=SETTINGS.fake_lm_completion_tokens,
+            max_concurrency=SETTINGS.fake_lm_max_concurrency,
+            limiter=LM_LIMITER,
+            metrics=LM_METRICS,
+        )
+    raise ValueError(f"Unknown LM backend: {LM_BACKEND}")
+
+
+class FakeLM(LM):
+    """
+    Deterministic stand-in for a chat completions model.
+
+    Completions are generated from the JSON schemas DSPy puts in typed prompts,
+    so `TypedPredictor`s parse them like real outputs. The same prompt always
+    yields the same completion, while latencies and errors follow a seeded sequence.
+    Like a provider's rate limit, `max_concurrency` is shared by all instances.
+    """
+
+    in_flight = 0
+    in_flight_lock = threading.Lock()
+
+    def __init__(
+        self,
+        model: str = "fake",
+        seed: int = 0,
+        latency: str = "constant",
+        latency_mean: float = 0.0,
+        latency_std: float = 0.0,
+        error_rate: float = 0.0,
+        completion_tokens: int = 0,
+        max_concurrency: int = 0,
+        **kwargs,
+    ):
+        super().__init__(model)
+        self.provider = "openai"
+        self.model_type = "chat"
+        self.kwargs.update(kwargs)
+
+        self.seed = seed
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.error_rate = error_rate
+        self.completion_tokens = completion_tokens
+        self.max_concurrency = max_concurrency
+        self.rng = random.Random(seed)
+
+    def copy(self, **kwargs):
+        return self.__class__(
+            model=self.kwargs["model"],
+            seed=self.seed,
+            latency=self.latency,
+            latency_mean=self.latency_mean,
+            latency_std=self.latency_std,
+            error_rate=self.error_rate,
+            completion_tokens=self.completion_tokens,
+            max_concurrency=self.max_concurrency,
+            **kwargs,
+        )
+
+    def sample_latency(self) -> float:
+        if self.latency == "constant":
+            return self.latency_mean
+        if self.latency == "normal":
+            return max(0.0, self.rng.gauss(self.latency_mean, self.latency_std))
+        if self.latency == "lognormal":  # mean and std of the latency itself, not its log
+            if not self.latency_mean:
+                return 0.0
+            sigma2 = math.log(1 + (self.latency_std / self.latency_mean) ** 2)
+            return self.rng.lognormvariate(math.log(self.latency_mean) - sigma2 / 2, math.sqrt(sigma2))
+        if self.latency == "exponential":
+            return self.rng.expovariate(1 / self.latency_mean) if self.latency_mean else 0.0
+        raise ValueError(f"Unknown latency distribution: {self.latency}")
+
+    def complete(self, prompt: str) -> str:
+        """Complete the remaining fields of a DSPy prompt."""
+        rng = random.Random(f"{self.seed}:{prompt}")
+        fields = _parse_format(prompt)
+        last_line = prompt.rstrip().split("\n")[-1].strip()
+        start = next((i for i, (prefix, _) in enumerate(fields) if prefix == last_line), len(fields) - 1)
+
+        parts = []
+        for i, (prefix, line) in enumerate(fields[max(start, 0) :]):
+            value = _fake_field(line, rng)
+            parts.append(value if i == 0 else f"{prefix} {value}")
+        return "\n\n".join(parts)
+
+    def basic_request(self, prompt: str, **kwargs) -> dict[str, Any]:
+        raw_kwargs = kwargs
+        kwargs = {**self.kwargs, **kwargs}
+
+        with FakeLM.in_flight_lock:
+            FakeLM.in_flight += 1
+            throttled = self.max_concurrency and FakeLM.in_flight > self.max_concurrency
+            latency, error = self.sample_latency(), self.rng.random() < self.error_rate
+        try:
+            time.sleep(THROTTLED_LATENCY if throttled else latency)
+        finally:
+            with FakeLM.in_flight_lock:
+                FakeLM.in_flight -= 1
+        if throttled or error:
+            raise openai.RateLimitError(
+                "Rate limit reached",
+                response=httpx.Response(429, request=httpx.Request("POST", FAKE_LM_URL)),
+                body=None,
+            )
+
+        text = self.complete(prompt)
+        response = {
+            "choices": [
+                {"message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                for _ in range(kwargs.get("n", 1))
+            ],
+            "usage": {
+                "prompt_tokens": count_tokens(prompt),
+                "completion_tokens": self.completion_tokens or count_tokens(text),
+            },
+        }
+        response["usage"]["total_tokens"] = response["usage"]["prompt_tokens"] + response["usage"]["completion_tokens"]
+
+        self.history.append({"prompt": prompt, "response": response, "kwargs": kwargs, "raw_kwargs": raw_kwargs})
+        return response
+
+    def _get_choice_text(self, choice: dict[str, Any]) -> str:
+        return choice["message"]["content"]
+
+    def __call__(self, prompt: str, only_completed: bool = True, return_sorted: bool = False, **kwargs) -> list[str]:
+        response = self.request(prompt, **kwargs)
+        return [self._get_choice_text(choice) for choice in response["choices"]]
+
+
+class LimitedFakeLM(LimitedLM, FakeLM):
+    """Fake model, instrumented and limited."""
+
+
+def _parse_format(prompt: str) -> list[tuple[str, str]]:
+    """Get the (prefix, format line) of each field in a DSPy prompt."""
+    if FORMAT_HEADER not in prompt:
+        return [("", "")]
+    section = prompt.split(FORMAT_HEADER, 1)[1].split("\n\n---", 1)[0]
+    return [(line.split(" ${", 1)[0].strip(), line) for line in section.split("\n") if line.strip()]
+
+
+def _fake_field(line: str, rng: random.Random) -> str:
+    """Fake the value of a field from its format line."""
+    if JSON_SCHEMA_MARKER in line:
+        schema = json.loads(line.split(JSON_SCHEMA_MARKER, 1)[1])
+        return json.dumps(_fake_value(schema, schema.get("$defs", {}), rng))
+    if "${produce the output}" in line:
+        return "produce the output. We fake it."
+    return "fake"
+
+
+def _fake_value(schema: dict, defs: dict, rng: random.Random) -> Any:
+    """Fake a value that validates against a JSON schema."""
+    if "$ref" in schema:
+        return _fake_value(defs[schema["$ref"].split("/")[-1]], defs, rng)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"] or schema["anyOf"]
+        return _fake_value(options[0], defs, rng)
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {name: _fake_value(prop, defs, rng) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [_fake_value(schema.get("items", {}), defs, rng) for _ in range(rng.randint(0, 2))]
+    if schema_type == "string":
+        if "yes or no" in schema.get("description", ""):
+            return rng.choice(["yes", "no"])
+        if schema.get("format") == "date-time":
+            return "2024-01-01T00:00:00"
+        return f"fake-{rng.randrange(16**6):06x}"
+    if schema_type == "integer":
+        return rng.randint(0, 10)
+    if schema_type == "number":
+        return round(rng.uniform(0, 10), 2)
+    if schema_type == "boolean":
+        return rng.random() < 0.5
+    return None
@@ -0,0 +1,383 @@
+"""Dependencies for in-process metrics, and their Prometheus exposition across workers."""
+
+import bisect
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import get_settings
+from app.dependencies.cache import CACHE_PATH, _connect
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = get_settings()
+METRICS_ENABLED = SETTINGS.metrics_enabled
+METRICS_FLUSH_INTERVAL = SETTINGS.metrics_flush_interval
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+ROUTE_CACHE_SIZE = 1024  # paths whose route template is cached, per worker
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)  # bytes
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    pid INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    live INTEGER NOT NULL,
+    PRIMARY KEY (pid, name, labels)
+);
+"""
+
+
+class Histogram:
+    """Thread-safe histogram with fixed bucket upper bounds, like Prometheus'."""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate a quantile by interpolating within its bucket."""
+        with self.lock:
+            if not self.count:
+                return None
+            rank, seen = q * self.count, 0
+            for i, count in enumerate(self.counts):
+                if seen + count >= rank and count:
+                    lower = self.buckets[i - 1] if i else 0.0
+                    upper = self.buckets[i] if i < len(self.buckets) else lower
+                    return lower + (upper - lower) * (rank - seen) / count
+                seen += count
+            return self.buckets[-1]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            buckets = dict(zip([*map(str, self.buckets), "+Inf"], self.counts, strict=True))
+            count, total = self.count, self.sum
+        return {
+            "count": count,
+            "sum": round(total, 4),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+def _format_labels(labels: list[tuple[str, str]]) -> str:
+    escaped = ((name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels)
+    return ",".join(f'{name}="{value}"' for name, value in escaped)
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class MetricFamily:
+    """Counter, gauge or histogram of this worker, one value per combination of label values."""
+
+    def __init__(self, name: str, help: str, kind: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label values -> float, or Histogram
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        """Add to a counter, or to a gauge, which can go down."""
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the seconds the block takes, whether it raises or not."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """
+        Get the samples of the family, in the Prometheus data model.
+
+        Returns
+        -------
+        list[tuple[str, str, float]]
+            Name, formatted labels and value of each sample, with cumulative
+            `_bucket`, `_sum` and `_count` samples for histograms
+        """
+        with self.lock:
+            values = list(self.values.items())
+        samples = []
+        for key, value in values:
+            pairs = list(zip(self.labels, key, strict=True))
+            labels = _format_labels(pairs)
+            if self.kind != "histogram":
+                samples.append((self.name, labels, value))
+                continue
+            with value.lock:
+                counts, count, total = list(value.counts), value.count, value.sum
+            cumulative = 0
+            for bound, bucket_count in zip([*map(_format_value, self.buckets), "+Inf"], counts, strict=True):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", _format_labels([*pairs, ("le", bound)]), cumulative))
+            samples += [(f"{self.name}_sum", labels, total), (f"{self.name}_count", labels, count)]
+        return samples
+
+    def render(self, values: dict[tuple[str, str], float]) -> list[str]:
+        """Format the family's samples, e.g. summed across workers, in the Prometheus text format."""
+        names = (
+            [f"{self.name}_bucket", f"{self.name}_sum", f"{self.name}_count"]
+            if self.kind == "histogram"
+            else [self.name]
+        )
+
+        def order(key: tuple[str, str]) -> tuple:  # by labels, then buckets by their bound, then sum and count
+            name, labels = key
+            if name != f"{self.name}_bucket":
+                return labels, names.index(name), 0.0
+            labels, _, bound = labels.rpartition('le="')
+            return labels.rstrip(","), 0, float(bound.rstrip('"'))
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels in sorted((key for key in values if key[0] in names), key=order):
+            lines.append(
+                f"{name}{{{labels}}} {_format_value(values[name, labels])}"
+                if labels
+                else f"{name} {_format_value(values[name, labels])}"
+            )
+        return lines
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MetricsRegistry:
+    """
+    Metric families of this worker, written to a SQLite file so that any worker serves the totals of all of them.
+
+    Each worker writes its samples every `interval` seconds, and before it
+    serves a scrape. Counters and histograms of exited workers are folded
+    into one row per sample, so totals never go down and the table doesn't
+    grow with restarts; their gauges are dropped.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, interval: float = METRICS_FLUSH_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.families = {}
+        self.local = threading.local()
+        self.stopping = threading.Event()
+        self.thread = None
+        self._get_conn().executescript(SCHEMA)
+
+    def _get_conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = _connect(self.path)
+        return conn
+
+    def _add(self, family: MetricFamily) -> MetricFamily:
+        return self.families.setdefault(family.name, family)
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> MetricFamily:
+        return self._add(MetricFamily(name, help, "counter", labels))
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> MetricFamily:
+        return self._add(MetricFamily(name, help, "gauge", labels))
+
+    def histogram(
+        self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> MetricFamily:
+        return self._add(MetricFamily(name, help, "histogram", labels, buckets))
+
+    def flush(self) -> None:
+        """Write this worker's samples."""
+        pid = os.getpid()
+        rows = [
+            (pid, name, labels, value, family.kind == "gauge")
+            for family in list(self.families.values())
+            for name, labels, value in family.samples()
+        ]
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)", rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def collect(self) -> dict[tuple[str, str], float]:
+        """
+        Sum the samples of every worker of the host, after writing this one's.
+
+        Returns
+        -------
+        dict[tuple[str, str], float]
+            Value of each sample name and formatted labels
+        """
+        self.flush()
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            pids = [pid for (pid,) in conn.execute("SELECT DISTINCT pid FROM metrics WHERE pid != 0")]
+            for pid in pids:
+                if _is_alive(pid):
+                    continue
+                conn.execute(
+                    """
+                    INSERT INTO metrics SELECT 0, name, labels, value, 0 FROM metrics WHERE pid = ? AND NOT live
+                    ON CONFLICT (pid, name, labels) DO UPDATE SET value = value + excluded.value
+                    """,
+                    (pid,),
+                )
+                conn.execute("DELETE FROM metrics WHERE pid = ?", (pid,))
+            rows = conn.execute("SELECT name, labels, SUM(value) FROM metrics GROUP BY name, labels").fetchall()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return {(name, labels): value for name, labels, value in rows}
+
+    def render(self) -> str:
+        """Format the totals of every worker in the Prometheus text format."""
+        values = self.collect()
+        return "".join(f"{line}\n" for family in list(self.families.values()) for line in family.render(values))
+
+    def _run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Metrics flush failed")
+
+    def start(self) -> "MetricsRegistry":
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="metrics-flusher", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+            self.flush()
+
+
+METRICS = MetricsRegistry()
+REQUESTS = METRICS.counter(
+    "http_requests_total", "Requests by method, route template and status", ("method", "route", "status")
+)
+REQUEST_SECONDS = METRICS.histogram(
+    "http_request_duration_seconds", "Request latency until the response is sent", ("method", "route")
+)
+REQUESTS_IN_PROGRESS = METRICS.gauge("http_requests_in_progress", "Requests being served", ("method", "route"))
+RESPONSE_BYTES = METRICS.histogram("http_response_size_bytes", "Response body sizes", ("method", "route"), SIZE_BUCKETS)
+OPERATION_SECONDS = METRICS.histogram(
+    "operation_duration_seconds", "Latency of internal operations: scrape, dataframe, lm, db and bcrypt", ("operation",)
+)
+
+
+def get_route_template(scope: Scope) -> str:
+    """Get the path template of the route a request goes to, e.g. "/items/{id}", so labels stay few."""
+    app = scope.get("app")
+    partial = None
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path  # e.g. a method that isn't allowed
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording requests, their latency, in-progress requests and response sizes per route template.
+
+    A plain ASGI middleware rather than `BaseHTTPMiddleware`, so streamed
+    responses pass through without being buffered, and their latency runs
+    until their last chunk is sent. Routes are matched before the request
+    is served, for the in-progress gauge, and cached per method and path,
+    since matching every route takes longer than the rest of the metrics.
+    """
+
+    def __init__(self, app: ASGIApp, cache_size: int = ROUTE_CACHE_SIZE):
+        self.app = app
+        self.cache_size = cache_size
+        self.templates = OrderedDict()  # (method, path) -> route template, the most recent `cache_size`
+
+    def get_route_template(self, scope: Scope) -> str:
+        key = (scope["method"], scope["path"])
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = get_route_template(scope)
+            if len(self.templates) > self.cache_size:
+                self.templates.popitem(last=False)
+        return template
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        labels = {"method": scope["method"], "route": self.get_route_template(scope)}
+        status, size = 500, 0
+
+        async def send_with_metrics(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_PROGRESS.inc(**labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+            REQUESTS_IN_PROGRESS.inc(-1, **labels)
+            RESPONSE_BYTES.observe(size, **labels)
+            REQUESTS.inc(status=str(status), **labels)
@@ -0,0 +1,170 @@
+"""Dependencies for password hashing off the event loop."""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+from app.config import get_settings
+from app.dependencies.metrics import OPERATION_SECONDS, Histogram
+
+SETTINGS = get_settings()
+PASSWORD_HASH_ROUNDS = SETTINGS.password_hash_rounds
+PASSWORD_HASH_WORKERS = SETTINGS.password_hash_workers or os.cpu_count() or 1
+PASSWORD_HASH_MAX_QUEUE = SETTINGS.password_hash_max_queue
+
+
+@lru_cache
+def get_crypt_context(rounds: int = PASSWORD_HASH_ROUNDS) -> CryptContext:
+    """
+    Get the bcrypt context of a work factor.
+
+    Hashes of any other work factor verify, but need an update.
+
+    Parameters
+    ----------
+    rounds : int
+        bcrypt work factor, log2 of the iterations
+
+    Returns
+    -------
+    CryptContext
+        Context
+    """
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+def _hash(password: str, rounds: int) -> tuple[str, float, float]:
+    start = time.time()
+    hashed_password = get_crypt_context(rounds).hash(password)
+    return hashed_password, start, time.time() - start
+
+
+def _verify(password: str, hashed_password: str, rounds: int) -> tuple[tuple[bool, str | None], float, float]:
+    start = time.time()
+    result = get_crypt_context(rounds).verify_and_update(password, hashed_password)
+    return result, start, time.time() - start
+
+
+class PasswordHasher:
+    """
+    bcrypt in a pool of processes, so hashing neither blocks the event loop nor holds the GIL.
+
+    At most `workers` hashes run at once, and at most `max_queue` more wait
+    for a process; past that, requests are rejected with a 503 rather than
+    queued behind seconds of work. The pool is started on first use, so
+    every server worker forks its own.
+    """
+
+    def __init__(
+        self,
+        rounds: int = PASSWORD_HASH_ROUNDS,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+    ):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.counts = {"hashes": 0, "verifications": 0, "rehashes": 0, "rejected": 0}
+        self.wait = Histogram()
+        self.run = Histogram()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+            return self.executor
+
+    async def _submit(self, count: str, fn, *args):
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                self.counts["rejected"] += 1
+                raise HTTPException(status_code=503, detail="Too many password requests, try again later")
+            self.counts[count] += 1
+            self.pending += 1
+        submitted = time.time()
+        try:
+            result, start, duration = await asyncio.wrap_future(self._get_executor().submit(fn, *args, self.rounds))
+        finally:
+            with self.lock:
+                self.pending -= 1
+        self.wait.observe(max(start - submitted, 0.0))
+        self.run.observe(duration)
+        OPERATION_SECONDS.observe(duration, operation="bcrypt")
+        return result
+
+    async def hash(self, password: str) -> str:
+        """
+        Hash a password with the configured work factor.
+
+        Parameters
+        ----------
+        password : str
+            Password
+
+        Returns
+        -------
+        str
+            Hashed password
+        """
+        return await self._submit("hashes", _hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> tuple[bool, str | None]:
+        """
+        Verify a password, and rehash it if its hash has another work factor.
+
+        Parameters
+        ----------
+        password : str
+            Password
+        hashed_password : str
+            Hashed password
+
+        Returns
+        -------
+        tuple[bool, str | None]
+            Whether the password is verified, and its new hash if it needs one
+        """
+        verified, new_hash = await self._submit("verifications", _verify, password, hashed_password)
+        if new_hash:
+            with self.lock:
+                self.counts["rehashes"] += 1
+        return verified, new_hash
+
+    def metrics(self) -> dict:
+        with self.lock:
+            pending, counts = self.pending, dict(self.counts)
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "running": min(pending, self.workers),
+            "queued": max(pending - self.workers, 0),
+            **counts,
+            "wait": self.wait.snapshot(),
+            "run": self.run.snapshot(),
+        }
+
+    def shutdown(self) -> None:
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(cancel_futures=True)
+                self.executor = None
+
+
+PASSWORD_HASHER = PasswordHasher()
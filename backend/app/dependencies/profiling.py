@@ -0,0 +1,310 @@
+"""Dependencies for profiling requests on demand."""
+
+import asyncio
+import logging
+import marshal
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from types import CodeType, FrameType
+from uuid import uuid4
+
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import get_settings
+from app.dependencies.cache import CACHE_PATH, _connect
+from app.dependencies.security import API_KEY
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = get_settings()
+PROFILE_SAMPLE_RATE = SETTINGS.profile_sample_rate
+PROFILE_INTERVAL = SETTINGS.profile_interval
+PROFILE_BUFFER_SIZE = SETTINGS.profile_buffer_size
+PROFILE_HEADER = "X-Profile"  # with the API key, profiles the request
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+AWAIT_FRAME = "[await] (~:0)"  # the request waits, e.g. for the thread pool or the network
+FRAME_PATTERN = re.compile(r"^(.*) \((.*):(\d+)\)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    method TEXT NOT NULL,
+    path TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    interval REAL NOT NULL,
+    folded TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_profiles_created ON profiles (created);
+"""
+
+
+def _frame_name(code: CodeType) -> str:
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({code.co_filename}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Samples of the stack of one request, folded into counts per stack."""
+
+    def __init__(self, method: str, path: str):
+        self.id = uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.created = time.time()
+        self.start = time.perf_counter()
+        self.task = asyncio.current_task()
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+
+    def sample(self, frames: dict[int, FrameType]) -> None:
+        """
+        Count the request's current stack.
+
+        When the request's task runs, its stack is read from the event loop
+        thread, from the task's coroutine up. When it waits, its chain of
+        awaited coroutines is read instead, ending in an `[await]` frame.
+
+        Parameters
+        ----------
+        frames : dict[int, FrameType]
+            Current frame of each thread, from `sys._current_frames()`
+        """
+        coro = self.task.get_coro()
+        root = getattr(coro, "cr_frame", None)
+        if root is None:  # done
+            return
+        stack = []
+        if asyncio.current_task(self.loop) is self.task:
+            frame = frames.get(self.thread_id)
+            while frame is not None and frame is not root:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if frame is None:  # the task switched since the frames were read
+                return
+            stack.append(_frame_name(root.f_code))
+            stack.reverse()
+        else:
+            awaitable = coro
+            while (frame := getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)) is not None:
+                stack.append(_frame_name(frame.f_code))
+                awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+            stack.append(AWAIT_FRAME)
+        self.stacks[";".join(stack)] += 1
+
+    def folded(self) -> str:
+        """Stacks in the folded format of flamegraph.pl and speedscope, one `frame;frame count` per line."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def to_pstats(folded: str, interval: float) -> bytes:
+    """
+    Convert folded stacks to the format of `pstats`, e.g. for `python -m pstats` or snakeviz.
+
+    Times are estimated from the samples: a function's total time counts
+    the samples it's on the stack, its own time the samples it's the leaf.
+    Call counts are sample counts.
+
+    Parameters
+    ----------
+    folded : str
+        Folded stacks
+    interval : float
+        Seconds between samples
+
+    Returns
+    -------
+    bytes
+        Marshalled stats, as `cProfile` dumps them
+    """
+    stats = {}  # (file, line, function) -> [calls, primitive calls, own time, total time, callers]
+    for line in folded.splitlines():
+        stack, _, count = line.rpartition(" ")
+        seconds = int(count) * interval
+        frames = []
+        for frame in stack.split(";"):
+            name, filename, lineno = FRAME_PATTERN.match(frame).groups()
+            frames.append((filename, int(lineno), name))
+        for i, frame in enumerate(frames):
+            entry = stats.setdefault(frame, [0, 0, 0.0, 0.0, {}])
+            if frame not in frames[:i]:  # recursive frames count once
+                entry[0] += int(count)
+                entry[1] += int(count)
+                entry[3] += seconds
+            if i == len(frames) - 1:
+                entry[2] += seconds
+            if i:
+                calls, primitive_calls, own, total = entry[4].get(frames[i - 1], (0, 0, 0.0, 0.0))
+                own += seconds if i == len(frames) - 1 else 0.0
+                entry[4][frames[i - 1]] = (calls + int(count), primitive_calls + int(count), own, total + seconds)
+    return marshal.dumps({frame: (*entry[:4], entry[4]) for frame, entry in stats.items()})
+
+
+class RequestProfiler:
+    """
+    Sampling profiler for the requests that ask for it, keeping the latest profiles of the host in a SQLite file.
+
+    One thread per worker samples every profiled request each `interval`
+    seconds while any is in progress, so requests that aren't profiled
+    cost nothing. Profiles are stored in `CACHE_PATH`, so any worker lists
+    and serves the `buffer_size` latest of every worker.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        interval: float = PROFILE_INTERVAL,
+        buffer_size: int = PROFILE_BUFFER_SIZE,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+    ):
+        self.path = path
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.sample_rate = sample_rate
+        self.active = {}  # id -> Profile
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.local = threading.local()
+        self._get_conn().executescript(SCHEMA)
+
+    def _get_conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = _connect(self.path)
+        return conn
+
+    def should_profile(self, headers: dict[str, str]) -> bool:
+        """Profile requests with the header and the API key, and a `sample_rate` share of the others."""
+        if headers.get(PROFILE_HEADER.lower()) and headers.get("x-api-key") == API_KEY:
+            return True
+        return bool(self.sample_rate) and random.random() < self.sample_rate
+
+    def _run(self) -> None:
+        while self.wake.wait():
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                profiles = list(self.active.values())
+                if not self.active:
+                    self.wake.clear()
+            for profile in profiles:
+                try:
+                    profile.sample(frames)
+                except Exception:
+                    logger.exception("Profile sample failed")
+            del frames
+
+    def start(self, method: str, path: str) -> Profile:
+        """Start sampling the request of the current task."""
+        profile = Profile(method, path)
+        with self.lock:
+            self.active[profile.id] = profile
+            self.wake.set()
+            if self.thread is None or not self.thread.is_alive():  # also after a fork
+                self.thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self.thread.start()
+        return profile
+
+    def stop(self, profile: Profile, status: int) -> None:
+        """Stop sampling a request, and store its profile in place of the oldest past `buffer_size`."""
+        with self.lock:
+            self.active.pop(profile.id, None)
+        duration, samples = time.perf_counter() - profile.start, sum(profile.stacks.values())
+        interval = duration / samples if samples else self.interval  # longer than `interval` while waiting for the GIL
+        row = (
+            profile.id,
+            profile.created,
+            profile.method,
+            profile.path,
+            status,
+            duration,
+            samples,
+            interval,
+            profile.folded(),
+        )
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("INSERT INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            conn.execute(
+                "DELETE FROM profiles WHERE id NOT IN (SELECT id FROM profiles ORDER BY created DESC LIMIT ?)",
+                (self.buffer_size,),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def recent(self) -> list[dict]:
+        """List the stored profiles, newest first, without their stacks."""
+        rows = self._get_conn().execute(
+            "SELECT id, created, method, path, status, duration, samples FROM profiles ORDER BY created DESC"
+        )
+        return [
+            {
+                "id": id,
+                "created": created,
+                "method": method,
+                "path": path,
+                "status": status,
+                "duration": duration,
+                "samples": samples,
+            }
+            for id, created, method, path, status, duration, samples in rows
+        ]
+
+    def get(self, profile_id: str) -> tuple[str, float] | None:
+        """Get a profile's folded stacks and sampling interval, or None if it's gone."""
+        return self._get_conn().execute("SELECT folded, interval FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+
+
+PROFILER = RequestProfiler()
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the requests that ask for it, and telling them their profile's id in `X-Profile-Id`.
+
+    Requests are profiled when they have the `X-Profile` header and the API
+    key, or at random with `PROFILE_SAMPLE_RATE`.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        profiler = PROFILER
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        if not profiler.should_profile(headers):
+            await self.app(scope, receive, send)
+            return
+        profile = profiler.start(scope["method"], scope["path"])
+        status = 500
+
+        async def send_with_id(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {
+                    **message,
+                    "headers": [*message.get("headers", []), (PROFILE_ID_HEADER.lower().encode(), profile.id.encode())],
+                }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            await run_in_threadpool(profiler.stop, profile, status)
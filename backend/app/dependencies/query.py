@@ -0,0 +1,305 @@
+"""Dependencies for parsing natural-language property queries."""
+
+import json
+import re
+from datetime import datetime
+from typing import Any
+
+import dspy
+from pydantic import BaseModel, Field
+
+from app.dependencies.lm import LM_METRICS, get_lm
+from app.models.items import SearchRequest
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+DEFAULT_MAX_RETRIES = 3
+
+# Gazetteer
+STATES = {
+    "alabama": "AL",
+    "alaska": "AK",
+    "arizona": "AZ",
+    "arkansas": "AR",
+    "california": "CA",
+    "colorado": "CO",
+    "connecticut": "CT",
+    "delaware": "DE",
+    "district of columbia": "DC",
+    "florida": "FL",
+    "georgia": "GA",
+    "hawaii": "HI",
+    "idaho": "ID",
+    "illinois": "IL",
+    "indiana": "IN",
+    "iowa": "IA",
+    "kansas": "KS",
+    "kentucky": "KY",
+    "louisiana": "LA",
+    "maine": "ME",
+    "maryland": "MD",
+    "massachusetts": "MA",
+    "michigan": "MI",
+    "minnesota": "MN",
+    "mississippi": "MS",
+    "missouri": "MO",
+    "montana": "MT",
+    "nebraska": "NE",
+    "nevada": "NV",
+    "new hampshire": "NH",
+    "new jersey": "NJ",
+    "new mexico": "NM",
+    "new york": "NY",
+    "north carolina": "NC",
+    "north dakota": "ND",
+    "ohio": "OH",
+    "oklahoma": "OK",
+    "oregon": "OR",
+    "pennsylvania": "PA",
+    "rhode island": "RI",
+    "south carolina": "SC",
+    "south dakota": "SD",
+    "tennessee": "TN",
+    "texas": "TX",
+    "utah": "UT",
+    "vermont": "VT",
+    "virginia": "VA",
+    "washington": "WA",
+    "west virginia": "WV",
+    "wisconsin": "WI",
+    "wyoming": "WY",
+}
+STATE_CODES = set(STATES.values())
+STYLES = {
+    "single family": "SINGLE_FAMILY",
+    "single-family": "SINGLE_FAMILY",
+    "multi family": "MULTI_FAMILY",
+    "multi-family": "MULTI_FAMILY",
+    "condo": "CONDOS",
+    "condos": "CONDOS",
+    "townhouse": "TOWNHOMES",
+    "townhouses": "TOWNHOMES",
+    "townhome": "TOWNHOMES",
+    "townhomes": "TOWNHOMES",
+    "duplex": "DUPLEX_TRIPLEX",
+    "triplex": "DUPLEX_TRIPLEX",
+    "mobile home": "MOBILE",
+    "mobile homes": "MOBILE",
+    "land": "LAND",
+    "farm": "FARM",
+    "apartment": "APARTMENT",
+    "apartments": "APARTMENT",
+}
+PERIODS = {"day": 1, "week": 7, "month": 30, "year": 365}
+MULTIPLIERS = {"k": 1_000, "thousand": 1_000, "m": 1_000_000, "mm": 1_000_000, "million": 1_000_000}
+FILLER_WORDS = set(
+    (
+        "a all an and any are around at find for from get home homes house houses i in is listing listings "
+        "looking me near of on please properties property real estate search show some that the to want with"
+    ).split()
+)
+
+# Grammar
+AMOUNT = r"\$?\s*(\d+(?:,\d{3})*(?:\.\d+)?)\s*(k|m|mm|thousand|million)?\b"
+DATE = r"(\d{4}-\d{2}-\d{2})"
+STATE = r"(" + "|".join(sorted([*STATE_CODES, *(name.title() for name in STATES)], key=len, reverse=True)) + r")"
+PLACE = r"([A-Z][\w.'-]*(?:\s+[A-Z][\w.'-]*)*)"
+STREET_SUFFIX = r"(?:St|Street|Ave|Avenue|Rd|Road|Blvd|Boulevard|Dr|Drive|Ln|Lane|Way|Ct|Court|Pl|Place|Ter|Pkwy|Hwy)"
+
+
+def _amount(number: str, multiplier: str | None) -> float:
+    return float(number.replace(",", "")) * MULTIPLIERS.get((multiplier or "").lower(), 1)
+
+
+def _bounds(low: str | None, high: str | None, name: str, cast=int) -> dict[str, Any]:
+    return {key: cast(value) for key, value in ((f"min_{name}", low), (f"max_{name}", high)) if value is not None}
+
+
+def _state_code(state: str) -> str:
+    return STATES.get(state.lower(), state.upper())
+
+
+RULES = [
+    # (pattern, match -> fields); the first match of each rule is consumed in order
+    (r"\bwithin\s+(\d+(?:\.\d+)?)\s*(?:mi|miles?)\b(?:\s+of)?", lambda m: {"radius": float(m[1])}),
+    (
+        rf"\b(?:between|from)\s+{DATE}\s+(?:and|to|-)\s+{DATE}",
+        lambda m: {"date_from": m[1], "date_to": m[2]},
+    ),
+    (rf"\b(?:since|after)\s+{DATE}", lambda m: {"date_from": m[1]}),
+    (rf"\bbefore\s+{DATE}", lambda m: {"date_to": m[1]}),
+    (
+        r"\b(?:in\s+the\s+)?(?:last|past)\s+(\d+)?\s*(day|week|month|year)s?\b",
+        lambda m: {"past_days": int(m[1] or 1) * PERIODS[m[2].lower()]},
+    ),
+    (
+        r"\b(\d+)\s*(?:-|to)\s*(\d+)\s*(?:bed(?:room)?s?|br|bd)\b",
+        lambda m: _bounds(m[1], m[2], "beds"),
+    ),
+    (
+        r"\b(?:(at\s+least|min(?:imum)?)\s+)?(\d+)\s*(\+)?\s*(?:bed(?:room)?s?|br|bd)\b",
+        lambda m: {"min_beds": int(m[2])} if m[1] or m[3] else _bounds(m[2], m[2], "beds"),
+    ),
+    (
+        r"\b(?:(at\s+least|min(?:imum)?)\s+)?(\d+)\s*(\+)?\s*(?:bath(?:room)?s?|ba)\b",
+        lambda m: {"min_baths": int(m[2])} if m[1] or m[3] else _bounds(m[2], m[2], "baths"),
+    ),
+    (
+        r"\b(under|below|less\s+than|over|above|more\s+than|at\s+least)?\s*(\d+(?:,\d{3})*)\s*\+?\s*"
+        r"(?:sq\.?\s*ft\.?|sqft|square\s+feet)",
+        lambda m: (
+            {"max_sqft": int(m[2].replace(",", ""))}
+            if m[1] and m[1].lower().startswith(("under", "below", "less"))
+            else {"min_sqft": int(m[2].replace(",", ""))}
+        ),
+    ),
+    (r"\bbuilt\s+(?:after|since)\s+(\d{4})\b", lambda m: {"min_year_built": int(m[1])}),
+    (r"\bbuilt\s+before\s+(\d{4})\b", lambda m: {"max_year_built": int(m[1])}),
+    (r"\b(\d+)\s*(?:\+\s*)?(?:stor(?:y|ies)|floors?)\b", lambda m: {"min_stories": int(m[1])}),
+    (r"\b(\d+)\s*-?\s*car\s+garage\b", lambda m: {"parking_garage": int(m[1])}),
+    (
+        rf"\b(?:between|from)\s+{AMOUNT}\s*(?:and|to|-)\s*{AMOUNT}",
+        lambda m: {"min_price": _amount(m[1], m[2]), "max_price": _amount(m[3], m[4])},
+    ),
+    (
+        rf"\b(?:under|below|less\s+than|max(?:imum)?|up\s+to|at\s+most|<)\s*{AMOUNT}",
+        lambda m: {"max_price": _amount(m[1], m[2])},
+    ),
+    (
+        rf"\b(?:over|above|more\s+than|min(?:imum)?|at\s+least|>)\s*{AMOUNT}",
+        lambda m: {"min_price": _amount(m[1], m[2])},
+    ),
+    (
+        r"\b(?:for\s+rent|rentals?|to\s+rent|for\s+lease)\b",
+        lambda m: {"listing_type": "for_rent"},
+    ),
+    (r"\b(?:recently\s+)?sold\b", lambda m: {"listing_type": "sold"}),
+    (r"\b(?:for\s+sale|on\s+the\s+market|to\s+buy)\b", lambda m: {"listing_type": "for_sale"}),
+    (r"\bforeclos(?:ure|ures|ed)\b", lambda m: {"foreclosure": True}),
+    (r"\bmls(?:\s+only|\s+listings?)?\b", lambda m: {"mls_only": True}),
+    (
+        r"\b(" + "|".join(sorted(map(re.escape, STYLES), key=len, reverse=True)) + r")\b",
+        lambda m: {"style": STYLES[m[1].lower()]},
+    ),
+]
+RULES = [(re.compile(pattern, re.IGNORECASE), handler) for pattern, handler in RULES]
+
+LOCATION_RULES = [
+    # Mostly case-sensitive: capitalized places aren't confused with the rest of the query
+    (
+        re.compile(
+            rf"\b\d+\s+(?:[\w.]+\s+)*?{STREET_SUFFIX}\b\.?(?:\s+[NSEW]{{1,2}}\b)?,\s*{PLACE},\s*{STATE}\b(?:\s+\d{{5}})?"
+        ),
+        lambda m: m[0],
+    ),
+    (
+        re.compile(rf"\b{PLACE},?\s+{STATE}\b(?:\s+(\d{{5}}))?"),
+        lambda m: f"{m[1]}, {_state_code(m[2])}" + (f" {m[3]}" if m[3] else ""),
+    ),
+    (
+        re.compile(rf"\b(?:in|near|around)\s+([a-z][\w.'-]*(?:\s+[a-z][\w.'-]*){{0,2}}?),?\s+{STATE}\b", re.IGNORECASE),
+        lambda m: f"{m[1].title()}, {_state_code(m[2])}",
+    ),
+    (re.compile(r"\b\d{5}(?:-\d{4})?\b"), lambda m: m[0]),
+    (re.compile(rf"\b(?:in|near|around)\s+{STATE}\b(?![\w,])"), lambda m: _state_code(m[1])),
+    (re.compile(rf"\b(?:in|near|around)\s+{PLACE}"), lambda m: m[1]),
+]
+TOKEN_PATTERN = re.compile(r"[a-z0-9$+.'-]+")
+
+
+class ParsedQuery(BaseModel):
+    """Search parameters extracted from a query, and the words left unparsed."""
+
+    fields: dict[str, Any]
+    remainder: str
+
+    @property
+    def complete(self) -> bool:
+        return "location" in self.fields and not self.remainder
+
+    def to_request(self) -> SearchRequest | None:
+        return SearchRequest(**self.fields) if "location" in self.fields else None
+
+
+def parse_query(query: str) -> ParsedQuery:
+    """
+    Extract search parameters from the common patterns of a query.
+
+    Rules are applied in order, each consuming the text it matched, so that
+    e.g. "3 bed" isn't read as a price later on.
+
+    Parameters
+    ----------
+    query : str
+        Natural-language query, e.g. "3 bed under 500k in Austin, TX sold in the last 30 days"
+
+    Returns
+    -------
+    ParsedQuery
+        Extracted fields and the words no rule or filler list accounts for
+    """
+    text, fields = f" {query} ", {}
+    for pattern, handler in RULES:
+        match = pattern.search(text)
+        if match:
+            matched = handler(match)
+            if matched.keys() & fields.keys():  # conflicting phrases are left for the LM
+                continue
+            fields.update(matched)
+            text = text[: match.start()] + " " + text[match.end() :]
+    for pattern, handler in LOCATION_RULES:
+        match = pattern.search(text)
+        if match:
+            fields["location"] = handler(match).strip()
+            text = text[: match.start()] + " " + text[match.end() :]
+            break
+
+    words = [word.strip(".'-") for word in TOKEN_PATTERN.findall(text.lower())]
+    return ParsedQuery(fields=fields, remainder=" ".join(word for word in words if word and word not in FILLER_WORDS))
+
+
+# Query parser
+class Input(BaseModel):
+    """Input model."""
+
+    query: str = Field(description="natural-language property search query")
+    parsed: str = Field(description="JSON of the search parameters already extracted from the query")
+    remainder: str = Field(description="words of the query the extracted parameters don't account for")
+    current_date: datetime = Field(default_factory=datetime.utcnow)
+
+
+class Output(BaseModel):
+    """Output model."""
+
+    request: SearchRequest = Field(description="search parameters for the whole query")
+
+
+class ParseQuery(dspy.Signature):
+    """
+    Given a property search query, the parameters already extracted from it
+    and the words left unparsed, return the search parameters for the whole query.
+    Keep the extracted parameters and fill in what the remainder asks for.
+    """
+
+    input: Input = dspy.InputField()
+    output: Output = dspy.OutputField()
+
+
+class QueryParser(dspy.Module):
+    """Query parser that only calls the LM for what the rules can't parse."""
+
+    def __init__(self, model: str = DEFAULT_MODEL, max_retries: int = DEFAULT_MAX_RETRIES):
+        super().__init__()
+
+        self.lm = get_lm(model)
+        self.generate_request = dspy.TypedPredictor(signature=ParseQuery, max_retries=max_retries)
+
+    def forward(self, query):
+        parsed = parse_query(query)
+        if parsed.complete:
+            return dspy.Prediction(request=parsed.to_request(), fast_path=True)
+
+        with dspy.context(lm=self.lm), LM_METRICS.track("ParseQuery"):
+            request = self.generate_request(
+                input=Input(query=query, parsed=json.dumps(parsed.fields), remainder=parsed.remainder)
+            ).output.request
+        return dspy.Prediction(request=request.model_copy(update=parsed.fields), fast_path=False)
@@ -0,0 +1,288 @@
+"""Dependencies for limiting the rate of requests per client."""
+
+import hashlib
+import math
+import random
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from app.config import get_settings
+from app.dependencies.cache import CACHE_PATH, PURGE_RATE, _connect
+from app.dependencies.security import API_KEY
+
+SETTINGS = get_settings()
+RATE_LIMIT_ENABLED = SETTINGS.rate_limit_enabled
+RATE_LIMIT_SHARED = SETTINGS.rate_limit_shared
+RATE_LIMIT_WINDOW = SETTINGS.rate_limit_window
+RATE_LIMITS = {
+    "ip": SETTINGS.rate_limit_per_ip,
+    "email": SETTINGS.rate_limit_per_email,
+    "api_key": SETTINGS.rate_limit_per_api_key,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ratelimits (
+    key TEXT PRIMARY KEY,
+    start REAL NOT NULL,
+    count INTEGER NOT NULL,
+    previous INTEGER NOT NULL
+);
+"""
+
+
+def slide(
+    state: tuple[float, int, int] | None, limit: int, window: float, now: float
+) -> tuple[tuple[float, int, int], float]:
+    """
+    Move a sliding window counter to `now` and check whether one more request fits.
+
+    The window's count is estimated from the current fixed window's count
+    plus the previous one's, weighted by how much of it still overlaps the
+    sliding window.
+
+    Parameters
+    ----------
+    state : tuple[float, int, int] | None
+        Start of the current fixed window, its count and the previous window's count
+    limit : int
+        Requests allowed per window
+    window : float
+        Seconds
+    now : float
+        Current time
+
+    Returns
+    -------
+    tuple[tuple[float, int, int], float]
+        State at `now`, without the request, and seconds until it fits, 0 if it does now
+    """
+    start = now - now % window
+    if state is None or state[0] < start - window:
+        state = (start, 0, 0)
+    elif state[0] < start:
+        state = (start, 0, state[1])
+    _, count, previous = state
+    elapsed = now - start
+    if previous * (1 - elapsed / window) + count + 1 <= limit:
+        return state, 0.0
+    if count + 1 <= limit:  # fits once enough of the previous window slides out
+        return state, window * (1 - (limit - 1 - count) / previous) - elapsed
+    return state, window - elapsed + window * max(0.0, 1 - (limit - 1) / count)  # fits in the next window
+
+
+class LocalRateStore:
+    """Sliding window counters of one worker."""
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def hit(self, limits: dict[str, int], window: float, now: float) -> float:
+        """
+        Count a request against every key, if it fits in all of their limits.
+
+        Parameters
+        ----------
+        limits : dict[str, int]
+            Limit of each key
+        window : float
+            Seconds
+        now : float
+            Current time
+
+        Returns
+        -------
+        float
+            0 if the request was counted, else seconds until it fits
+        """
+        with self.lock:
+            checked = {key: slide(self.states.get(key), limit, window, now) for key, limit in limits.items()}
+            retry_after = max((wait for _, wait in checked.values()), default=0.0)
+            if not retry_after:
+                for key, ((start, count, previous), _) in checked.items():
+                    self.states[key] = (start, count + 1, previous)
+            if random.random() < PURGE_RATE:
+                stale = [key for key, state in self.states.items() if state[0] < now - 2 * window]
+                for key in stale:
+                    del self.states[key]
+        return retry_after
+
+
+class SharedRateStore:
+    """
+    Sliding window counters in a SQLite file, so limits hold across the workers of a host.
+
+    Each hit reads and updates its keys in one immediate transaction, so
+    concurrent hits from any worker are counted one at a time.
+    """
+
+    def __init__(self, path: str = CACHE_PATH):
+        self.path = path
+        self.local = threading.local()
+        self._get_conn().executescript(SCHEMA)
+
+    def _get_conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = _connect(self.path)
+        return conn
+
+    def hit(self, limits: dict[str, int], window: float, now: float) -> float:
+        """
+        Count a request against every key, if it fits in all of their limits.
+
+        Parameters
+        ----------
+        limits : dict[str, int]
+            Limit of each key
+        window : float
+            Seconds
+        now : float
+            Current time
+
+        Returns
+        -------
+        float
+            0 if the request was counted, else seconds until it fits
+        """
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            checked = {}
+            for key, limit in limits.items():
+                row = conn.execute("SELECT start, count, previous FROM ratelimits WHERE key = ?", (key,)).fetchone()
+                checked[key] = slide(row, limit, window, now)
+            retry_after = max((wait for _, wait in checked.values()), default=0.0)
+            if not retry_after:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO ratelimits VALUES (?, ?, ?, ?)",
+                    [(key, start, count + 1, previous) for key, ((start, count, previous), _) in checked.items()],
+                )
+            if random.random() < PURGE_RATE:
+                conn.execute("DELETE FROM ratelimits WHERE start < ?", (now - 2 * window,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return retry_after
+
+
+def get_client_ip(request: Request) -> str | None:
+    """
+    Get the IP of the client a request is made for.
+
+    The frontend calls the API from its server, for every browser, so it
+    forwards the browser's IP in `X-Forwarded-For`. The header is only
+    trusted on requests with the API key, which only the frontend holds.
+
+    Parameters
+    ----------
+    request : Request
+        Request
+
+    Returns
+    -------
+    str | None
+        Forwarded IP, else the IP of the connection, None if unknown
+    """
+    forwarded = request.headers.get("X-Forwarded-For")
+    if forwarded and API_KEY and request.headers.get("X-API-Key") == API_KEY:
+        return forwarded.split(",")[-1].strip() or None  # the address the frontend added
+    return request.client.host if request.client else None
+
+
+class RateLimiter:
+    """
+    Sliding window limits on requests per IP, email and API key, for each scope (e.g. a route).
+
+    A request is counted against all of its keys or, when any of them is
+    over its limit, against none of them, so rejected requests don't extend
+    the wait. Keys are hashed, so no emails or API keys are stored.
+    """
+
+    def __init__(
+        self,
+        store: LocalRateStore | SharedRateStore | None = None,
+        limits: dict[str, int] = RATE_LIMITS,
+        window: float = RATE_LIMIT_WINDOW,
+        enabled: bool = RATE_LIMIT_ENABLED,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.store = store or LocalRateStore()
+        self.limits = limits
+        self.window = window
+        self.enabled = enabled
+        self.clock = clock
+        self.counts = {}  # scope -> counts of allowed and limited requests
+
+    def hit(self, scope: str, **keys: str | None) -> float:
+        """
+        Count a request of a scope.
+
+        Parameters
+        ----------
+        scope : str
+            Scope, limited separately from the others
+        **keys : str | None
+            Value of each kind of key in `limits`, e.g. `ip`, skipped if None
+
+        Returns
+        -------
+        float
+            0 if the request is allowed, else seconds until it would be
+        """
+        if not self.enabled:
+            return 0.0
+        limits = {
+            hashlib.sha256(f"{scope}:{kind}:{value.lower()}".encode()).hexdigest()[:32]: self.limits[kind]
+            for kind, value in keys.items()
+            if value and self.limits.get(kind)  # a limit of 0 is no limit
+        }
+        retry_after = self.store.hit(limits, self.window, self.clock()) if limits else 0.0
+        counts = self.counts.setdefault(scope, {"allowed": 0, "limited": 0})
+        counts["limited" if retry_after else "allowed"] += 1
+        return retry_after
+
+    async def check(self, scope: str, request: Request, email: str | None = None) -> None:
+        """
+        Count a request of a scope by its client IP, API key and email.
+
+        Shared counts are updated in a thread, so waiting for the lock of
+        the cache file doesn't block the event loop.
+
+        Parameters
+        ----------
+        scope : str
+            Scope, e.g. the route
+        request : Request
+            Request
+        email : str | None, optional
+            Email the request is about, by default None
+
+        Raises
+        ------
+        HTTPException
+            429 with a `Retry-After` header, if the request is over a limit
+        """
+        keys = {"ip": get_client_ip(request), "email": email, "api_key": request.headers.get("X-API-Key")}
+        if isinstance(self.store, SharedRateStore):
+            retry_after = await run_in_threadpool(self.hit, scope, **keys)
+        else:
+            retry_after = self.hit(scope, **keys)
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests, try again later",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+    def metrics(self) -> dict:
+        return {"enabled": self.enabled, "window": self.window, "limits": self.limits, "scopes": self.counts}
+
+
+RATE_LIMITER = RateLimiter(SharedRateStore() if RATE_LIMIT_SHARED else LocalRateStore())
@@ -0,0 +1,138 @@
+"""Dependencies for searching users."""
+
+from datetime import datetime
+
+from sqlalchemy import ColumnElement, and_, func, or_
+from sqlmodel import select
+from sqlmodel.sql.expression import SelectOfScalar
+
+from app.database import DBSession
+from app.models.users import User
+
+SEARCH_COLUMNS = ("email", "first_name", "last_name")
+MAX_SEARCH_LIMIT = 500
+
+
+def escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def match_column(column: ColumnElement, query: str, match: str, dialect: str) -> ColumnElement[bool]:
+    """
+    Match the lowercased column against a lowercased query, in a form its expression index can serve.
+
+    Prefixes are a `LIKE 'query%'` on Postgres, served by the
+    `varchar_pattern_ops` index, and a range on SQLite, whose `LIKE`
+    can't use an expression index. Substrings are a `LIKE '%query%'`,
+    served by the trigram index on Postgres and a scan on SQLite.
+
+    Parameters
+    ----------
+    column : ColumnElement
+        Column with a `lower()` index
+    query : str
+        Lowercased query
+    match : str
+        "prefix" or "contains"
+    dialect : str
+        Database dialect, e.g. "postgresql"
+
+    Returns
+    -------
+    ColumnElement[bool]
+        Condition
+    """
+    lowered = func.lower(column)
+    if match == "contains":
+        return lowered.like(f"%{escape_like(query)}%", escape="\\")
+    if dialect == "sqlite":  # binary collation, so the prefixes sort between these bounds
+        return and_(lowered >= query, lowered < query[:-1] + chr(ord(query[-1]) + 1))
+    return lowered.like(f"{escape_like(query)}%", escape="\\")
+
+
+def build_user_search(
+    query: str | None = None,
+    match: str = "prefix",
+    provider: str | None = None,
+    disabled: bool | None = None,
+    joined_after: datetime | None = None,
+    joined_before: datetime | None = None,
+    after: int | None = None,
+    limit: int = 50,
+    dialect: str = "sqlite",
+) -> SelectOfScalar[User]:
+    """
+    Build a page of a user search, in join order.
+
+    Pages are keyset paginated on the user id: the next page starts after
+    the last id of this one, instead of skipping an `OFFSET` of rows, so a
+    page deep into the results costs as much as the first one.
+
+    Parameters
+    ----------
+    query : str | None, optional
+        Text matched against emails, first and last names, case-insensitively, by default None
+    match : str, optional
+        "prefix" to match the start of the fields, or "contains" anywhere, by default "prefix"
+    provider : str | None, optional
+        Provider, e.g. "google", by default None
+    disabled : bool | None, optional
+        Disabled users only, or enabled users only, by default None
+    joined_after : datetime | None, optional
+        Earliest join date, inclusive, by default None
+    joined_before : datetime | None, optional
+        Latest join date, exclusive, by default None
+    after : int | None, optional
+        Last id of the previous page, by default None
+    limit : int, optional
+        Page size, by default 50
+    dialect : str, optional
+        Database dialect, by default "sqlite"
+
+    Returns
+    -------
+    SelectOfScalar[User]
+        Statement, with one row more than `limit` to tell whether there is a next page
+    """
+    statement = select(User)
+    if query:
+        query = query.lower()
+        statement = statement.where(
+            or_(*(match_column(User.__table__.c[column], query, match, dialect) for column in SEARCH_COLUMNS))
+        )
+    if provider is not None:
+        statement = statement.where(User.provider == provider)
+    if disabled is not None:
+        statement = statement.where(User.disabled == disabled)
+    if joined_after is not None:
+        statement = statement.where(User.join_date >= joined_after)
+    if joined_before is not None:
+        statement = statement.where(User.join_date < joined_before)
+    if after is not None:
+        statement = statement.where(User.id > after)
+    return statement.order_by(User.id).limit(limit + 1)
+
+
+async def search_users(session: DBSession, limit: int = 50, **filters) -> tuple[list[User], int | None]:
+    """
+    Search a page of users.
+
+    Parameters
+    ----------
+    session : DBSession
+        Database session
+    limit : int, optional
+        Page size, by default 50
+    **filters
+        Arguments of `build_user_search`
+
+    Returns
+    -------
+    tuple[list[User], int | None]
+        Users, and the cursor of the next page, or None on the last page
+    """
+    dialect = session.bind.dialect.name
+    users = list((await session.exec(build_user_search(limit=limit, dialect=dialect, **filters))).all())
+    if len(users) > limit:
+        return users[:limit], users[limit - 1].id
+    return users, None
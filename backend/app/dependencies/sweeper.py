@@ -0,0 +1,154 @@
+"""Dependencies for sweeping stale rows in the background."""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, update
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+
+from app.config import get_settings
+from app.database import engine
+from app.models.emails import OutboxEmail
+from app.models.users import AuthCode, RefreshSession
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = get_settings()
+AUTH_CODE_SWEEP_INTERVAL = SETTINGS.auth_code_sweep_interval
+AUTH_CODE_SWEEP_BATCH_SIZE = SETTINGS.auth_code_sweep_batch_size
+AUTH_CODE_RETENTION = timedelta(days=SETTINGS.auth_code_retention_days)
+
+
+class AuthCodeSweeper:
+    """
+    Background thread that expires pending auth codes past their expiry, and purges old codes, sessions and emails.
+
+    Rows are updated and deleted in batches of `batch_size`, one transaction
+    each, so a sweep over millions of rows never holds long locks. Sweeps
+    are idempotent, so every worker can run one.
+    """
+
+    def __init__(
+        self,
+        engine: Engine = engine,
+        interval: float = AUTH_CODE_SWEEP_INTERVAL,
+        batch_size: int = AUTH_CODE_SWEEP_BATCH_SIZE,
+        retention: timedelta = AUTH_CODE_RETENTION,
+    ):
+        self.engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.stopping = threading.Event()
+        self.thread = None
+        self.counts = {"expired": 0, "purged": 0, "sessions_purged": 0, "emails_purged": 0, "sweeps": 0}
+
+    def expire(self, session: Session, now: datetime) -> int:
+        """Mark a batch of pending codes past their expiry as expired."""
+        batch = (
+            select(AuthCode.id)
+            .where(AuthCode.status == "pending")
+            .where(AuthCode.expire_date < now)
+            .limit(self.batch_size)
+        )
+        result = session.exec(
+            update(AuthCode)
+            .where(AuthCode.id.in_(batch))
+            .values(status="expired")
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+
+    def purge(self, session: Session, now: datetime) -> int:
+        """Delete a batch of codes that expired more than `retention` ago."""
+        batch = select(AuthCode.id).where(AuthCode.expire_date < now - self.retention).limit(self.batch_size)
+        result = session.exec(
+            delete(AuthCode).where(AuthCode.id.in_(batch)).execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+
+    def purge_sessions(self, session: Session, now: datetime) -> int:
+        """Delete a batch of refresh sessions that expired more than `retention` ago, revoked or not."""
+        batch = (
+            select(RefreshSession.id).where(RefreshSession.expire_date < now - self.retention).limit(self.batch_size)
+        )
+        result = session.exec(
+            delete(RefreshSession).where(RefreshSession.id.in_(batch)).execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+
+    def purge_emails(self, session: Session, now: datetime) -> int:
+        """Delete a batch of outbox emails sent or failed more than `retention` ago."""
+        batch = (
+            select(OutboxEmail.id)
+            .where(OutboxEmail.status.in_(["sent", "failed"]))
+            .where(OutboxEmail.request_date < now - self.retention)
+            .limit(self.batch_size)
+        )
+        result = session.exec(
+            delete(OutboxEmail).where(OutboxEmail.id.in_(batch)).execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount
+
+    def run_once(self) -> dict[str, int]:
+        """
+        Sweep until no batch is left.
+
+        Returns
+        -------
+        dict[str, int]
+            Number of codes expired and purged, and of refresh sessions and emails purged
+        """
+        now = datetime.utcnow()
+        swept = {"expired": 0, "purged": 0, "sessions_purged": 0, "emails_purged": 0}
+        steps = [
+            ("expired", self.expire),
+            ("purged", self.purge),
+            ("sessions_purged", self.purge_sessions),
+            ("emails_purged", self.purge_emails),
+        ]
+        with Session(self.engine) as session:
+            for name, step in steps:
+                while not self.stopping.is_set():
+                    count = step(session, now)
+                    swept[name] += count
+                    if count < self.batch_size:
+                        break
+        for name, count in swept.items():
+            self.counts[name] += count
+        self.counts["sweeps"] += 1
+        return swept
+
+    def _run(self) -> None:
+        while not self.stopping.is_set():
+            start = time.perf_counter()
+            try:
+                swept = self.run_once()
+                if any(swept.values()):
+                    logger.info(f"Swept auth codes in {time.perf_counter() - start:.1f}s: {swept}")
+            except Exception:
+                logger.exception("Auth code sweep failed")
+            self.stopping.wait(self.interval)
+
+    def start(self) -> "AuthCodeSweeper":
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="auth-code-sweeper", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+
+AUTH_CODE_SWEEPER = AuthCodeSweeper()
@@ -1,43 +1,50 @@
 """Dependencies for user endpoints."""
 
-import smtplib
+import hashlib
 from datetime import datetime, timedelta
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.utils import formataddr
 from typing import Annotated
+from uuid import UUID, uuid4
 
-import requests
-from fastapi import Cookie, Depends, HTTPException, Response
+from fastapi import Cookie, Depends, HTTPException, Request, Response
 from fastapi.responses import RedirectResponse
 from jose import JWTError, jwt
-from markdown import markdown
-from passlib.context import CryptContext
+from sqlalchemy import event, inspect, update
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.util.concurrency import await_only, in_greenlet
 from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
 
 from app.config import get_settings
-from app.database import get_session
-from app.models.users import AuthCode, User
+from app.database import DBSession, get_db_session
+from app.dependencies.cache import LocalCache, SharedCache
+from app.dependencies.http import HTTPClient, UpstreamUnavailableError
+from app.dependencies.passwords import PASSWORD_HASHER
+from app.models.users import MAX_USER_AGENT_LENGTH, AuthCode, RefreshSession, User
 
 SETTINGS = get_settings()
 
-SMTP_SSL_HOST = SETTINGS.smtp_ssl_host
-SMTP_SSL_PORT = SETTINGS.smtp_ssl_port
-SMTP_SSL_SENDER = SETTINGS.smtp_ssl_sender
-SMTP_SSL_LOGIN = SETTINGS.smtp_ssl_login
-SMTP_SSL_PASSWORD = SETTINGS.smtp_ssl_password
-
 JWT_SECRET = SETTINGS.jwt_secret
 ACCESS_TOKEN_EXPIRES = timedelta(minutes=SETTINGS.access_token_expire_minutes)
 REFRESH_TOKEN_EXPIRES = timedelta(minutes=SETTINGS.refresh_token_expire_minutes)
 VERIFY_CODE_EXPIRES = timedelta(minutes=SETTINGS.verify_code_expire_minutes)
 RECOVERY_CODE_EXPIRES = timedelta(minutes=SETTINGS.recovery_code_expire_minutes)
 JWT_ALGORITHM = "HS256"
-PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 GOOGLE_CLIENT_ID = SETTINGS.google_client_id
 GOOGLE_CLIENT_SECRET = SETTINGS.google_client_secret
 GOOGLE_REDIRECT_URI = SETTINGS.google_redirect_uri
+GOOGLE_AUTH_URL = SETTINGS.google_auth_url
+GOOGLE_TOKEN_URL = SETTINGS.google_token_url
+GOOGLE_USERINFO_URL = SETTINGS.google_userinfo_url
+GOOGLE_TOKEN_CACHE_TTL = SETTINGS.google_token_cache_ttl
+GOOGLE_TOKEN_NEGATIVE_CACHE_TTL = SETTINGS.google_token_negative_cache_ttl
+GOOGLE_TOKEN_CACHE = SharedCache("google_token_email")
+GOOGLE_CLIENT = HTTPClient("google")
+
+USER_CACHE = LocalCache(
+    "user", SETTINGS.user_cache_ttl, SETTINGS.user_cache_size, sync_interval=SETTINGS.user_cache_sync_interval
+)
+USER_CACHE_EXCLUDE = {"hashed_password"}  # secrets stay out of the cache, and load from the database if read
 
 FRONTEND_URL = SETTINGS.frontend_url
 DOMAIN = FRONTEND_URL.split("//")[1].split(":")[0]  # : is for port in case of localhost
@@ -49,11 +56,15 @@ CREDENTIALS_EXCEPTION = HTTPException(
     status_code=401,
     detail="Could not validate credentials",
 )
+PROVIDER_UNAVAILABLE_EXCEPTION = HTTPException(
+    status_code=503,
+    detail="Sign-in provider is unavailable, try again later",
+)
 
 
-def get_user(
+async def get_user(
     email: str,
-    session: Session,
+    session: DBSession,
     disabled: bool = None,
     provider: str = None,
 ) -> User | None:
@@ -83,37 +94,104 @@ def get_user(
         statement = statement.where(User.provider == provider)
 
     if email:
-        return session.exec(statement.where(User.email == email)).first()
+        return (await session.exec(statement.where(User.email == email))).first()
     else:
         return None
 
 
-def send_email(email: str, subject: str, body: str) -> None:
+def get_user_cache_key(email: str, provider: str) -> str:
+    """
+    Get the key of a user in the user cache.
+
+    Parameters
+    ----------
+    email : str
+        Email
+    provider : str
+        Provider
+
+    Returns
+    -------
+    str
+        Key
+    """
+    return f"{provider}:{email}"
+
+
+async def get_cached_user(email: str, session: DBSession, provider: str) -> User | None:
     """
-    Send email.
+    Get an enabled user, from this worker's user cache if possible.
+
+    A cached user is attached to the session without a query, so it can be
+    updated like one read from the database. Its `USER_CACHE_EXCLUDE` fields
+    aren't cached, and load on first access.
 
     Parameters
     ----------
     email : str
         Email
-    subject : str
-        Subject
-    body : str
-        Body
-    """
-    with smtplib.SMTP(SMTP_SSL_HOST, SMTP_SSL_PORT) as s:
-        s.ehlo()
-        s.starttls()
-        s.ehlo()
-        s.login(SMTP_SSL_LOGIN, SMTP_SSL_PASSWORD)
-
-        msg = MIMEMultipart("alternative")
-        msg["From"] = formataddr((SMTP_SSL_SENDER, SMTP_SSL_LOGIN))
-        msg["To"] = email
-        msg["Subject"] = subject
-        msg.attach(MIMEText(body, "plain"))
-        msg.attach(MIMEText(markdown(body), "html"))
-        s.send_message(msg)
+    session : Session
+        Session
+    provider : str
+        Provider
+
+    Returns
+    -------
+    User | None
+        User if exists and is enabled, else None
+    """
+    key = get_user_cache_key(email, provider)
+    if USER_CACHE.needs_sync():
+        await run_in_threadpool(USER_CACHE.sync)
+    data = USER_CACHE.get(key, sync=False)
+    if data is None:
+        seq = await run_in_threadpool(USER_CACHE.sync)
+        db_user = await get_user(email, session, disabled=False, provider=provider)
+        if db_user is not None:
+            await run_in_threadpool(USER_CACHE.set, key, db_user.model_dump(exclude=USER_CACHE_EXCLUDE), seq)
+        return db_user
+
+    user = User(**data)
+    for field in USER_CACHE_EXCLUDE:
+        del user.__dict__[field]  # unloaded, so expired by make_transient_to_detached
+    make_transient_to_detached(user)
+    return await session.merge(user, load=False)
+
+
+def _invalidate_cached_user(key: str) -> None:
+    """Invalidate a cached user from a session event, in a thread when an `AsyncSession` runs it on the event loop."""
+    if in_greenlet():
+        await_only(run_in_threadpool(USER_CACHE.invalidate, key))
+    else:
+        USER_CACHE.invalidate(key)  # already in a thread, e.g. a `ThreadedSession` commit
+
+
+@event.listens_for(Session, "before_flush")
+def _invalidate_flushed_users(session: Session, flush_context, instances) -> None:
+    """Invalidate the cached users a flush updates or deletes, under their old and new keys."""
+    keys = set()
+    for user in (*session.dirty, *session.deleted):
+        if not isinstance(user, User):
+            continue
+        state = inspect(user)
+        emails = {user.email, *state.attrs.email.history.deleted}
+        providers = {user.provider, *state.attrs.provider.history.deleted}
+        keys.update(get_user_cache_key(email, provider) for email in emails for provider in providers)
+    for key in keys:
+        _invalidate_cached_user(key)
+    session.info.setdefault("user_cache_keys", set()).update(keys)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_user_cache(session: Session) -> None:
+    """Invalidate again on commit, in case a worker cached the old row while the transaction was open."""
+    for key in session.info.pop("user_cache_keys", ()):
+        _invalidate_cached_user(key)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_user_cache_keys(session: Session, previous_transaction) -> None:
+    session.info.pop("user_cache_keys", None)
 
 
 def get_google_auth_url(state: str) -> str:
@@ -130,10 +208,10 @@ def get_google_auth_url(state: str) -> str:
     str
         Google auth URL
     """
-    return f"https://accounts.google.com/o/oauth2/v2/auth?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email&access_type=offline&state={state}"
+    return f"{GOOGLE_AUTH_URL}?response_type=code&client_id={GOOGLE_CLIENT_ID}&redirect_uri={GOOGLE_REDIRECT_URI}&scope=openid%20profile%20email&access_type=offline&state={state}"
 
 
-def get_auth_code(session: Session, email: str, request_type: str, status: str = "pending") -> AuthCode | None:
+async def get_auth_code(session: DBSession, email: str, request_type: str, status: str = "pending") -> AuthCode | None:
     """
     Get auth code.
 
@@ -150,18 +228,21 @@ def get_auth_code(session: Session, email: str, request_type: str, status: str =
 
     Returns
     -------
-    AuthCode
-        Auth code
+    AuthCode | None
+        Latest auth code, if any
     """
-    return session.exec(
+    result = await session.exec(
         select(AuthCode)
         .where(AuthCode.email == email)
         .where(AuthCode.request_type == request_type)
         .where(AuthCode.status == status)
-    ).all()[-1]
+        .order_by(AuthCode.request_date.desc())
+        .limit(1)
+    )
+    return result.first()
 
 
-def verify_code(session: Session, code: str, email: str, request_type: str) -> bool:
+async def verify_code(session: DBSession, code: str, email: str, request_type: str) -> bool:
     """
     Check if code is valid.
 
@@ -185,7 +266,7 @@ def verify_code(session: Session, code: str, email: str, request_type: str) -> b
             detail="Code is empty",
         )
 
-    db_verify_code = get_auth_code(session, email, request_type)
+    db_verify_code = await get_auth_code(session, email, request_type)
     now = datetime.utcnow()
 
     if not db_verify_code or not db_verify_code.code:
@@ -202,7 +283,7 @@ def verify_code(session: Session, code: str, email: str, request_type: str) -> b
         if db_verify_code.status != "expired":
             db_verify_code.status = "expired"
             session.add(db_verify_code)
-            session.commit()
+            await session.commit()
         raise HTTPException(
             status_code=400,
             detail="Code is expired, request new code",
@@ -211,7 +292,7 @@ def verify_code(session: Session, code: str, email: str, request_type: str) -> b
     db_verify_code.status = "verified"
     db_verify_code.usage_date = now
     session.add(db_verify_code)
-    session.commit()
+    await session.commit()
     return True
 
 
@@ -238,21 +319,193 @@ def create_token(data: dict, expires_delta: timedelta) -> str:
     return encoded_jwt
 
 
-def get_password_hash(password: str) -> str:
+def create_refresh_token(
+    session: DBSession, user: User, provider: str, request: Request, provider_refresh_token: str | None = None
+) -> str:
     """
-    Get password hash.
+    Sign a device in with a new refresh session, saved when the session commits.
 
     Parameters
     ----------
-    password : str
-        Password
+    session : Session
+        Session
+    user : User
+        User
+    provider : str
+        Provider
+    request : Request
+        Request of the device, for its user agent and IP address
+    provider_refresh_token : str | None
+        Refresh token of the provider, carried in the token, if any
 
     Returns
     -------
     str
-        Hashed password
+        Refresh token, with the id of the refresh session
+    """
+    jti = uuid4().hex
+    session.add(
+        RefreshSession(
+            jti=jti,
+            user_uuid=user.uuid,
+            provider=provider,
+            user_agent=(request.headers.get("user-agent") or "")[:MAX_USER_AGENT_LENGTH] or None,
+            ip_address=request.client.host if request.client else None,
+            expire_date=datetime.utcnow() + REFRESH_TOKEN_EXPIRES,
+        )
+    )
+    return encode_refresh_token(jti, provider_refresh_token)
+
+
+def encode_refresh_token(jti: str, provider_refresh_token: str | None = None) -> str:
+    data = {"jti": jti}
+    if provider_refresh_token:
+        data["refresh_token"] = provider_refresh_token
+    return create_token(data, REFRESH_TOKEN_EXPIRES)
+
+
+def decode_refresh_token(refresh_token: str) -> dict:
     """
-    return PWD_CONTEXT.hash(password)
+    Decode a refresh token.
+
+    Parameters
+    ----------
+    refresh_token : str
+        Refresh token
+
+    Raises
+    ------
+    HTTPException
+        401 if the token is invalid, expired or has no refresh session
+
+    Returns
+    -------
+    dict
+        Payload, with the id of the refresh session as `jti`
+    """
+    try:
+        payload = jwt.decode(refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        raise CREDENTIALS_EXCEPTION from None
+    if not payload.get("jti"):
+        raise CREDENTIALS_EXCEPTION
+    return payload
+
+
+async def rotate_refresh_token(
+    session: DBSession, refresh_token: str, provider: str, request: Request
+) -> tuple[User, str]:
+    """
+    Swap a refresh token for a new one of the same refresh session, which the old one no longer matches.
+
+    The refresh session is found and updated by its token id in one
+    statement, so of two concurrent refreshes with the same token only one
+    succeeds. Commit the session for the new token to be valid.
+
+    Parameters
+    ----------
+    session : Session
+        Session
+    refresh_token : str
+        Refresh token
+    provider : str
+        Provider
+    request : Request
+        Request of the device
+
+    Raises
+    ------
+    HTTPException
+        401 if the token is invalid, rotated, revoked or expired, or its user is disabled
+
+    Returns
+    -------
+    tuple[User, str]
+        User and new refresh token
+    """
+    payload = decode_refresh_token(refresh_token)
+    jti, now = uuid4().hex, datetime.utcnow()
+    user_uuid = (
+        await session.exec(
+            update(RefreshSession)
+            .where(RefreshSession.jti == payload["jti"])
+            .where(RefreshSession.provider == provider)
+            .where(RefreshSession.revoked_date.is_(None))
+            .where(RefreshSession.expire_date > now)
+            .values(
+                jti=jti,
+                last_used_date=now,
+                expire_date=now + REFRESH_TOKEN_EXPIRES,
+                ip_address=request.client.host if request.client else None,
+            )
+            .returning(RefreshSession.user_uuid)
+            .execution_options(synchronize_session=False)
+        )
+    ).scalar()
+    if user_uuid is None:
+        raise CREDENTIALS_EXCEPTION
+    user = (await session.exec(select(User).where(User.uuid == user_uuid).where(User.disabled.is_(False)))).first()
+    if user is None:
+        raise CREDENTIALS_EXCEPTION
+    return user, encode_refresh_token(jti, payload.get("refresh_token"))
+
+
+async def revoke_refresh_token(session: DBSession, refresh_token: str) -> bool:
+    """
+    Sign a device out by revoking its refresh session.
+
+    Parameters
+    ----------
+    session : Session
+        Session
+    refresh_token : str
+        Refresh token
+
+    Returns
+    -------
+    bool
+        True if a refresh session was revoked, False if the token was invalid or already revoked
+    """
+    try:
+        jti = decode_refresh_token(refresh_token)["jti"]
+    except HTTPException:
+        return False
+    result = await session.exec(
+        update(RefreshSession)
+        .where(RefreshSession.jti == jti)
+        .where(RefreshSession.revoked_date.is_(None))
+        .values(revoked_date=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount == 1
+
+
+async def revoke_user_refresh_tokens(session: DBSession, user_uuid: UUID) -> int:
+    """
+    Sign a user out of every device.
+
+    Parameters
+    ----------
+    session : Session
+        Session
+    user_uuid : UUID
+        UUID of the user
+
+    Returns
+    -------
+    int
+        Number of refresh sessions revoked
+    """
+    result = await session.exec(
+        update(RefreshSession)
+        .where(RefreshSession.user_uuid == user_uuid)
+        .where(RefreshSession.revoked_date.is_(None))
+        .values(revoked_date=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount
 
 
 def set_auth_cookies(
@@ -286,7 +539,7 @@ def set_auth_cookies(
         response.set_cookie(
             key="access_token",
             value=access_token,
-            max_age=ACCESS_TOKEN_EXPIRES.total_seconds(),
+            max_age=int(ACCESS_TOKEN_EXPIRES.total_seconds()),
             secure=True,
             httponly=True,
             samesite="none",
@@ -295,7 +548,7 @@ def set_auth_cookies(
         response.set_cookie(
             key="refresh_token",
             value=refresh_token,
-            max_age=REFRESH_TOKEN_EXPIRES.total_seconds(),
+            max_age=int(REFRESH_TOKEN_EXPIRES.total_seconds()),
             secure=True,
             httponly=True,
             samesite="none",
@@ -304,32 +557,14 @@ def set_auth_cookies(
         response.set_cookie(
             key="provider",
             value=provider,
-            max_age=REFRESH_TOKEN_EXPIRES.total_seconds(),
+            max_age=int(REFRESH_TOKEN_EXPIRES.total_seconds()),
             secure=True,
             httponly=True,
             samesite="none",
         )
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify password.
-
-    Parameters
-    ----------
-    plain_password: str
-        Plain text password
-    hashed_password: str
-        Hashed password
-
-    Returns
-    -------
-    bool
-        True if password is verified, else False
-    """
-    return PWD_CONTEXT.verify(plain_password, hashed_password)
-
-
-def google_get_tokens(data: dict) -> dict[str, str]:
+async def google_get_tokens(data: dict) -> dict[str, str]:
     """
     Get tokens from Google.
 
@@ -338,24 +573,29 @@ def google_get_tokens(data: dict) -> dict[str, str]:
     data : dict
         Data
 
+    Raises
+    ------
+    HTTPException
+        401 if credentials are invalid, 503 if Google is unavailable
+
     Returns
     -------
     dict[str, str]
         Tokens
     """
-    response = requests.post(
-        "https://www.googleapis.com/oauth2/v4/token",
-        data=data,
-    )
+    try:
+        response = await GOOGLE_CLIENT.post(GOOGLE_TOKEN_URL, data=data)
+    except UpstreamUnavailableError:
+        raise PROVIDER_UNAVAILABLE_EXCEPTION from None
     result = response.json()
     access_token = result.get("access_token")
     refresh_token = result.get("refresh_token")
     if not access_token:
         raise CREDENTIALS_EXCEPTION
-    return {"access_token": access_token, "refresh_token": refresh_token}
+    return {"access_token": access_token, "refresh_token": refresh_token, "expires_in": result.get("expires_in")}
 
 
-def google_get_tokens_from_code(code: str) -> dict[str, str]:
+async def google_get_tokens_from_code(code: str) -> dict[str, str]:
     """
     Get tokens from Google code.
 
@@ -369,7 +609,7 @@ def google_get_tokens_from_code(code: str) -> dict[str, str]:
     dict[str, str]
         Tokens
     """
-    return google_get_tokens(
+    return await google_get_tokens(
         {
             "code": code,
             "client_id": GOOGLE_CLIENT_ID,
@@ -380,24 +620,7 @@ def google_get_tokens_from_code(code: str) -> dict[str, str]:
     )
 
 
-def google_encode_refresh_token(refresh_token: str) -> str:
-    """
-    Encode refresh token.
-
-    Parameters
-    ----------
-    refresh_token : str
-        Refresh token
-
-    Returns
-    -------
-    str
-        Encoded refresh token
-    """
-    return jwt.encode({"refresh_token": refresh_token}, JWT_SECRET, algorithm=JWT_ALGORITHM)
-
-
-def google_get_user_info_from_access_token(access_token: str) -> dict[str, str]:
+async def google_get_user_info_from_access_token(access_token: str) -> dict[str, str]:
     """
     Get user info from Google access token.
 
@@ -408,8 +631,8 @@ def google_get_user_info_from_access_token(access_token: str) -> dict[str, str]:
 
     Raises
     ------
-    credentials_exception
-        If credentials are invalid
+    HTTPException
+        401 if credentials are invalid, 503 if Google is unavailable
 
     Returns
     -------
@@ -417,16 +640,16 @@ def google_get_user_info_from_access_token(access_token: str) -> dict[str, str]:
         User info
     """
     try:
-        response = requests.get(
-            "https://www.googleapis.com/oauth2/v1/userinfo", headers={"Authorization": f"Bearer {access_token}"}
-        )
+        response = await GOOGLE_CLIENT.get(GOOGLE_USERINFO_URL, headers={"Authorization": f"Bearer {access_token}"})
         return response.json()
+    except UpstreamUnavailableError:
+        raise PROVIDER_UNAVAILABLE_EXCEPTION from None
     except Exception:
         raise CREDENTIALS_EXCEPTION from None
 
 
-def google_get_user_from_user_info(
-    session: Session,
+async def google_get_user_from_user_info(
+    session: DBSession,
     user_info: dict,
     disabled: bool = None,
 ) -> User:
@@ -453,8 +676,8 @@ def google_get_user_from_user_info(
     provider = "google"
     email = user_info.get("email")
     if disabled is not None:
-        return get_user(email, session, disabled=disabled, provider=provider)
-    return get_user(email, session, provider=provider)
+        return await get_user(email, session, disabled=disabled, provider=provider)
+    return await get_user(email, session, provider=provider)
 
 
 def set_redirect_fe(response: RedirectResponse, route: str) -> RedirectResponse:
@@ -477,52 +700,125 @@ def set_redirect_fe(response: RedirectResponse, route: str) -> RedirectResponse:
     return response
 
 
-def google_decode_refresh_token(refresh_token: str) -> str:
+async def google_get_new_access_token(refresh_token: str) -> dict[str, str]:
     """
-    Decode refresh token.
+    Get tokens from Google refresh token.
 
     Parameters
     ----------
     refresh_token : str
         Refresh token
 
+    Returns
+    -------
+    dict[str, str]
+        Tokens
+    """
+    return (
+        await google_get_tokens(
+            {
+                "refresh_token": refresh_token,
+                "client_id": GOOGLE_CLIENT_ID,
+                "client_secret": GOOGLE_CLIENT_SECRET,
+                "grant_type": "refresh_token",
+            },
+        )
+    )["access_token"]
+
+
+def get_token_fingerprint(token: str) -> str:
+    """
+    Get the fingerprint of a token, to key caches without storing the token.
+
+    Parameters
+    ----------
+    token : str
+        Token
+
     Returns
     -------
     str
-        Decoded refresh token
+        SHA-256 of the token
     """
-    try:
-        payload = jwt.decode(refresh_token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload.get("refresh_token")
-    except JWTError:
-        raise CREDENTIALS_EXCEPTION from None
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
-def google_get_new_access_token(refresh_token: str) -> dict[str, str]:
+async def google_cache_token_email(token: str, email: str | None, expires_in: float | None = None) -> None:
     """
-    Get tokens from Google refresh token.
+    Cache the email of a Google token, or that it's invalid if email is None.
 
     Parameters
     ----------
-    refresh_token : str
-        Refresh token
+    token : str
+        Access token
+    email : str | None
+        Verified email, or None for an invalid token
+    expires_in : float | None
+        Seconds until the token expires, if known
+    """
+    if email is None:
+        ttl = GOOGLE_TOKEN_NEGATIVE_CACHE_TTL
+    else:
+        ttl = min(GOOGLE_TOKEN_CACHE_TTL, expires_in) if expires_in else GOOGLE_TOKEN_CACHE_TTL
+    await run_in_threadpool(GOOGLE_TOKEN_CACHE.set, get_token_fingerprint(token), email, ttl)
+
+
+async def google_uncache_token(token: str) -> None:
+    """
+    Forget the cached email of a Google token, for every worker.
+
+    Parameters
+    ----------
+    token : str
+        Access token
+    """
+    await run_in_threadpool(GOOGLE_TOKEN_CACHE.delete, get_token_fingerprint(token))
+
+
+async def google_get_email_from_token(token: str) -> str:
+    """
+    Get the verified email of a Google token, from the shared cache if possible.
+
+    The cache is read and written in the thread pool, so a worker waiting
+    for the lock of its file doesn't block the event loop.
+
+    Parameters
+    ----------
+    token : str
+        Access token
+
+    Raises
+    ------
+    HTTPException
+        401 if the token is invalid, or was found invalid recently, 503 if Google
+        is unavailable, which isn't cached
 
     Returns
     -------
-    dict[str, str]
-        Tokens
+    str
+        Email
     """
-    return google_get_tokens(
-        {
-            "refresh_token": refresh_token,
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "grant_type": "refresh_token",
-        },
-    )["access_token"]
+    hit, email = await run_in_threadpool(GOOGLE_TOKEN_CACHE.get, get_token_fingerprint(token))
+    if hit:
+        if email is None:
+            raise CREDENTIALS_EXCEPTION
+        return email
+
+    # Refresh tokens aren't accepted here: they're only exchanged by `rotate_refresh_token`, which checks their session
+    try:
+        user_info = await google_get_user_info_from_access_token(token)
+        email = user_info.get("email")
+        if email is None:
+            raise CREDENTIALS_EXCEPTION
+    except HTTPException as e:
+        if e.status_code == CREDENTIALS_EXCEPTION.status_code:
+            await google_cache_token_email(token, None)
+        raise
+    await google_cache_token_email(token, email)
+    return email
 
 
-def get_user_from_token(session: Session, provider: str, token: str) -> User:
+async def get_user_from_token(session: DBSession, provider: str, token: str) -> User:
     """
     Verify token.
 
@@ -537,8 +833,8 @@ def get_user_from_token(session: Session, provider: str, token: str) -> User:
 
     Raises
     ------
-    credentials_exception
-        If credentials are invalid
+    HTTPException
+        401 if credentials are invalid, 503 if the provider is unavailable
 
     Returns
     -------
@@ -554,21 +850,11 @@ def get_user_from_token(session: Session, provider: str, token: str) -> User:
         except JWTError:
             raise CREDENTIALS_EXCEPTION from None
     elif provider == "google":
-        # Check if token is access token or refresh token
-        try:
-            user_info = google_get_user_info_from_access_token(token)
-            email = user_info.get("email")
-            if email is None:
-                raise CREDENTIALS_EXCEPTION
-        except HTTPException:  # token is refresh token
-            dec_refresh_token = google_decode_refresh_token(token)
-            access_token = google_get_new_access_token(dec_refresh_token)
-            user_info = google_get_user_info_from_access_token(access_token)
-            email = user_info.get("email")
+        email = await google_get_email_from_token(token)
     else:
         raise CREDENTIALS_EXCEPTION
 
-    db_user = get_user(email, session, disabled=False, provider=provider)
+    db_user = await get_cached_user(email, session, provider)
     if db_user is None:
         raise CREDENTIALS_EXCEPTION
     return db_user
@@ -591,7 +877,7 @@ def delete_auth_cookies(response: Response, cookies: list[str] = None) -> None:
 
 async def get_current_user(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     access_token: str | None = Cookie(default=None),
     provider: str | None = Cookie(default=None),
 ) -> User:
@@ -601,7 +887,7 @@ async def get_current_user(
     Parameters
     ----------
     session : Session, optional
-        Session, by default Depends(get_session)
+        Session, by default Depends(get_db_session)
     token : str
         Token
 
@@ -612,7 +898,7 @@ async def get_current_user(
     """
     if not access_token or not provider:
         raise CREDENTIALS_EXCEPTION
-    return get_user_from_token(session, provider, access_token)
+    return await get_user_from_token(session, provider, access_token)
 
 
 async def get_current_active_user(
@@ -641,7 +927,7 @@ async def get_current_active_user(
     return current_user
 
 
-def verify_user_update(user_data: dict) -> None:
+async def verify_user_update(user_data: dict) -> None:
     """
     Verify user update data.
 
@@ -672,6 +958,6 @@ def verify_user_update(user_data: dict) -> None:
                 status_code=400,
                 detail="Passwords do not match",
             )
-        user_data["hashed_password"] = get_password_hash(user_data["password"])
+        user_data["hashed_password"] = await PASSWORD_HASHER.hash(user_data["password"])
         del user_data["password"]
         del user_data["confirm_password"]
@@ -1,5 +1,24 @@
 """Admin module."""
-from fastapi import APIRouter
+from datetime import datetime
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Security
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from app import database
+from app.database import DBSession, get_db_session, get_pool_metrics
+from app.dependencies.bulk import MEDIA_TYPES, export_users, import_users
+from app.dependencies.emails import EMAIL_SENDER
+from app.dependencies.lm import LM_LIMITER, LM_METRICS
+from app.dependencies.metrics import METRICS, PROMETHEUS_CONTENT_TYPE
+from app.dependencies.passwords import PASSWORD_HASHER
+from app.dependencies.profiling import PROFILER, to_pstats
+from app.dependencies.ratelimit import RATE_LIMITER
+from app.dependencies.search import MAX_SEARCH_LIMIT, search_users
+from app.dependencies.security import verify_api_key
+from app.dependencies.users import GOOGLE_CLIENT
+from app.models.users import UserSearchPage
 
 router = APIRouter(
     tags=["admin"],
@@ -18,3 +37,236 @@ async def update_admin() -> dict[str, str]:
         Message
     """
     return {"message": "Admin"}
+
+
+@router.get("/metrics/lm", dependencies=[Security(verify_api_key)])
+async def read_lm_metrics() -> dict[str, dict]:
+    """Read the metrics of this worker's LM calls.
+
+    Returns
+    -------
+    dict[str, dict]
+        Per-signature latency histograms, token counts, retries, parse failures,
+        throttles, timeouts and errors, and the state of the LM limiter
+    """
+    return {"signatures": LM_METRICS.snapshot(), "limiter": LM_LIMITER.metrics()}
+
+
+@router.get("/metrics/passwords", dependencies=[Security(verify_api_key)])
+async def read_password_metrics() -> dict:
+    """Read the metrics of this worker's password hashing pool.
+
+    Returns
+    -------
+    dict
+        Work factor, pool size, running and queued hashes, counts of hashes,
+        verifications, rehashes and rejections, and wait and run histograms
+    """
+    return PASSWORD_HASHER.metrics()
+
+
+@router.get("/metrics/emails", dependencies=[Security(verify_api_key)])
+async def read_email_metrics() -> dict:
+    """Read the metrics of this worker's email sender.
+
+    Returns
+    -------
+    dict
+        Counts of sent, retried and failed emails and of SMTP connections, and
+        send and delivery latency histograms
+    """
+    return EMAIL_SENDER.metrics()
+
+
+@router.get("/metrics/http", dependencies=[Security(verify_api_key)])
+async def read_http_metrics() -> dict[str, dict]:
+    """Read the metrics of this worker's outbound provider calls.
+
+    Returns
+    -------
+    dict[str, dict]
+        Per-provider counts of requests, retries, failures and short-circuited
+        calls, circuit state and latency histogram
+    """
+    return {"google": GOOGLE_CLIENT.metrics()}
+
+
+@router.get("/metrics/db", dependencies=[Security(verify_api_key)])
+async def read_db_metrics() -> dict[str, dict]:
+    """Read the metrics of this worker's database connection pools.
+
+    Returns
+    -------
+    dict[str, dict]
+        Per-engine pool size, checked out, checked in and overflow connections,
+        counts of checkouts, timeouts and new connections, and checkout wait
+        histogram
+    """
+    return get_pool_metrics()
+
+
+@router.get("/metrics/ratelimit", dependencies=[Security(verify_api_key)])
+async def read_rate_limit_metrics() -> dict:
+    """Read the metrics of this worker's rate limiter.
+
+    Returns
+    -------
+    dict
+        Window, limits per IP, email and API key, and per-route counts of
+        allowed and limited requests
+    """
+    return RATE_LIMITER.metrics()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, dependencies=[Security(verify_api_key)])
+async def read_metrics() -> PlainTextResponse:
+    """Read the metrics of every worker of the host, in the Prometheus text format.
+
+    Returns
+    -------
+    PlainTextResponse
+        Per-route request counts, latency histograms, requests in progress
+        and response sizes, and latency histograms of scrapes, DataFrame
+        conversions, LM calls, database queries and bcrypt
+    """
+    return PlainTextResponse(await run_in_threadpool(METRICS.render), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@router.get("/users/export", dependencies=[Security(verify_api_key)])
+async def read_users_export(format: Literal["ndjson", "csv"] = "ndjson") -> StreamingResponse:
+    """Export every user, streamed in constant memory.
+
+    Parameters
+    ----------
+    format
+        "ndjson", one JSON object per line, or "csv" with a header row
+
+    Returns
+    -------
+    StreamingResponse
+        Users, oldest first
+    """
+    return StreamingResponse(
+        export_users(database.engine, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="users.{format}"'},
+    )
+
+
+@router.post("/users/import", dependencies=[Security(verify_api_key)])
+async def create_users_import(request: Request, format: Literal["ndjson", "csv"] = "ndjson") -> dict:
+    """Import users from the request body, inserting new emails and updating existing ones.
+
+    Parameters
+    ----------
+    request
+        Request, with a body of NDJSON lines or CSV rows with a header,
+        in the fields of `UserImport`
+    format
+        "ndjson" or "csv"
+
+    Returns
+    -------
+    dict
+        Counts of inserted, updated and invalid rows, and the first errors
+    """
+    return await import_users(database.engine, request.stream(), format)
+
+
+@router.get("/users/search", response_model=UserSearchPage, dependencies=[Security(verify_api_key)])
+async def read_users_search(
+    q: str | None = Query(default=None, min_length=1),
+    match: Literal["prefix", "contains"] = "prefix",
+    provider: str | None = None,
+    disabled: bool | None = None,
+    joined_after: datetime | None = None,
+    joined_before: datetime | None = None,
+    after: int | None = None,
+    limit: int = Query(default=50, ge=1, le=MAX_SEARCH_LIMIT),
+    session: DBSession = Depends(get_db_session),
+) -> UserSearchPage:
+    """Search users by email and name, in join order, a page at a time.
+
+    Parameters
+    ----------
+    q
+        Text matched case-insensitively against emails, first and last names
+    match
+        "prefix" to match the start of the fields, or "contains" anywhere
+    provider
+        Provider, e.g. "google"
+    disabled
+        Disabled users only, or enabled users only
+    joined_after
+        Earliest join date, inclusive
+    joined_before
+        Latest join date, exclusive
+    after
+        `next_after` of the previous page
+    limit
+        Page size
+    session
+        Database session
+
+    Returns
+    -------
+    UserSearchPage
+        Users, and the `after` of the next page
+    """
+    users, next_after = await search_users(
+        session,
+        limit=limit,
+        query=q,
+        match=match,
+        provider=provider,
+        disabled=disabled,
+        joined_after=joined_after,
+        joined_before=joined_before,
+        after=after,
+    )
+    return UserSearchPage(users=users, next_after=next_after)
+
+
+@router.get("/profiles", dependencies=[Security(verify_api_key)])
+async def read_profiles() -> list[dict]:
+    """List the latest request profiles of every worker of the host.
+
+    Returns
+    -------
+    list[dict]
+        Id, creation time, method, path, status, duration and number of
+        samples of each profile, newest first
+    """
+    return await run_in_threadpool(PROFILER.recent)
+
+
+@router.get("/profiles/{profile_id}", dependencies=[Security(verify_api_key)])
+async def read_profile(profile_id: str, format: Literal["folded", "pstats"] = "folded") -> Response:
+    """Download a request profile.
+
+    Parameters
+    ----------
+    profile_id
+        Id, from the `X-Profile-Id` header of the profiled response
+    format
+        "folded" stacks, for flamegraph.pl or speedscope, or "pstats", for
+        `python -m pstats` or snakeviz
+
+    Returns
+    -------
+    Response
+        Profile
+
+    Raises
+    ------
+    HTTPException
+        404 if the profile was never stored or was dropped from the buffer
+    """
+    profile = await run_in_threadpool(PROFILER.get, profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    folded, interval = profile
+    headers = {"Content-Disposition": f'attachment; filename="{profile_id}.{format}"'}
+    if format == "pstats":
+        return Response(to_pstats(folded, interval), media_type="application/octet-stream", headers=headers)
+    return PlainTextResponse(folded, headers=headers)
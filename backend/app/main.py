@@ -1,6 +1,7 @@
 """Main application and routing logic for the API."""
 
 import logging
+from contextlib import asynccontextmanager
 
 logging.basicConfig()
 
@@ -8,8 +9,14 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app import database
 from app.config import get_settings
-from app.dependencies.users import WWW_URL
+from app.dependencies.emails import EMAIL_SENDER, SMTP_SSL_HOST
+from app.dependencies.metrics import METRICS, METRICS_ENABLED, MetricsMiddleware
+from app.dependencies.passwords import PASSWORD_HASHER
+from app.dependencies.profiling import ProfilingMiddleware
+from app.dependencies.sweeper import AUTH_CODE_SWEEPER
+from app.dependencies.users import GOOGLE_CLIENT, WWW_URL
 from app.internal import admin
 from app.routers import items, users
 
@@ -17,8 +24,27 @@ from app.routers import items, users
 SETTINGS = get_settings()
 FRONTEND_URL = SETTINGS.frontend_url
 
+
 # App
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    AUTH_CODE_SWEEPER.start()
+    METRICS.start()
+    if SMTP_SSL_HOST:
+        EMAIL_SENDER.start()
+    else:
+        logging.warning("SMTP_SSL_HOST is not set, queued emails will not be sent.")
+    yield
+    EMAIL_SENDER.stop()
+    AUTH_CODE_SWEEPER.stop()
+    METRICS.stop()
+    PASSWORD_HASHER.shutdown()
+    await GOOGLE_CLIENT.aclose()
+    if database.async_engine is not None:
+        await database.async_engine.dispose()  # aiosqlite connections hold threads that block exit
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(admin.router)
 app.include_router(users.router)
 app.include_router(items.router)
@@ -34,6 +60,15 @@ app.add_middleware(
 )
 
 
+# Profiling, of the requests that ask for it
+app.add_middleware(ProfilingMiddleware)
+
+
+# Metrics, outermost so they include the other middleware
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+
 # Paths
 @app.get("/")
 async def read_root() -> dict[str, str]:
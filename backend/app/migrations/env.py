@@ -5,7 +5,7 @@ from sqlalchemy import engine_from_config, pool
 from sqlmodel import SQLModel
 
 from app.config import get_settings
-from app.models import items, users  # noqa: F401
+from app.models import emails, items, users  # noqa: F401
 
 SETTINGS = get_settings()
 DB_URI = SETTINGS.database_uri
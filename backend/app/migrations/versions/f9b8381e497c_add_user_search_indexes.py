@@ -0,0 +1,48 @@
+"""Add user search indexes
+
+Revision ID: f9b8381e497c
+Revises: 5c8956006cd3
+Create Date: 2026-10-19 16:52:44.318204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f9b8381e497c"
+down_revision = "5c8956006cd3"
+branch_labels = None
+depends_on = None
+
+COLUMNS = ["email", "first_name", "last_name"]
+
+
+def upgrade():
+    is_postgresql = op.get_bind().dialect.name == "postgresql"
+    if is_postgresql:
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for column in COLUMNS:
+        op.create_index(
+            f"ix_user_{column}_lower",
+            "user",
+            [sa.func.lower(sa.column(column)).label("lowered")],
+            unique=False,
+            postgresql_ops={"lowered": "varchar_pattern_ops"},
+        )
+        if is_postgresql:
+            op.create_index(
+                f"ix_user_{column}_trigram",
+                "user",
+                [sa.func.lower(sa.column(column)).label("lowered")],
+                unique=False,
+                postgresql_using="gin",
+                postgresql_ops={"lowered": "gin_trgm_ops"},
+            )
+
+
+def downgrade():
+    is_postgresql = op.get_bind().dialect.name == "postgresql"
+    for column in reversed(COLUMNS):
+        if is_postgresql:
+            op.drop_index(f"ix_user_{column}_trigram", table_name="user")
+        op.drop_index(f"ix_user_{column}_lower", table_name="user")
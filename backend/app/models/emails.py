@@ -0,0 +1,24 @@
+"""Models for outgoing emails."""
+
+from datetime import datetime
+
+from sqlmodel import Field, SQLModel
+
+from app.models.users import MAX_EMAIL_LENGTH
+
+
+class OutboxEmail(SQLModel, table=True):
+    """Email waiting to be sent, or sent."""
+
+    id: int | None = Field(default=None, primary_key=True)
+    email: str = Field(default=None, max_length=MAX_EMAIL_LENGTH)
+    template: str
+    context: str = Field(default="{}")  # JSON of the template's fields, cleared once sent or failed
+
+    status: str = Field(default="pending", index=True)
+    attempts: int = Field(default=0)
+    claim: str | None = Field(default=None, index=True)  # sender that holds the email until next_attempt_date
+    last_error: str | None = Field(default=None)
+    request_date: datetime = Field(default_factory=datetime.utcnow)
+    next_attempt_date: datetime = Field(default_factory=datetime.utcnow, index=True)
+    sent_date: datetime | None = Field(default=None)
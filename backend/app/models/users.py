@@ -3,6 +3,7 @@
 from datetime import datetime
 from uuid import UUID, uuid4
 
+from sqlalchemy import DDL, Index, event, func
 from sqlmodel import Field, SQLModel
 
 # Max lengths (in characters)
@@ -11,12 +12,19 @@ MAX_PHONE_NUMBER_LENGTH = 20
 MAX_MESSAGE_LENGTH = 1000
 MAX_FIRST_NAME_LENGTH = 700
 MAX_LAST_NAME_LENGTH = 700
+MAX_USER_AGENT_LENGTH = 500
+MAX_IP_ADDRESS_LENGTH = 45  # IPv6
 
 
 # Misc auth
 class AuthCode(SQLModel, table=True):
     """Verification code model."""
 
+    __table_args__ = (
+        Index("ix_authcode_lookup", "email", "request_type", "status", "request_date"),  # latest code of a request
+        Index("ix_authcode_status_expire_date", "status", "expire_date"),  # expiry sweep
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     email: str = Field(default=None, max_length=MAX_EMAIL_LENGTH, index=True)
     code: str = Field(default_factory=lambda: uuid4().hex[:6])
@@ -24,10 +32,26 @@ class AuthCode(SQLModel, table=True):
     status: str = Field(default="pending", index=True)
     request_type: str = Field(default=None, index=True)
     request_date: datetime = Field(default_factory=datetime.utcnow)
-    expire_date: datetime = Field(default=None)
+    expire_date: datetime = Field(default=None, index=True)  # purge sweep
     usage_date: datetime | None = Field(default=None)
 
 
+class RefreshSession(SQLModel, table=True):
+    """Signed in device, with the id of its current refresh token."""
+
+    id: int | None = Field(default=None, primary_key=True)
+    jti: str = Field(unique=True, index=True, max_length=32)  # rotated on every refresh
+    user_uuid: UUID = Field(foreign_key="user.uuid", ondelete="CASCADE", index=True)
+    provider: str
+
+    user_agent: str | None = Field(default=None, max_length=MAX_USER_AGENT_LENGTH)
+    ip_address: str | None = Field(default=None, max_length=MAX_IP_ADDRESS_LENGTH)
+    created_date: datetime = Field(default_factory=datetime.utcnow)
+    last_used_date: datetime = Field(default_factory=datetime.utcnow)
+    expire_date: datetime = Field(index=True)  # purge sweep
+    revoked_date: datetime | None = Field(default=None)
+
+
 class GoogleAuth(SQLModel):
     """Google auth model."""
 
@@ -115,7 +139,6 @@ class User(UserBase, table=True):
     uuid: UUID = Field(default_factory=uuid4, unique=True)
 
     hashed_password: str | None = Field(default=None)
-    refresh_token: str | None = Field(default=None)
 
     # requester_links: list["ChatRequest"] = Relationship(
     #     back_populates="requester",
@@ -137,6 +160,26 @@ class User(UserBase, table=True):
     # )
 
 
+# Case-insensitive search: `lower()` btrees for prefixes, with pattern ops so Postgres serves `LIKE 'prefix%'` under
+# any collation, and trigram GIN indexes on Postgres for substrings
+event.listen(
+    User.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
+for _column in (User.email, User.first_name, User.last_name):
+    Index(
+        f"ix_user_{_column.name}_lower",
+        func.lower(_column).label("lowered"),
+        postgresql_ops={"lowered": "varchar_pattern_ops"},
+    )
+    Index(
+        f"ix_user_{_column.name}_trigram",
+        func.lower(_column).label("lowered"),
+        postgresql_using="gin",
+        postgresql_ops={"lowered": "gin_trgm_ops"},
+    ).ddl_if(dialect="postgresql")
+del _column
+
+
 class UserCreate(UserBase):
     """User create model."""
 
@@ -153,6 +196,13 @@ class UserRead(UserBase):
     # receiver_links: list[ChatRequestRead] = []
 
 
+class UserSearchPage(SQLModel):
+    """Page of a user search."""
+
+    users: list[UserRead]
+    next_after: int | None = None  # `after` of the next page, None on the last page
+
+
 class UserUpdate(SQLModel):
     """User update model."""
 
@@ -167,3 +217,21 @@ class UserUpdate(SQLModel):
 
     account_view: str | None = None
     is_sidebar_open: bool | None = None
+
+
+class UserImport(SQLModel):
+    """User row of a bulk import, matched to existing users by email and provider."""
+
+    email: str = Field(max_length=MAX_EMAIL_LENGTH)
+    provider: str = Field(default="dilemma")
+    uuid: UUID | None = None  # new users only
+    join_date: datetime | None = None  # new users only
+
+    profile_picture: str | None = None
+    first_name: str | None = Field(default=None, max_length=MAX_FIRST_NAME_LENGTH)
+    last_name: str | None = Field(default=None, max_length=MAX_LAST_NAME_LENGTH)
+    hashed_password: str | None = None
+
+    account_view: str = Field(default="profile")
+    is_sidebar_open: bool = Field(default=True)
+    disabled: bool = Field(default=False)
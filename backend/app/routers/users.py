@@ -3,36 +3,39 @@
 from datetime import datetime
 from typing import Annotated
 
-from fastapi import APIRouter, Cookie, Depends, HTTPException, Response, Security
+from fastapi import APIRouter, Cookie, Depends, HTTPException, Request, Response, Security
 from fastapi.responses import RedirectResponse
-from sqlmodel import Session
 
-from app.database import get_session
+from app.database import DBSession, get_db_session
+from app.dependencies.emails import queue_email
+from app.dependencies.passwords import PASSWORD_HASHER
+from app.dependencies.ratelimit import RATE_LIMITER
 from app.dependencies.security import verify_api_key
 from app.dependencies.users import (
     ACCESS_TOKEN_EXPIRES,
     CREDENTIALS_EXCEPTION,
     RECOVERY_CODE_EXPIRES,
-    REFRESH_TOKEN_EXPIRES,
     VERIFY_CODE_EXPIRES,
+    create_refresh_token,
     create_token,
+    decode_refresh_token,
     delete_auth_cookies,
     get_current_active_user,
     get_google_auth_url,
-    get_password_hash,
     get_user,
     get_user_from_token,
-    google_decode_refresh_token,
-    google_encode_refresh_token,
+    google_cache_token_email,
     google_get_new_access_token,
     google_get_tokens_from_code,
     google_get_user_from_user_info,
     google_get_user_info_from_access_token,
-    send_email,
+    google_uncache_token,
+    revoke_refresh_token,
+    revoke_user_refresh_tokens,
+    rotate_refresh_token,
     set_auth_cookies,
     set_redirect_fe,
     verify_code,
-    verify_password,
     verify_user_update,
 )
 from app.models.users import (
@@ -55,7 +58,8 @@ router = APIRouter(
 @router.post("/auth/verify-email", response_model=dict[str, str])
 async def verify_email(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     user: UserCreate,
 ):
     """Verify email.
@@ -92,8 +96,9 @@ async def verify_email(
             status_code=400,
             detail="Passwords do not match",
         )
+    await RATE_LIMITER.check("verify_email", request, db_user.email)
 
-    user_exists = get_user(db_user.email, session)
+    user_exists = await get_user(db_user.email, session)
     if not user_exists:
         verify_code = AuthCode(
             email=db_user.email,
@@ -101,18 +106,8 @@ async def verify_email(
             expire_date=datetime.utcnow() + VERIFY_CODE_EXPIRES,
         )
         session.add(verify_code)
-        session.commit()
-
-        body = f"""
-## Welcome!
-
-Head back to the website and enter the following code to continue:
-
-## {verify_code.code}
-
-If you did not request this code, please ignore this email.
-        """
-        send_email(db_user.email, subject="Verify Email", body=body)
+        queue_email(session, db_user.email, "verify", code=verify_code.code)
+        await session.commit()
 
     return {"message": "If the email exists, you will receive a verification email shortly."}
 
@@ -120,7 +115,8 @@ If you did not request this code, please ignore this email.
 @router.post("/auth/signup", response_model=UserRead)
 async def signup(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     response: Response,
     user: UserCreate,
 ):
@@ -137,22 +133,22 @@ async def signup(
         User
     """
     db_user = UserCreate.model_validate(user)
-    verify_code(session, db_user.code, db_user.email, "verify")
+    await verify_code(session, db_user.code, db_user.email, "verify")
 
     access_token = create_token(data={"email": db_user.email}, expires_delta=ACCESS_TOKEN_EXPIRES)
-    refresh_token = create_token(data={"email": db_user.email}, expires_delta=REFRESH_TOKEN_EXPIRES)
 
     created_user = User(
         profile_picture=db_user.profile_picture,
         email=db_user.email,
         first_name=db_user.first_name,
         last_name=db_user.last_name,
-        hashed_password=get_password_hash(db_user.password),
-        refresh_token=refresh_token,
+        hashed_password=await PASSWORD_HASHER.hash(db_user.password),
     )
     session.add(created_user)
-    session.commit()
-    session.refresh(created_user)
+    await session.commit()  # before its refresh session references it
+    await session.refresh(created_user)
+    refresh_token = create_refresh_token(session, created_user, created_user.provider, request)
+    await session.commit()
 
     set_auth_cookies(response, access_token, refresh_token, created_user.provider)
     return UserRead.model_validate(created_user)
@@ -161,7 +157,8 @@ async def signup(
 @router.post("/auth/login", response_model=UserRead)
 async def login(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     response: Response,
     user: UserCreate,
 ):
@@ -185,23 +182,26 @@ async def login(
             status_code=400,
             detail="Email is empty",
         )
-    verified_user = get_user(db_user.email, session, disabled=False, provider=provider)
+    await RATE_LIMITER.check("login", request, db_user.email)
+    verified_user = await get_user(db_user.email, session, disabled=False, provider=provider)
 
     if not db_user.password:
         raise HTTPException(
             status_code=400,
             detail="Password is empty",
         )
-    if not verified_user or not verify_password(db_user.password, verified_user.hashed_password):
+    if not verified_user:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+    verified, new_hash = await PASSWORD_HASHER.verify(db_user.password, verified_user.hashed_password)
+    if not verified:
         raise HTTPException(status_code=401, detail="Incorrect email or password")
+    if new_hash:  # the work factor changed since the password was hashed
+        verified_user.hashed_password = new_hash
+        session.add(verified_user)
 
     access_token = create_token(data={"email": verified_user.email}, expires_delta=ACCESS_TOKEN_EXPIRES)
-    refresh_token = create_token(data={"email": verified_user.email}, expires_delta=REFRESH_TOKEN_EXPIRES)
-
-    verified_user.refresh_token = refresh_token
-    session.add(verified_user)
-    session.commit()
-    session.refresh(verified_user)
+    refresh_token = create_refresh_token(session, verified_user, provider, request)
+    await session.commit()
 
     set_auth_cookies(response, access_token, refresh_token, provider)
     return UserRead.model_validate(verified_user)
@@ -237,7 +237,8 @@ async def verify_email_google(
 @router.post("/auth/google", response_model=UserRead)
 async def auth_google(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     response: Response,
     auth: GoogleAuth,
 ):
@@ -266,13 +267,12 @@ async def auth_google(
             detail="State is empty",
         )
 
-    tokens = google_get_tokens_from_code(auth.code)
+    tokens = await google_get_tokens_from_code(auth.code)
     access_token = tokens["access_token"]
-    refresh_token = tokens["refresh_token"]
-    enc_refresh_token = google_encode_refresh_token(refresh_token)
 
-    user_info = google_get_user_info_from_access_token(access_token)
-    db_user = google_get_user_from_user_info(session, user_info)
+    user_info = await google_get_user_info_from_access_token(access_token)
+    db_user = await google_get_user_from_user_info(session, user_info)
+    await google_cache_token_email(access_token, user_info.get("email"), tokens["expires_in"])
 
     if not db_user and auth.state == "signup":
         db_user = User(
@@ -280,11 +280,11 @@ async def auth_google(
             email=user_info["email"],
             first_name=user_info["given_name"],
             last_name=user_info["family_name"],
-            refresh_token=enc_refresh_token,
             provider=provider,
         )
-    elif db_user and auth.state == "login":
-        db_user.refresh_token = enc_refresh_token
+        session.add(db_user)
+        await session.commit()  # before its refresh session references it
+        await session.refresh(db_user)
     elif db_user and auth.state == "signup":
         raise HTTPException(
             status_code=400,
@@ -295,14 +295,13 @@ async def auth_google(
             status_code=400,
             detail="Account does not exist",
         )
-    else:  # shouldn't happen
+    elif not db_user or auth.state != "login":  # shouldn't happen
         raise CREDENTIALS_EXCEPTION
 
-    session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    refresh_token = create_refresh_token(session, db_user, provider, request, tokens.get("refresh_token"))
+    await session.commit()
 
-    set_auth_cookies(response, access_token, enc_refresh_token, provider)
+    set_auth_cookies(response, access_token, refresh_token, provider)
     return UserRead.model_validate(db_user)
 
 
@@ -310,7 +309,8 @@ async def auth_google(
 @router.post("/auth/token/refresh", response_model=UserRead)
 async def refresh_token(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     response: Response,
     access_token: str | None = Cookie(default=None),
     refresh_token: str | None = Cookie(default=None),
@@ -336,27 +336,27 @@ async def refresh_token(
     try:
         if not access_token:
             raise CREDENTIALS_EXCEPTION
-        user = get_user_from_token(session, provider, access_token)
+        user = await get_user_from_token(session, provider, access_token)
         if user:
             return UserRead.model_validate(user)
     except HTTPException:
         pass
 
-    # If not, check if refresh token is valid
-    if not refresh_token:
-        raise CREDENTIALS_EXCEPTION
-    user = get_user_from_token(session, provider, refresh_token)
-    if not user or user.refresh_token != refresh_token:
+    # If not, rotate the refresh token, which fails if it was rotated or revoked already
+    if not refresh_token or provider not in ("dilemma", "google"):
         raise CREDENTIALS_EXCEPTION
+    user, new_refresh_token = await rotate_refresh_token(session, refresh_token, provider, request)
 
     # If valid, create new access token
     if provider == "dilemma":
         access_token = create_token(data={"email": user.email}, expires_delta=ACCESS_TOKEN_EXPIRES)
-    elif provider == "google":
-        dec_refresh_token = google_decode_refresh_token(refresh_token)
-        access_token = google_get_new_access_token(dec_refresh_token)
     else:
-        raise CREDENTIALS_EXCEPTION
+        google_refresh_token = decode_refresh_token(new_refresh_token).get("refresh_token")
+        if not google_refresh_token:
+            raise CREDENTIALS_EXCEPTION
+        access_token = await google_get_new_access_token(google_refresh_token)
+    await session.commit()
+    refresh_token = new_refresh_token
 
     set_auth_cookies(response, access_token, refresh_token, provider)
     return UserRead.model_validate(user)
@@ -365,7 +365,7 @@ async def refresh_token(
 @router.post("/auth/logout", response_model=dict[str, str])
 async def logout(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     response: Response,
     access_token: str | None = Cookie(default=None),
     refresh_token: str | None = Cookie(default=None),
@@ -391,36 +391,53 @@ async def logout(
     dict[str, str]
         Message
     """
-    # Try to remove refresh token from database
-    if provider:
-        # Try to get user from access token
-        try:
-            if not access_token:
-                raise CREDENTIALS_EXCEPTION
-            user = get_user_from_token(session, provider, access_token)
-            user.refresh_token = None
-            session.add(user)
-            session.commit()
-        except HTTPException:  # If not, try to get user from refresh token
-            try:
-                if not refresh_token:
-                    raise CREDENTIALS_EXCEPTION
-                user = get_user_from_token(session, provider, refresh_token)
-                user.refresh_token = None
-                session.add(user)
-                session.commit()
-            except HTTPException:
-                pass
+    # Revoke this device's refresh session
+    if refresh_token:
+        await revoke_refresh_token(session, refresh_token)
+
+    if provider == "google":
+        for token in (access_token, refresh_token):
+            if token:
+                await google_uncache_token(token)
 
     delete_auth_cookies(response)
     return {"message": "Logout successful"}
 
 
+@router.post("/auth/logout/all", response_model=dict[str, str])
+async def logout_all(
+    *,
+    session: DBSession = Depends(get_db_session),
+    response: Response,
+    current_user: Annotated[User, Depends(get_current_active_user)],
+):
+    """Logout of every device.
+
+    Parameters
+    ----------
+    session
+        Database session
+    response
+        Response
+    current_user
+        Current user
+
+    Returns
+    -------
+    dict[str, str]
+        Message
+    """
+    await revoke_user_refresh_tokens(session, current_user.uuid)
+    delete_auth_cookies(response)
+    return {"message": "Logout successful"}
+
+
 # Native password recovery
 @router.post("/account/password/forgot", response_model=dict[str, str])
 async def forgot_password(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     user: UserUpdate,
 ):
     """Forgot password.
@@ -445,25 +462,16 @@ async def forgot_password(
             status_code=400,
             detail="Email is empty",
         )
+    await RATE_LIMITER.check("forgot_password", request, db_user.email)
 
-    verified_user = get_user(db_user.email, session, disabled=False, provider=provider)
+    verified_user = await get_user(db_user.email, session, disabled=False, provider=provider)
     if verified_user:
         recovery_code = AuthCode(
             email=verified_user.email, request_type="recovery", expire_date=datetime.utcnow() + RECOVERY_CODE_EXPIRES
         )
         session.add(recovery_code)
-        session.commit()
-
-        body = f"""
-## You've requested a password reset.
-
-Head back to the website and enter the following code to continue:
-
-## {recovery_code.code}
-
-If you did not request this code, please ignore this email.
-        """
-        send_email(verified_user.email, subject="Password Recovery", body=body)
+        queue_email(session, verified_user.email, "recovery", code=recovery_code.code)
+        await session.commit()
 
     return {"message": "If the email exists, you will receive a recovery email shortly."}
 
@@ -471,7 +479,7 @@ If you did not request this code, please ignore this email.
 @router.post("/account/code/verify", response_model=dict[str, str])
 async def check_code(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     user: UserUpdate,
 ):
     """Check code.
@@ -497,9 +505,9 @@ async def check_code(
             detail="Email is empty",
         )
 
-    verified_user = get_user(db_user.email, session, disabled=False, provider=provider)
+    verified_user = await get_user(db_user.email, session, disabled=False, provider=provider)
 
-    verify_code(session, db_user.code, verified_user.email, "recovery")
+    await verify_code(session, db_user.code, verified_user.email, "recovery")
 
     return {"message": "Code is valid"}
 
@@ -507,7 +515,7 @@ async def check_code(
 @router.post("/account/password/reset", response_class=RedirectResponse)
 async def reset_password(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     user: UserUpdate,
 ):
     """Reset password.
@@ -534,7 +542,7 @@ async def reset_password(
             detail="Email is empty",
         )
 
-    verified_user = get_user(db_user.email, session, False, provider)
+    verified_user = await get_user(db_user.email, session, False, provider)
 
     if not db_user.password:
         raise HTTPException(status_code=400, detail="Password is empty")
@@ -543,9 +551,10 @@ async def reset_password(
     if db_user.password != db_user.confirm_password:
         raise HTTPException(status_code=400, detail="Passwords do not match")
 
-    verified_user.hashed_password = get_password_hash(db_user.password)
+    verified_user.hashed_password = await PASSWORD_HASHER.hash(db_user.password)
     session.add(verified_user)
-    session.commit()
+    await session.commit()
+    await revoke_user_refresh_tokens(session, verified_user.uuid)  # sign out every device
 
     response = set_redirect_fe(response, "/login")
     return response
@@ -556,7 +565,8 @@ async def reset_password(
 async def verify_email_update(
     *,
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
+    request: Request,
     provider: str | None = Cookie(default=None),
     user: UserUpdate,
 ):
@@ -590,8 +600,9 @@ async def verify_email_update(
             status_code=400,
             detail="Email is the same",
         )
+    await RATE_LIMITER.check("verify_email_update", request, db_user.email)
 
-    user_exists = get_user(db_user.email, session)
+    user_exists = await get_user(db_user.email, session)
     if not user_exists:
         verify_code = AuthCode(
             email=db_user.email,
@@ -599,18 +610,8 @@ async def verify_email_update(
             expire_date=datetime.utcnow() + VERIFY_CODE_EXPIRES,
         )
         session.add(verify_code)
-        session.commit()
-
-        body = f"""
-## You've requested to update your email.
-
-Head back to the website and enter the following code to continue:
-
-## {verify_code.code}
-
-If you did not request this code, please ignore this email.
-        """
-        send_email(db_user.email, subject="Verify Email", body=body)
+        queue_email(session, db_user.email, "verify_update", code=verify_code.code)
+        await session.commit()
 
     return {"message": "If the email exists, you will receive a verification email shortly."}
 
@@ -619,7 +620,7 @@ If you did not request this code, please ignore this email.
 async def update_email(
     *,
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     response: Response,
     user: UserUpdate,
 ):
@@ -636,12 +637,12 @@ async def update_email(
         Message
     """
     db_user = UserUpdate.model_validate(user)
-    verify_code(session, db_user.code, db_user.email, "verify")
+    await verify_code(session, db_user.code, db_user.email, "verify")
 
     current_user.email = db_user.email
     session.add(current_user)
-    session.commit()
-    session.refresh(current_user)
+    await session.commit()
+    await session.refresh(current_user)
 
     access_token = create_token(data={"email": db_user.email}, expires_delta=ACCESS_TOKEN_EXPIRES)
     set_auth_cookies(response, access_token)
@@ -668,7 +669,7 @@ async def read_user(
 async def update_user(
     *,
     current_user: Annotated[User, Depends(get_current_active_user)],
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     new_user: UserUpdate,
 ):
     """Update user with new field(s).
@@ -690,13 +691,13 @@ async def update_user(
         token_type and uuid
     """
     user_data = new_user.model_dump(exclude_unset=True)
-    verify_user_update(user_data)
+    await verify_user_update(user_data)
 
     for key, value in user_data.items():
         setattr(current_user, key, value)
     session.add(current_user)
-    session.commit()
-    session.refresh(current_user)
+    await session.commit()
+    await session.refresh(current_user)
 
     return UserRead.model_validate(current_user)
 
@@ -704,11 +705,11 @@ async def update_user(
 @router.delete("/user/profile/delete", response_model=UserRead)
 async def delete_user(
     *,
-    session: Session = Depends(get_session),
+    session: DBSession = Depends(get_db_session),
     current_user: Annotated[User, Depends(get_current_active_user)],
 ):
-    session.delete(current_user)
-    session.commit()
+    await session.delete(current_user)
+    await session.commit()
     return UserRead.model_validate(current_user)
 
 
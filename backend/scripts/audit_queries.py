@@ -0,0 +1,417 @@
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+from fastapi.testclient import TestClient
+from sqlalchemy import Column, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression
+from sqlmodel import Session, SQLModel, select
+
+from app import database
+from app.database import create_database_engine
+from app.dependencies import users
+from app.dependencies.cache import LocalCache, SharedCache
+from app.dependencies.emails import EmailSender
+from app.dependencies.passwords import PasswordHasher, get_crypt_context
+from app.dependencies.security import API_KEY
+from app.dependencies.sweeper import AuthCodeSweeper
+from app.main import app
+from app.models.emails import OutboxEmail
+from app.models.users import AuthCode, RefreshSession, User
+from app.routers import users as users_router
+from scripts.fake_google import FakeGoogle
+
+# Audit params
+PASSWORD = "Password123!"
+PASSWORD_ROUNDS = 4  # bcrypt work factor of seeded and new users, the audit is about queries
+EQUALITY_OPERATORS = {operators.eq, operators.in_op, operators.is_}
+RANGE_OPERATORS = {operators.lt, operators.le, operators.gt, operators.ge}
+AUDITED_STATEMENTS = ("SELECT", "UPDATE", "DELETE", "WITH")
+SQLITE_SCAN = re.compile(r"^SCAN (\w+)")  # SEARCH is an index lookup, SCAN reads the whole table or index
+POSTGRES_SCAN = re.compile(r"Seq Scan on (\w+)")
+MIGRATION_TEMPLATE = '''"""{message}
+
+Revision ID: {revision}
+Revises: {down_revision}
+Create Date: {create_date}
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "{revision}"
+down_revision = "{down_revision}"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+{upgrade}
+
+
+def downgrade():
+{downgrade}
+'''
+
+
+@dataclass
+class AuditedStatement:
+    """SQL statement seen during the audit, with its plan, timings and the routes that made it."""
+
+    sql: str
+    plan: list[str]
+    scans: list[str]  # tables read in full
+    index_columns: dict[str, list[str]]  # per table, columns a composite index would serve
+    routes: set[str] = field(default_factory=set)
+    hot: bool = False
+    durations: list[float] = field(default_factory=list)
+
+
+class QueryAudit:
+    """
+    Records each statement an engine runs, with its plan, while routes run under `route`.
+
+    Plans are read with `EXPLAIN QUERY PLAN` on SQLite and `EXPLAIN` on
+    Postgres, on the same connection and transaction as the statement, once
+    per distinct statement. Timings run until the first row, since drivers
+    like SQLite fetch the rest lazily.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.statements: dict[str, AuditedStatement] = {}
+        self.route, self.hot = None, False
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @contextmanager
+    def audit(self, route: str, hot: bool = True):
+        self.route, self.hot = route, hot
+        try:
+            yield
+        finally:
+            self.route, self.hot = None, False
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info["audit_start"] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info.pop("audit_start")
+        if self.route is None or executemany or not statement.lstrip().upper().startswith(AUDITED_STATEMENTS):
+            return
+        audited = self.statements.get(statement)
+        if audited is None:
+            plan = self.explain(conn, statement, parameters)
+            scan = SQLITE_SCAN if conn.dialect.name == "sqlite" else POSTGRES_SCAN
+            scans = sorted({match.group(1) for line in plan if (match := scan.search(line.strip()))})
+            compiled = context.compiled.statement if context is not None and context.compiled is not None else None
+            audited = self.statements[statement] = AuditedStatement(statement, plan, scans, get_index_columns(compiled))
+        audited.routes.add(self.route)
+        audited.hot |= self.hot
+        audited.durations.append(duration)
+
+    def explain(self, conn, statement: str, parameters) -> list[str]:
+        cursor = conn.connection.cursor()  # the DBAPI cursor, so the EXPLAIN isn't audited itself
+        try:
+            if conn.dialect.name == "sqlite":
+                cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                return [row[3] for row in cursor.fetchall()]
+            cursor.execute(f"EXPLAIN {statement}", parameters)
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    @property
+    def failures(self) -> list[AuditedStatement]:
+        """Statements of hot routes that read a table in full."""
+        return [audited for audited in self.statements.values() if audited.hot and audited.scans]
+
+    def propose_indexes(self) -> dict[tuple[str, tuple[str, ...]], set[str]]:
+        """
+        Propose composite indexes for the statements that read a table in full.
+
+        Columns compared for equality come first, then one compared by range,
+        then the ones sorted by. Indexes that an existing one already covers
+        are skipped, since their scan is the planner's choice.
+
+        Returns
+        -------
+        dict[tuple[str, tuple[str, ...]], set[str]]
+            Table and columns of each index, to the routes it would serve
+        """
+        existing = {
+            (table.name, tuple(column.name for column in index.columns))
+            for table in SQLModel.metadata.tables.values()
+            for index in table.indexes
+        }
+        proposals = defaultdict(set)
+        for audited in self.statements.values():
+            for table in audited.scans:
+                columns = tuple(audited.index_columns.get(table, ()))
+                covered = any(name == table and cols[: len(columns)] == columns for name, cols in existing)
+                if columns and not covered:
+                    proposals[table, columns] |= audited.routes
+        return dict(proposals)
+
+    def report(self) -> None:
+        print(f"{len(self.statements)} distinct statements, {len(self.failures)} with full scans on hot routes")
+        for audited in sorted(self.statements.values(), key=lambda audited: -sum(audited.durations)):
+            flag = "FAIL" if audited.hot and audited.scans else "scan" if audited.scans else "ok"
+            mean = sum(audited.durations) / len(audited.durations) * 1000
+            print(f"\n[{flag}] {len(audited.durations)}x, mean {mean:.2f}ms, {', '.join(sorted(audited.routes))}")
+            print(f"  {' '.join(audited.sql.split())[:300]}")
+            for line in audited.plan:
+                print(f"    {line}")
+
+
+def get_index_columns(statement) -> dict[str, list[str]]:
+    """
+    Get the columns a statement filters and sorts on, per table, in the order a composite index should have them.
+
+    Parameters
+    ----------
+    statement
+        Compiled statement, e.g. an ORM select or update
+
+    Returns
+    -------
+    dict[str, list[str]]
+        Equality columns, then the first range column, then sort columns, per table
+    """
+    equality, ranges, ordering = defaultdict(list), defaultdict(list), defaultdict(list)
+    where = getattr(statement, "whereclause", None)
+    for element in visitors.iterate(where) if where is not None else ():
+        if isinstance(element, BinaryExpression) and isinstance(element.left, Column):
+            columns = equality if element.operator in EQUALITY_OPERATORS else ranges
+            if element.operator in EQUALITY_OPERATORS | RANGE_OPERATORS:
+                columns[element.left.table.name].append(element.left.name)
+    for clause in getattr(statement, "_order_by_clauses", ()):
+        column = getattr(clause, "element", clause)
+        if isinstance(column, Column):
+            ordering[column.table.name].append(column.name)
+    index_columns = {}
+    for table in {*equality, *ranges, *ordering}:
+        columns = [*equality[table], *ranges[table][:1], *ordering[table]]
+        index_columns[table] = list(dict.fromkeys(columns))
+    return index_columns
+
+
+def render_migration(proposals: dict[tuple[str, tuple[str, ...]], set[str]]) -> str:
+    """
+    Render an Alembic migration that creates the proposed indexes.
+
+    Parameters
+    ----------
+    proposals : dict[tuple[str, tuple[str, ...]], set[str]]
+        Table and columns of each index, to the routes it would serve
+
+    Returns
+    -------
+    str
+        Migration script, revising the current head
+    """
+    upgrade, downgrade = [], []
+    for (table, columns), routes in sorted(proposals.items()):
+        name = f"ix_{table}_{'_'.join(columns)}"
+        upgrade.append(
+            f"    op.create_index({name!r}, {table!r}, {list(columns)!r}, unique=False)  # {', '.join(sorted(routes))}"
+        )
+        downgrade.insert(0, f"    op.drop_index({name!r}, table_name={table!r})")
+    return MIGRATION_TEMPLATE.format(
+        message="Add indexes proposed by the query audit",
+        revision=uuid4().hex[:12],
+        down_revision=ScriptDirectory.from_config(Config("alembic.ini")).get_current_head(),
+        create_date=datetime.now(),
+        upgrade="\n".join(upgrade).replace("'", '"') or "    pass",
+        downgrade="\n".join(downgrade).replace("'", '"') or "    pass",
+    )
+
+
+def seed(engine: Engine, args) -> None:
+    """Fill the tables with production-like volumes, with one password hash for every user."""
+    SQLModel.metadata.create_all(engine)
+    rng, now = random.Random(42), datetime.utcnow()
+    hashed_password = get_crypt_context(PASSWORD_ROUNDS).hash(PASSWORD)
+    start = time.perf_counter()
+    uuids = [uuid4() for _ in range(args.num_users)]
+    emails = [f"user{i}@example.com" for i in range(args.num_users)]
+    codes, sessions = [], []
+    for i in range(args.num_codes):
+        request_date = now - timedelta(days=rng.uniform(0, 90))
+        codes.append(
+            {
+                "email": rng.choice(emails),
+                "code": f"{i:06x}"[-6:],
+                "status": "pending" if rng.random() < 0.2 else rng.choice(["verified", "expired"]),
+                "request_type": rng.choice(["verify", "recovery"]),
+                "request_date": request_date,
+                "expire_date": request_date + timedelta(minutes=15),
+            }
+        )
+    for _ in range(args.num_sessions):
+        created_date = now - timedelta(days=rng.uniform(0, 60))
+        sessions.append(
+            {
+                "jti": uuid4().hex,
+                "user_uuid": rng.choice(uuids),
+                "provider": "dilemma",
+                "user_agent": "Mozilla/5.0",
+                "ip_address": "10.0.0.1",
+                "created_date": created_date,
+                "last_used_date": created_date,
+                "expire_date": created_date + timedelta(days=30),
+            }
+        )
+    with engine.begin() as conn:
+        conn.execute(
+            User.__table__.insert(),
+            [
+                {
+                    "uuid": uuid,
+                    "email": email,
+                    "provider": "dilemma",
+                    "first_name": f"First{i % 500}",
+                    "last_name": f"Last{i % 2000}",
+                    "hashed_password": hashed_password,
+                }
+                for i, (uuid, email) in enumerate(zip(uuids, emails, strict=True))
+            ],
+        )
+        conn.execute(AuthCode.__table__.insert(), codes)
+        conn.execute(RefreshSession.__table__.insert(), sessions)
+        conn.execute(
+            OutboxEmail.__table__.insert(),
+            [
+                {
+                    "email": email,
+                    "template": "verify",
+                    "status": "sent" if rng.random() < 0.99 else "pending",
+                    "attempts": 1,
+                }
+                for email in emails[: args.num_emails]
+            ],
+        )
+        conn.execute(text("ANALYZE"))  # so the planner knows the volumes
+    print(
+        f"Seeded {args.num_users} users, {args.num_codes} codes, {args.num_sessions} sessions and "
+        f"{min(args.num_emails, args.num_users)} emails in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def get_code(engine: Engine, email: str, request_type: str) -> str:
+    with Session(engine) as session:
+        return session.exec(
+            select(AuthCode.code)
+            .where(AuthCode.email == email)
+            .where(AuthCode.request_type == request_type)
+            .order_by(AuthCode.request_date.desc())
+        ).first()
+
+
+def run_routes(audit: QueryAudit, engine: Engine, google: FakeGoogle) -> None:
+    """Call every route that touches the database, then the background jobs."""
+    client = TestClient(app, base_url="https://testserver", headers={"X-API-Key": API_KEY})
+    new_user = {"email": "new@example.com", "password": PASSWORD, "confirm_password": PASSWORD}
+    existing_user = {"email": "user1@example.com", "password": PASSWORD}
+    google_email = "google-new@example.com"
+    google.add_user(google_email)
+
+    def call(method: str, path: str, **kwargs):
+        with audit.audit(f"{method} {path}"):
+            response = client.request(method, path, **kwargs)
+        if response.status_code >= 400:
+            print(f"{method} {path}: {response.status_code} {response.text}", file=sys.stderr)
+        return response
+
+    call("POST", "/auth/verify-email", json=new_user)
+    call("POST", "/auth/signup", json={**new_user, "code": get_code(engine, new_user["email"], "verify")})
+    call("POST", "/auth/login", json=existing_user)
+    client.cookies.delete("access_token")
+    call("POST", "/auth/token/refresh")
+    call("GET", "/user/profile")
+    call("PATCH", "/user/profile/update", json={"first_name": "Audited"})
+    call("POST", "/account/email/verify-update", json={"email": "moved@example.com"})
+    code = get_code(engine, "moved@example.com", "verify")
+    call("POST", "/account/email/update", json={"email": "moved@example.com", "code": code})
+    call("POST", "/auth/logout")
+    recovering_email = "user2@example.com"  # user1 moved to another email
+    call("POST", "/account/password/forgot", json={"email": recovering_email})
+    code = get_code(engine, recovering_email, "recovery")
+    call("POST", "/account/code/verify", json={"email": recovering_email, "code": code})
+    reset = {"email": recovering_email, "code": code, "password": PASSWORD, "confirm_password": PASSWORD}
+    call("POST", "/account/password/reset", json=reset, follow_redirects=False)
+    call("POST", "/auth/login", json={"email": recovering_email, "password": PASSWORD})
+    call("POST", "/auth/logout/all")
+    call("POST", "/auth/google", json={"code": google.add_code(google_email), "state": "signup"})
+    call("POST", "/auth/google", json={"code": google.add_code(google_email), "state": "login"})
+    call("DELETE", "/user/profile/delete")
+
+    with audit.audit("email sender", hot=False), Session(engine) as session:
+        EmailSender(engine).claim(session)
+    with audit.audit("auth code sweeper", hot=False):
+        AuthCodeSweeper(engine).run_once()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Audit the query plans of every route on seeded tables.")
+    parser.add_argument("--database-uri", help="empty database to seed, by default a temporary SQLite file")
+    parser.add_argument("--num-users", type=int, default=100_000)
+    parser.add_argument("--num-codes", type=int, default=500_000)
+    parser.add_argument("--num-sessions", type=int, default=200_000)
+    parser.add_argument("--num-emails", type=int, default=100_000)
+    parser.add_argument("--migration", help="where to write a migration of the proposed indexes")
+    args = parser.parse_args()
+
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'audit.db')}"
+    engine = create_database_engine(database_uri)
+    seed(engine, args)
+
+    # Every request misses the caches and goes to the database, with tokens that outlive the audit
+    tmp_dir = tempfile.mkdtemp()
+    users.USER_CACHE = LocalCache("user", 60, 0, os.path.join(tmp_dir, "cache.db"))
+    users.GOOGLE_TOKEN_CACHE = SharedCache("google_token_email", os.path.join(tmp_dir, "cache.db"))
+    for module in (users, users_router):
+        for name in ["ACCESS_TOKEN_EXPIRES", "VERIFY_CODE_EXPIRES", "RECOVERY_CODE_EXPIRES"]:
+            setattr(module, name, timedelta(hours=1))
+    users.REFRESH_TOKEN_EXPIRES = timedelta(days=1)
+    hasher = users.PASSWORD_HASHER = users_router.PASSWORD_HASHER = PasswordHasher(PASSWORD_ROUNDS, workers=1)
+    google = FakeGoogle().start()
+    users.GOOGLE_TOKEN_URL, users.GOOGLE_USERINFO_URL = f"{google.url}/token", f"{google.url}/userinfo"
+    database.engine, database.async_engine = engine, None
+
+    audit = QueryAudit(engine)
+    try:
+        run_routes(audit, engine, google)
+    finally:
+        hasher.shutdown()
+        google.stop()
+    audit.report()
+
+    proposals = audit.propose_indexes()
+    if proposals:
+        migration = render_migration(proposals)
+        if args.migration:
+            with open(args.migration, "w") as f:
+                f.write(migration)
+            print(f"\nWrote {len(proposals)} proposed indexes to {args.migration}")
+        else:
+            print(f"\nProposed migration:\n\n{migration}")
+    if audit.failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,839 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import dspy
+import httpx
+import openai
+import pandas as pd
+import requests
+from aiosmtpd.controller import Controller
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from app import database
+from app.database import ThreadedSession, create_async_database_engine, create_database_engine, get_db_session
+from app.dependencies import emails, users
+from app.dependencies.cache import LocalCache
+from app.dependencies.emails import EmailSender
+from app.dependencies.http import HTTPClient
+from app.dependencies.items import (
+    LocationReplacer,
+    ScrapeSnapshot,
+    get_latest_snapshot_path,
+    search_properties,
+    use_snapshot,
+)
+from app.dependencies.limiter import AdaptiveLimiter
+from app.dependencies.lm import LM_BACKEND, LM_METRICS, LimitedFakeLM, count_tokens
+from app.dependencies.passwords import PasswordHasher, get_crypt_context
+from app.dependencies.query import Input, QueryParser, parse_query
+from app.dependencies.search import build_user_search
+from app.dependencies.security import API_KEY
+from app.dependencies.sweeper import AuthCodeSweeper
+from app.main import app
+from app.models.items import SearchRequest
+from app.models.users import AuthCode, User
+from scripts.fake_google import FakeGoogle
+from scripts.metric import METRIC_LM, Assess, get_inputs
+
+# Benchmark params
+LOCATIONS = ["Austin, TX", "12345", "San Francisco, CA", "1600 Pennsylvania Ave NW, Washington, DC", "Not a place"]
+EXAMPLES_PATH = max(glob.glob("data/*.csv"))
+QUERIES = [  # used when the dataset has no labeled queries; labels are what the rules extract, e.g. "3 bed" is exactly 3
+    (
+        "3 bed under 500k in Austin, TX sold last 30 days",
+        {
+            "location": "Austin, TX",
+            "listing_type": "sold",
+            "min_beds": 3,
+            "max_beds": 3,
+            "max_price": 500000.0,
+            "past_days": 30,
+        },
+    ),
+    ("condos for rent in Miami, FL", {"location": "Miami, FL", "listing_type": "for_rent", "style": "CONDOS"}),
+    ("homes for sale in 78701", {"location": "78701", "listing_type": "for_sale"}),
+    (
+        "4 bedroom house near Seattle, WA between $600k and $900k",
+        {"location": "Seattle, WA", "min_beds": 4, "max_beds": 4, "min_price": 600000.0, "max_price": 900000.0},
+    ),
+    ("foreclosures in Ohio", {"location": "OH", "foreclosure": True}),
+    (
+        "sold homes in San Francisco, CA in the past week within 5 miles",
+        {"location": "San Francisco, CA", "listing_type": "sold", "past_days": 7, "radius": 5.0},
+    ),
+    (
+        "2 bed apartment in new york ny",
+        {"location": "New York, NY", "min_beds": 2, "max_beds": 2, "style": "APARTMENT"},
+    ),
+    (
+        "over 2,000 sqft in Denver, Colorado with a 2 car garage",
+        {"location": "Denver, CO", "min_sqft": 2000, "parking_garage": 2},
+    ),
+    (
+        "townhomes in Portland OR built after 2010",
+        {"location": "Portland, OR", "style": "TOWNHOMES", "min_year_built": 2010},
+    ),
+    ("houses in Austin with a pool", {"location": "Austin"}),  # places are kept as written
+    ("cheap beach houses in California", {"location": "CA"}),
+    ("1600 Pennsylvania Ave NW, Washington, DC", {"location": "1600 Pennsylvania Ave NW, Washington, DC"}),
+]
+
+
+def print_latencies(latencies: list[float]):
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    print(f"Latency: p50 {quantiles[49] * 1000:.1f}ms, p95 {quantiles[94] * 1000:.1f}ms")
+
+
+def bench_replacer(args):
+    replace_location = LocationReplacer()
+    latencies = []
+    start = time.perf_counter()
+    for i in range(args.num_requests):
+        request_start = time.perf_counter()
+        replace_location(LOCATIONS[i % len(LOCATIONS)])
+        latencies.append(time.perf_counter() - request_start)
+    elapsed = time.perf_counter() - start
+
+    print(f"Requests: {args.num_requests} in {elapsed:.2f}s ({args.num_requests / elapsed:.2f} req/s)")
+    print_latencies(latencies)
+    for signature, stats in LM_METRICS.snapshot().items():
+        latency = stats.pop("latency")
+        print(f"{signature}: {latency['sum']:.2f}s in LM calls (p50 {latency['p50']}, p95 {latency['p95']}), {stats}")
+
+
+def judge(judge_input) -> tuple[int, float]:
+    """Run one judge call, returning its prompt tokens and latency."""
+    start = time.perf_counter()
+    with dspy.context(lm=METRIC_LM), LM_METRICS.track("Assess"):
+        dspy.TypedPredictor(Assess)(input=judge_input)
+    return count_tokens(METRIC_LM.history[-1]["prompt"]), time.perf_counter() - start
+
+
+def bench_prompts(args):
+    snapshot_path = get_latest_snapshot_path(args.examples_path)
+    if not snapshot_path:
+        raise SystemExit(f"No snapshot for {args.examples_path}, run scripts/snapshot.py first.")
+    use_snapshot(snapshot_path)
+
+    results = {"legacy": ([], []), "compact": ([], [])}
+    for frame in ScrapeSnapshot(snapshot_path).manifest["frames"].values():
+        request = SearchRequest(**frame["params"])
+        pred = dspy.Prediction(**request.model_dump(), properties=search_properties(request).properties)
+        compact_input = get_inputs(dspy.Example(query=request.location), pred)[-1]
+
+        # Every field of every property, once in the question and once in the input
+        str_properties = "\n\n".join([json.dumps(jsonable_encoder(property)) for property in pred.properties])
+        legacy_input = compact_input.model_copy(
+            update={
+                "properties": json.dumps(jsonable_encoder(pred.properties)),
+                "assessment_question": compact_input.assessment_question + str_properties,
+            }
+        )
+
+        for name, judge_input in [("legacy", legacy_input), ("compact", compact_input)]:
+            tokens, latency = judge(judge_input)
+            results[name][0].append(tokens)
+            results[name][1].append(latency)
+
+    for name, (tokens, latencies) in results.items():
+        print(f"{name}: {statistics.mean(tokens):.0f} prompt tokens per judge call (max {max(tokens)})")
+        print_latencies(latencies)
+
+
+def run_load(limiter: AdaptiveLimiter, num_threads: int, args) -> dict:
+    """Send requests to a throttling fake LM through a limiter."""
+    lm = LimitedFakeLM(
+        latency="normal",
+        latency_mean=args.latency,
+        latency_std=args.latency / 5,
+        max_concurrency=args.capacity,
+        limiter=limiter,
+    )
+
+    def request(i: int) -> bool:
+        try:
+            lm.basic_request(f"prompt {i}")
+            return True
+        except openai.RateLimitError:
+            return False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        succeeded = sum(pool.map(request, range(args.num_requests)))
+    return {"throughput": succeeded / (time.perf_counter() - start), "failed": args.num_requests - succeeded}
+
+
+def bench_concurrency(args):
+    for name, limiter, num_threads in [
+        ("fixed", AdaptiveLimiter(16, 16, min_limit=16, throttle_errors=(openai.RateLimitError,)), 16),
+        ("adaptive", AdaptiveLimiter(16, 128, throttle_errors=(openai.RateLimitError,)), 128),
+    ]:
+        results = run_load(limiter, num_threads, args)
+        metrics = limiter.metrics()
+        print(
+            f"{name}: {results['throughput']:.1f} req/s, {results['failed']} failed, "
+            f"{metrics['throttled']} throttled, final limit {metrics['limit']}"
+        )
+
+
+def load_queries(examples_path: str) -> list[tuple[str, dict]]:
+    """Get the dataset's queries with their labeled search parameters, if any."""
+    df = pd.read_csv(examples_path)
+    if df.empty or "query" not in df:
+        print(f"No labeled queries in {examples_path}, using the built-in ones.")
+        return QUERIES
+    fields = [column for column in df.columns if column in SearchRequest.model_fields]
+    return [
+        (row["query"], {field: row[field] for field in fields if not pd.isna(row[field])}) for _, row in df.iterrows()
+    ]
+
+
+def bench_parser(args):
+    queries = load_queries(args.examples_path)
+    parser = QueryParser()
+
+    fast_latencies, complete, correct, matched, labeled = [], 0, 0, 0, 0
+    for query, gold in queries:
+        start = time.perf_counter()
+        parsed = parse_query(query)
+        fast_latencies.append(time.perf_counter() - start)
+        if not parsed.complete:
+            continue
+        complete += 1
+        matched += sum(parsed.fields.get(field) == value for field, value in gold.items())
+        labeled += len(gold)
+        correct += all(parsed.fields.get(field) == value for field, value in gold.items())
+    print(f"Coverage: {complete}/{len(queries)} queries parsed without the LM")
+    print(f"Accuracy: {correct}/{complete} parsed queries, {matched}/{labeled} labeled fields")
+    print("Rules:")
+    print_latencies(fast_latencies)
+
+    llm_latencies = []
+    for query, _ in queries:
+        start = time.perf_counter()
+        with dspy.context(lm=parser.lm):
+            try:
+                parser.generate_request(input=Input(query=query, parsed="{}", remainder=query))
+            except ValueError:
+                pass
+        llm_latencies.append(time.perf_counter() - start)
+    print("LM only:")
+    print_latencies(llm_latencies)
+
+
+def bench_users(args):
+    tmp_dir = tempfile.mkdtemp()
+    engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'users.db')}")
+    SQLModel.metadata.create_all(engine)
+    emails = [f"user{i}@example.com" for i in range(args.num_users)]
+    with Session(engine) as session:
+        session.add_all(User(email=email, provider="dilemma") for email in emails)
+        session.commit()
+    tokens = {email: users.create_token({"email": email}, timedelta(hours=1)) for email in emails}
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *event_args: statements.append(event_args[2]))
+
+    async def run_requests(rng: random.Random) -> tuple[list[float], int]:
+        latencies, writes = [], 0
+        for _ in range(args.num_requests):
+            email = rng.choice(emails)
+            start = time.perf_counter()
+            with Session(engine) as session:
+                user = await users.get_user_from_token(ThreadedSession(session), "dilemma", tokens[email])
+                if rng.random() < args.write_rate:  # e.g. update_user, invalidates the user everywhere
+                    user.is_sidebar_open = not user.is_sidebar_open
+                    session.add(user)
+                    session.commit()
+                    writes += 1
+            latencies.append(time.perf_counter() - start)
+        return latencies, writes
+
+    for name, max_size in [("No cache", 0), ("User cache", args.num_users)]:
+        users.USER_CACHE = LocalCache("user", 60, max_size, os.path.join(tmp_dir, f"cache-{max_size}.db"))
+        statements.clear()
+        latencies, writes = asyncio.run(run_requests(random.Random(42)))
+        reads = sum(statement.lstrip().upper().startswith("SELECT") for statement in statements)
+        print(f"{name}: {reads} SELECTs for {args.num_requests} requests with {writes} updates")
+        print_latencies(latencies)
+
+
+def bench_codes(args):
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'codes.db')}")
+    SQLModel.metadata.create_all(engine)
+    indexes = ["ix_authcode_lookup", "ix_authcode_status_expire_date", "ix_authcode_expire_date"]
+    rng, now = random.Random(42), datetime.utcnow()
+    emails = [f"user{i}@example.com" for i in range(args.num_emails)]
+
+    def rows():
+        for i in range(args.num_codes):
+            request_date = now - timedelta(days=rng.uniform(0, 90))
+            status = "pending" if rng.random() < 0.2 else rng.choice(["verified", "expired"])
+            yield (
+                rng.choice(emails),
+                f"{i:06x}"[-6:],
+                status,
+                rng.choice(["verify", "recovery"]),
+                request_date,
+                request_date + timedelta(minutes=15),
+            )
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for index in indexes:
+            conn.exec_driver_sql(f"DROP INDEX {index}")
+        conn.exec_driver_sql(
+            "INSERT INTO authcode (email, code, status, request_type, request_date, expire_date) VALUES (?, ?, ?, ?, ?, ?)",
+            list(rows()),
+        )
+    print(f"Seeded {args.num_codes} codes for {args.num_emails} emails in {time.perf_counter() - start:.1f}s")
+    lookups = [(rng.choice(emails), rng.choice(["verify", "recovery"])) for _ in range(args.num_lookups)]
+
+    latencies = []
+    with Session(engine) as session:
+        for email, request_type in lookups:  # like get_auth_code did before
+            start = time.perf_counter()
+            session.exec(
+                select(AuthCode)
+                .where(AuthCode.email == email)
+                .where(AuthCode.request_type == request_type)
+                .where(AuthCode.status == "pending")
+            ).all()[-1:]
+            latencies.append(time.perf_counter() - start)
+    print("all()[-1] without the composite index:")
+    print_latencies(latencies)
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for index in SQLModel.metadata.tables["authcode"].indexes:
+            if index.name in indexes:
+                index.create(conn)
+    print(f"Created the indexes in {time.perf_counter() - start:.1f}s")
+
+    async def run_lookups() -> list[float]:
+        latencies = []
+        with Session(engine) as session:
+            for email, request_type in lookups:
+                start = time.perf_counter()
+                await users.get_auth_code(ThreadedSession(session), email, request_type)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+
+    latencies = asyncio.run(run_lookups())
+    print("ORDER BY request_date DESC LIMIT 1 with the composite index:")
+    print_latencies(latencies)
+
+    sweeper = AuthCodeSweeper(engine, batch_size=args.batch_size)
+    start = time.perf_counter()
+    swept = sweeper.run_once()
+    print(f"Sweep: {swept} in {time.perf_counter() - start:.1f}s, batches of {args.batch_size}")
+    start = time.perf_counter()
+    print(f"Next sweep: {sweeper.run_once()} in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+class SlowCursor(sqlite3.Cursor):
+    """SQLite cursor that waits before each statement, like a round trip to a remote database."""
+
+    latency = 0.0
+
+    def execute(self, *args):
+        time.sleep(self.latency)
+        return super().execute(*args)
+
+
+class SlowConnection(sqlite3.Connection):
+    """SQLite connection whose cursors are slow."""
+
+    def cursor(self, factory=SlowCursor):
+        return super().cursor(factory)
+
+
+class BlockingSession(ThreadedSession):
+    """Session that makes its round trips on the event loop, like the routes did before."""
+
+    async def exec(self, statement, **kwargs):
+        return self.sync_session.exec(statement, **kwargs)
+
+    async def merge(self, instance, load: bool = True):
+        return self.sync_session.merge(instance, load=load)
+
+    async def commit(self):
+        self.sync_session.commit()
+
+    async def refresh(self, instance):
+        self.sync_session.refresh(instance)
+
+
+def seed_profile_users(engine, num_users: int) -> list[str]:
+    """Add users and return their access tokens, with the user cache off so every request queries."""
+    SQLModel.metadata.create_all(engine)
+    emails = [f"user{i}@example.com" for i in range(num_users)]
+    with Session(engine) as session:
+        session.add_all(User(email=email, provider="dilemma") for email in emails)
+        session.commit()
+    users.USER_CACHE = LocalCache("user", 60, 0, os.path.join(tempfile.mkdtemp(), "cache.db"))
+    return [users.create_token({"email": email}, timedelta(hours=1)) for email in emails]
+
+
+async def run_profile_requests(
+    tokens: list[str], num_requests: int, concurrency: int
+) -> tuple[float, list[float], list[float], int]:
+    """Request GET /user/profile concurrently, returning throughput, latencies, event loop lags and errors."""
+    lags, stop, latencies, errors = [], asyncio.Event(), [], 0
+    probe = asyncio.create_task(probe_loop_lag(lags, stop))
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+
+        async def request(i: int):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(
+                    "/user/profile",
+                    headers={"X-API-Key": API_KEY},
+                    cookies={"access_token": tokens[i % len(tokens)], "provider": "dilemma"},
+                )
+                latencies.append(time.perf_counter() - start)
+                errors += response.status_code != 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request(i) for i in range(num_requests)))
+        elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    return num_requests / elapsed, latencies, lags, errors
+
+
+def bench_db(args):
+    SlowCursor.latency = args.db_latency
+    uri = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'db.db')}"
+    pool = {"pool_size": args.concurrency, "max_overflow": 0}  # so only the driver limits concurrency
+    engine = create_database_engine(uri, connect_args={"factory": SlowConnection, "check_same_thread": False}, **pool)
+    tokens = seed_profile_users(engine, args.num_users)
+
+    async def get_blocking_session():
+        with Session(engine, expire_on_commit=False) as session:
+            yield BlockingSession(session)
+
+    async_engine = create_async_database_engine(uri, connect_args={"factory": SlowConnection}, **pool)
+    modes = [("Blocking", None), ("Thread pool", None), ("Async", async_engine)]
+    try:
+        for name, mode_async_engine in modes:
+            if name == "Blocking":
+                app.dependency_overrides[get_db_session] = get_blocking_session
+            database.engine, database.async_engine = engine, mode_async_engine
+            throughput, latencies, lags, _ = asyncio.run(
+                run_profile_requests(tokens, args.num_requests, args.concurrency)
+            )
+            app.dependency_overrides.clear()
+            print(f"{name}: {throughput:.0f} requests/s at concurrency {args.concurrency}")
+            print_latencies(latencies)
+            print("Event loop lag:")
+            print_latencies(lags)
+            asyncio.run(async_engine.dispose())  # its connections are bound to the finished loop
+    finally:
+        app.dependency_overrides.clear()
+
+
+def bench_pool(args):
+    SlowCursor.latency = args.db_latency
+    uri = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'pool.db')}"
+    connect_args = {"factory": SlowConnection, "check_same_thread": False}
+    tokens = seed_profile_users(create_database_engine(uri), args.num_users)
+    database.async_engine = None
+    for pool_size in args.pool_sizes:
+        database.engine = create_database_engine(
+            uri, connect_args=connect_args, pool_size=pool_size, max_overflow=0, pool_timeout=args.pool_timeout
+        )
+        throughput, latencies, _, errors = asyncio.run(
+            run_profile_requests(tokens, args.num_requests, args.concurrency)
+        )
+        metrics = database.get_pool_metrics()["sync"]
+        print(f"Pool of {pool_size}: {throughput:.0f} requests/s at concurrency {args.concurrency}, {errors} errors")
+        print_latencies(latencies)
+        wait = metrics["wait"]
+        print(
+            f"  checkout wait p50 {wait['p50'] * 1000:.1f}ms, p99 {wait['p99'] * 1000:.1f}ms, "
+            f"{metrics['timeouts']} timeouts, {metrics['connects']} connections"
+        )
+        database.engine.dispose()
+
+
+def bench_oauth(args):
+    server = FakeGoogle().start()
+    emails = [f"user{i}@example.com" for i in range(args.num_requests)]
+    for email in emails:
+        server.add_user(email)
+    access_tokens = [server.issue_access_token(email) for email in emails]
+    url = f"{server.url}/userinfo"
+
+    latencies = []
+    for access_token in access_tokens:  # like the routes did before the pooled client
+        start = time.perf_counter()
+        requests.get(url, headers={"Authorization": f"Bearer {access_token}"})
+        latencies.append(time.perf_counter() - start)
+    print(f"requests: {server.connections} connections for {args.num_requests} calls")
+    print_latencies(latencies)
+
+    async def run_pooled() -> list[float]:
+        client, latencies = HTTPClient("google"), []
+        for access_token in access_tokens:
+            start = time.perf_counter()
+            await client.get(url, headers={"Authorization": f"Bearer {access_token}"})
+            latencies.append(time.perf_counter() - start)
+        await client.aclose()
+        return latencies
+
+    connections = server.connections
+    latencies = asyncio.run(run_pooled())
+    print(f"Pooled client: {server.connections - connections} connections for {args.num_requests} calls")
+    print_latencies(latencies)
+    server.stop()
+
+
+async def probe_loop_lag(lags: list[float], stop: asyncio.Event, interval: float = 0.01):
+    """Record how late the event loop wakes up a sleeping coroutine, like any other route would see."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_logins(verify, num_requests: int, concurrency: int) -> tuple[float, list[float]]:
+    lags, stop = [], asyncio.Event()
+    probe = asyncio.create_task(probe_loop_lag(lags, stop))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def login():
+        async with semaphore:
+            await verify()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(num_requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    return num_requests / elapsed, lags
+
+
+def bench_passwords(args):
+    hashed_password = get_crypt_context(args.rounds).hash("password")
+
+    async def verify_inline():  # what the routes did before
+        get_crypt_context(args.rounds).verify("password", hashed_password)
+
+    modes = [("Inline", None)] + [(f"Pool of {workers}", workers) for workers in sorted({1, os.cpu_count() or 1})]
+    for name, workers in modes:
+        hasher = PasswordHasher(rounds=args.rounds, workers=workers or 1, max_queue=args.num_requests)
+        verify = verify_inline if workers is None else lambda hasher=hasher: hasher.verify("password", hashed_password)
+        try:
+            if workers:  # start the processes before timing
+                asyncio.run(run_logins(verify, workers, workers))
+            throughput, lags = asyncio.run(run_logins(verify, args.num_requests, args.concurrency))
+        finally:
+            hasher.shutdown()
+        print(f"{name}: {throughput:.1f} logins/s")
+        print("Event loop lag:")
+        print_latencies(lags)
+
+
+class SlowSMTPHandler:
+    """aiosmtpd handler that answers EHLO and DATA slowly, like a remote server behind TLS."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses) -> list[str]:
+        await asyncio.sleep(self.latency)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        await asyncio.sleep(self.latency)
+        return "250 OK"
+
+
+def bench_emails(args):
+    controller = Controller(SlowSMTPHandler(args.smtp_latency), hostname="127.0.0.1", port=args.smtp_port)
+    controller.start()
+    emails.SMTP_SSL_LOGIN = "noreply@example.com"
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'outbox.db')}")
+    SQLModel.metadata.create_all(engine)
+
+    async def get_bench_session():
+        with Session(engine, expire_on_commit=False) as session:
+            yield ThreadedSession(session)
+
+    app.dependency_overrides[get_db_session] = get_bench_session
+    client = TestClient(app, headers={"X-API-Key": API_KEY})
+    try:
+        for name in ["Inline", "Outbox"]:
+            # Inline reconnects for every email in the request, like the routes did before the outbox
+            sender = EmailSender(
+                engine, "127.0.0.1", args.smtp_port, starttls=False, idle_timeout=0 if name == "Inline" else 60
+            )
+            emails.EMAIL_SENDER = sender
+            if name == "Outbox":
+                sender.start()
+            latencies = []
+            for i in range(args.num_requests):
+                start = time.perf_counter()
+                email = f"{name.lower()}{i}@example.com"
+                client.post("/auth/verify-email", json={"email": email, "password": "pw", "confirm_password": "pw"})
+                if name == "Inline":
+                    sender.run_once()
+                latencies.append(time.perf_counter() - start)
+            sender.stop()
+            while sender.run_once():  # drain
+                pass
+            sender.close()
+            quantiles = statistics.quantiles(latencies, n=100)
+            print(f"{name}: p50 {quantiles[49] * 1000:.1f}ms, p99 {quantiles[98] * 1000:.1f}ms per request")
+            print(f"  {sender.counts['sent']} sent over {sender.counts['connections']} SMTP connections")
+    finally:
+        app.dependency_overrides.clear()
+        controller.stop()
+
+
+def read_rss(pid: int) -> int:
+    """Resident memory of a process in bytes, from /proc."""
+    with open(f"/proc/{pid}/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+
+
+def measure_phase(pid: int, phase) -> tuple[float, int, int]:
+    """Run a phase, returning its seconds, its result and the server's peak resident memory above its start."""
+    baseline, peak, done = read_rss(pid), [0], threading.Event()
+
+    def sample():
+        while not done.wait(0.02):
+            peak[0] = max(peak[0], read_rss(pid))
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = phase()
+    finally:
+        elapsed = time.perf_counter() - start
+        done.set()
+        sampler.join()
+    return elapsed, result, max(0, peak[0] - baseline)
+
+
+def bench_bulk(args):
+    tmp_dir = tempfile.mkdtemp()
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tmp_dir, 'bulk.db')}"
+    SQLModel.metadata.create_all(create_database_engine(database_uri))
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = {
+        **os.environ,
+        "API_KEY": API_KEY,
+        "DATABASE_URI": database_uri,
+        "CACHE_PATH": os.path.join(tmp_dir, "cache.db"),
+    }
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"]
+    server = subprocess.Popen(command, env=env)  # noqa: S603 a real server, so its memory is measured apart from the client
+    url = f"http://127.0.0.1:{port}/admin/users"
+    client = httpx.Client(headers={"X-API-Key": API_KEY}, timeout=None)
+
+    def rows():
+        for start in range(0, args.num_users, 10000):
+            yield "".join(
+                json.dumps({"email": f"user{i}@example.com", "first_name": f"First{i % 500}", "last_name": f"Last{i}"})
+                + "\n"
+                for i in range(start, min(start + 10000, args.num_users))
+            ).encode()
+
+    def export(format: str) -> int:
+        with client.stream("GET", f"{url}/export", params={"format": format}) as response:
+            return sum(chunk.count(b"\n") for chunk in response.iter_bytes()) - (format == "csv")
+
+    try:
+        while True:
+            try:
+                client.get(f"http://127.0.0.1:{port}/")
+                break
+            except httpx.TransportError:
+                time.sleep(0.2)
+        phases = [
+            ("Import (inserts)", lambda: client.post(f"{url}/import", content=rows()).json()),
+            ("Import again (updates)", lambda: client.post(f"{url}/import", content=rows()).json()),
+            ("Export NDJSON", lambda: export("ndjson")),
+            ("Export CSV", lambda: export("csv")),
+        ]
+        for name, phase in phases:
+            elapsed, result, peak = measure_phase(server.pid, phase)
+            count = result if isinstance(result, int) else result["inserted"] + result["updated"]
+            print(f"{name}: {count} rows in {elapsed:.1f}s, {count / elapsed:,.0f} rows/s")
+            print(f"  server peak memory +{peak / 2**20:.1f} MiB{'' if isinstance(result, int) else f', {result}'}")
+    finally:
+        client.close()
+        server.terminate()
+        server.wait()
+
+
+FIRST_NAMES = (
+    "James Mary John Patricia Robert Jennifer Michael Linda David Elizabeth Joseph Susan Thomas Jessica "
+    "Charles Sarah Jordan Joan Zebulon Yara"
+).split()
+LAST_SYLLABLES = ["son", "ber", "ton", "mar", "li", "go", "ra", "ken", "do", "vi", "sha", "wel", "jo", "an", "zu"]
+
+
+def bench_search(args):
+    engine = create_engine(f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'search.db')}")
+    SQLModel.metadata.create_all(engine)
+    rng, now = random.Random(42), datetime.utcnow()
+
+    def rows():
+        for i in range(args.num_users):
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = "".join(rng.choice(LAST_SYLLABLES) for _ in range(3)).capitalize()
+            yield {
+                "uuid": uuid4(),
+                "join_date": now - timedelta(days=3 * 365 * (1 - i / args.num_users)),
+                "provider": "google" if rng.random() < 0.3 else "dilemma",
+                "email": f"{first_name}.{last_name}{i}@example.com".lower(),
+                "first_name": first_name,
+                "last_name": last_name,
+                "disabled": rng.random() < 0.02,
+            }
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), list(rows()))
+        conn.exec_driver_sql("ANALYZE")
+    print(f"Seeded {args.num_users} users in {time.perf_counter() - start:.1f}s")
+
+    searches = {
+        "common prefix 'jo'": {"query": "jo"},
+        "rare prefix 'zeb'": {"query": "zeb"},
+        "substring 'mar'": {"query": "mar", "match": "contains"},
+        "google, enabled, joined last year": {
+            "provider": "google",
+            "disabled": False,
+            "joined_after": now - timedelta(days=365),
+        },
+        "everyone": {},
+    }
+    depths = [d for d in (1, 10, 100, 1000, 10000) if d <= args.max_pages]
+    print(f"Page latency (ms) by page, {args.limit} users per page: keyset / OFFSET")
+    print(f"{'search':<36}{'matches':>10}" + "".join(f"{f'page {d}':>20}" for d in depths))
+    with Session(engine) as session:
+        for name, filters in searches.items():
+            keyset, offset, after, matches = {}, {}, None, 0
+            for page in range(1, args.max_pages + 1):  # keyset pages have to be walked to get their cursor
+                start = time.perf_counter()
+                users_page = session.exec(build_user_search(after=after, limit=args.limit, **filters)).all()
+                if page in depths:
+                    keyset[page] = time.perf_counter() - start
+                    start = time.perf_counter()
+                    session.exec(build_user_search(limit=args.limit, **filters).offset((page - 1) * args.limit)).all()
+                    offset[page] = time.perf_counter() - start
+                matches += len(users_page[: args.limit])
+                if len(users_page) <= args.limit:
+                    break
+                after = users_page[args.limit - 1].id
+            cells = "".join(
+                f"{f'{keyset[d] * 1000:.1f} / {offset[d] * 1000:.1f}' if d in keyset else '-':>20}" for d in depths
+            )
+            print(f"{name:<36}{matches if page < args.max_pages else f'>{matches}':>10}{cells}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hot paths.")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    replacer_parser = subparsers.add_parser("replacer", help="LocationReplacer latency and throughput")
+    replacer_parser.add_argument("--num-requests", type=int, default=50)
+    prompts_parser = subparsers.add_parser("prompts", help="Judge prompt size and latency on the dataset snapshot")
+    prompts_parser.add_argument("--examples-path", default=EXAMPLES_PATH)
+    parser_parser = subparsers.add_parser("parser", help="Rule-based query parser coverage, accuracy and latency")
+    parser_parser.add_argument("--examples-path", default=EXAMPLES_PATH)
+    concurrency_parser = subparsers.add_parser("concurrency", help="Fixed vs adaptive concurrency on a throttling LM")
+    concurrency_parser.add_argument("--num-requests", type=int, default=2000)
+    concurrency_parser.add_argument("--capacity", type=int, default=48, help="concurrent calls before 429s")
+    concurrency_parser.add_argument("--latency", type=float, default=0.05, help="mean latency in seconds")
+    users_parser = subparsers.add_parser("users", help="Queries and latency of authenticated requests")
+    users_parser.add_argument("--num-users", type=int, default=100)
+    users_parser.add_argument("--num-requests", type=int, default=5000)
+    users_parser.add_argument("--write-rate", type=float, default=0.01, help="share of requests that update the user")
+    passwords_parser = subparsers.add_parser("passwords", help="Login throughput and event loop lag of bcrypt")
+    passwords_parser.add_argument("--num-requests", type=int, default=40)
+    passwords_parser.add_argument("--concurrency", type=int, default=16)
+    passwords_parser.add_argument("--rounds", type=int, default=12, help="bcrypt work factor")
+    emails_parser = subparsers.add_parser("emails", help="verify-email latency with inline SMTP vs the outbox")
+    emails_parser.add_argument("--num-requests", type=int, default=200)
+    emails_parser.add_argument("--smtp-latency", type=float, default=0.05, help="seconds per EHLO and DATA")
+    emails_parser.add_argument("--smtp-port", type=int, default=8025)
+    oauth_parser = subparsers.add_parser("oauth", help="Google userinfo calls with requests vs the pooled client")
+    oauth_parser.add_argument("--num-requests", type=int, default=500)
+    codes_parser = subparsers.add_parser("codes", help="Auth code lookups and sweeps on a seeded table")
+    codes_parser.add_argument("--num-codes", type=int, default=1_000_000)
+    codes_parser.add_argument("--num-emails", type=int, default=1000)
+    codes_parser.add_argument("--num-lookups", type=int, default=1000)
+    codes_parser.add_argument("--batch-size", type=int, default=1000)
+    db_parser = subparsers.add_parser("db", help="Request throughput with blocking, threaded and async sessions")
+    db_parser.add_argument("--num-requests", type=int, default=2000)
+    db_parser.add_argument("--num-users", type=int, default=100)
+    db_parser.add_argument("--concurrency", type=int, default=32)
+    db_parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per statement")
+    pool_parser = subparsers.add_parser("pool", help="Request throughput and checkout waits by pool size")
+    pool_parser.add_argument("--num-requests", type=int, default=2000)
+    pool_parser.add_argument("--num-users", type=int, default=100)
+    pool_parser.add_argument("--concurrency", type=int, default=32)
+    pool_parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per statement")
+    pool_parser.add_argument("--pool-sizes", type=int, nargs="+", default=[1, 4, 16, 32])
+    pool_parser.add_argument("--pool-timeout", type=float, default=1.0)
+    bulk_parser = subparsers.add_parser("bulk", help="Rows/s and server memory of the admin user export and import")
+    bulk_parser.add_argument("--num-users", type=int, default=1_000_000)
+    bulk_parser.add_argument("--database-uri", help="empty database, by default a temporary SQLite file")
+    search_parser = subparsers.add_parser("search", help="Admin user search latency by page, keyset vs OFFSET")
+    search_parser.add_argument("--num-users", type=int, default=1_000_000)
+    search_parser.add_argument("--limit", type=int, default=50)
+    search_parser.add_argument("--max-pages", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"LM backend: {LM_BACKEND}")
+    benchmarks = {
+        "prompts": bench_prompts,
+        "parser": bench_parser,
+        "concurrency": bench_concurrency,
+        "users": bench_users,
+        "passwords": bench_passwords,
+        "emails": bench_emails,
+        "oauth": bench_oauth,
+        "codes": bench_codes,
+        "db": bench_db,
+        "pool": bench_pool,
+        "bulk": bench_bulk,
+        "search": bench_search,
+    }
+    if args.benchmark in benchmarks:
+        benchmarks[args.benchmark](args)
+    else:
+        bench_replacer(args if args.benchmark else replacer_parser.parse_args([]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,57 @@
+import argparse
 import glob
 import json
+import logging
+import os
+from contextlib import contextmanager
 from datetime import datetime
 
 import dspy
 import pandas as pd
 from dspy.evaluate import Evaluate
-from dspy.teleprompt import MIPRO
-from fastapi.encoders import jsonable_encoder
-from pydantic import BaseModel, Field
 
 from app.config import get_settings
 from app.dependencies.items import (
     PropertiesFinder,
+    get_latest_snapshot_path,
+    use_snapshot,
 )
-from app.models.items import Property
+from app.dependencies.lm import LM_LIMITER, LM_METRICS, get_lm
+from scripts.experiments import ExperimentStore
+from scripts.metric import (
+    METRIC_LM,
+    METRIC_MODEL,
+    QUESTIONS,
+    get_surrogate_stats,
+    metric,
+    use_surrogate,
+    use_verdict_store,
+)
+from scripts.optimize import CheckpointedMIPRO
+from scripts.surrogate import SurrogateJudge
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 SETTINGS = get_settings()
-OPENAI_API_KEY = SETTINGS.openai_api_key
 
-# Logging
-LOGGING_PATH = "logs/compile.csv"
-LOG_DF = pd.read_csv(LOGGING_PATH)
+# Checkpoints - runs, trials and timings go to scripts.experiments.EXPERIMENTS_PATH
+CHECKPOINTS_PATH = "checkpoints"
 
 # Optimizer params - https://colab.research.google.com/github/stanfordnlp/dspy/blob/main/examples/qa/hotpot/hotpotqa_with_MIPRO.ipynb
-NUM_THREADS = 16
+NUM_THREADS = LM_LIMITER.max_limit  # LM_LIMITER adapts the number of concurrent LM calls
 NUM_CANDIDATES = 10
 INIT_TEMPERATURE = 1.0
 NUM_TRIALS = 20
 MAX_BOOTSTRAPPED_DEMOS = 1
 MAX_LABELED_DEMOS = 2
 
+# Successive halving params - `--search halving` scores candidates on growing subsets of the trainset
+HALVING_ETA = 3
+HALVING_MIN_EXAMPLES = 5
+
 PROMPT_MODEL = "gpt-4-turbo-preview"
-METRIC_MODEL = "gpt-3.5-turbo"
-PROMPT_LM = dspy.OpenAI(model=PROMPT_MODEL, api_key=OPENAI_API_KEY, model_type="chat")
-METRIC_LM = dspy.OpenAI(model=METRIC_MODEL, api_key=OPENAI_API_KEY, model_type="chat")
+PROMPT_LM = get_lm(PROMPT_MODEL)
 
 MODEL_PATH = f"models/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
 
@@ -41,6 +59,7 @@ MODEL_PATH = f"models/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
 # Dataset params
 EXAMPLES_PATH = max(glob.glob("data/*.csv"))
 TRAIN_TEST_SPLIT = 0.9  # Randomly chosen
+SNAPSHOT_PATH = get_latest_snapshot_path(EXAMPLES_PATH)  # build with scripts/snapshot.py
 
 
 # Load dataset
@@ -53,157 +72,141 @@ for query in df["query"]:
         ).with_inputs("query")
     )
 trainset, devset = dataset[: int(TRAIN_TEST_SPLIT * len(dataset))], dataset[int(TRAIN_TEST_SPLIT * len(dataset)) :]
+JUDGE_CALL_BUDGET = NUM_TRIALS * len(trainset) * len(QUESTIONS) // 4  # a quarter of the TPE search's judge calls
+
+PARAMS = {
+    "examples_path": EXAMPLES_PATH,
+    "snapshot_path": SNAPSHOT_PATH,
+    "num_threads": NUM_THREADS,
+    "num_candidates": NUM_CANDIDATES,
+    "init_temperature": INIT_TEMPERATURE,
+    "num_trials": NUM_TRIALS,
+    "max_bootstrapped_demos": MAX_BOOTSTRAPPED_DEMOS,
+    "max_labeled_demos": MAX_LABELED_DEMOS,
+    "prompt_model": PROMPT_MODEL,
+    "metric_model": METRIC_MODEL,
+    "train_test_split": TRAIN_TEST_SPLIT,
+    "halving_eta": HALVING_ETA,
+    "halving_min_examples": HALVING_MIN_EXAMPLES,
+    "judge_call_budget": JUDGE_CALL_BUDGET,
+}
 
 
-# Define metric
-class Input(BaseModel):
-    """Input model."""
-
-    query: str = Field()
-    current_date: datetime = Field(default_factory=datetime.utcnow)
-
-    location: str = Field(description="location of the properties")
-    listing_type: str = Field(description="type of listing")
-    radius: float | None = Field(description="radius in miles")
-    mls_only: bool | None = Field(description="whether to include only MLS listings")
-    past_days: int | None = Field(description="number of days in the past")
-    date_from: str | None = Field(description="start date")
-    date_to: str | None = Field(description="end date")
-    foreclosure: bool | None = Field(description="whether to include foreclosures")
-    properties: list[Property] = Field(description="list of properties")
-
-    assessment_question: str = Field(description="question to assess the relevancy of properties")
-
-
-class Output(BaseModel):
-    """Output model."""
-
-    assessment_answer: str = Field(description="yes or no")
-
-
-class Assess(dspy.Signature):
-    """Assess the relevancy of properties along the specified dimension."""
-
-    input: Input = dspy.InputField()
-    output: Output = dspy.OutputField()
-
-
-def metric(gold, pred, trace=None):
-    query, location, listing_type, radius, mls_only, past_days, date_from, date_to, foreclosure, properties = (
-        gold.query,
-        pred.location,
-        pred.listing_type,
-        pred.radius,
-        pred.mls_only,
-        pred.past_days,
-        pred.date_from,
-        pred.date_to,
-        pred.foreclosure,
-        pred.properties,
-    )
-
-    # Framing the base question for the assessment
-    str_properties = "\n\n".join([json.dumps(jsonable_encoder(property)) for property in properties])
-    base_question = f"""
-    The query is: {query}
-
-    The generated search parameters are:
-    Location: {location}
-    Listing Type: {listing_type}
-    Radius: {radius}
-    MLS Only: {mls_only}
-    Past Days: {past_days}
-    Date From: {date_from}
-    Date To: {date_to}
-    Foreclosure: {foreclosure}
-
-    Based on the search, the properties found are:
-    {str_properties}
-    """
-
-    # Defining the assessment questions
-    questions = [
-        "Is the location relevant to the query?",
-        "Is the listing type relevant to the query?",
-        "Is the radius relevant to the query, if specified? If not, return yes.",
-        "Is the MLS Only relevant to the query, if specified? If not, return yes.",
-        "Is the past days relevant to the query, if specified? If not, return yes.",
-        "Is the date from relevant to the query, if specified? If not, return yes.",
-        "Is the date to relevant to the query, if specified? If not, return yes.",
-        "Is the foreclosure relevant to the query, if specified? If not, return yes.",
-        "Are the properties relevant to the query?",
-    ]
-    questions = [base_question + "\n" + question for question in questions]
-
-    # Collect responses to the questions
-    responses = []
-    with dspy.context(lm=METRIC_LM):
-        for question in questions:
-            response = dspy.TypedPredictor(Assess)(
-                input=Input(
-                    query=query,
-                    location=location,
-                    listing_type=listing_type,
-                    radius=radius,
-                    mls_only=mls_only,
-                    past_days=past_days,
-                    date_from=date_from,
-                    date_to=date_to,
-                    foreclosure=foreclosure,
-                    properties=properties,
-                    assessment_question=question,
-                )
-            ).output
-            responses.append(response)
-
-    # Convert the responses to boolean values and calculate the score
-    results = [response.assessment_answer.lower() == "yes" for response in responses]
-    score = sum(results)
-
-    # Final evaluation logic
-    if trace is not None:  # Provide detailed feedback if trace is enabled
-        return score >= len(questions)  # True if all questions are affirmed
-    return score / len(questions)  # Otherwise, return the proportion of positive responses as the score
+# Optimization
+@contextmanager
+def phase(store: ExperimentStore, run_id: int, name: str, lms: dict):
+    surrogate_stats = get_surrogate_stats()
+    with store.phase(run_id, name, lms) as metrics:
+        try:
+            yield metrics
+        finally:
+            metrics["limiter"] = LM_LIMITER.metrics()
+            metrics["lm"] = LM_METRICS.snapshot()  # cumulative over the run
+            metrics["surrogate"] = get_surrogate_stats(since=surrogate_stats)
 
 
-# Optimization
 def main():
-    optimizer = MIPRO(
-        metric=metric,
-        prompt_model=PROMPT_LM,
-        task_model=PropertiesFinder().lm,
-        num_candidates=NUM_CANDIDATES,
-        init_temperature=INIT_TEMPERATURE,
-        verbose=True,
-    )
-    compiled_program = optimizer.compile(
-        student=PropertiesFinder(),
-        trainset=trainset,
-        num_trials=NUM_TRIALS,
-        max_bootstrapped_demos=MAX_BOOTSTRAPPED_DEMOS,
-        max_labeled_demos=MAX_LABELED_DEMOS,
-        eval_kwargs={"num_threads": NUM_THREADS, "display_progress": True, "display_table": 0},
+    parser = argparse.ArgumentParser(description="Compile PropertiesFinder with MIPRO.")
+    parser.add_argument("--resume", type=int, help="id of an interrupted run to resume from its checkpoints")
+    parser.add_argument("--search", choices=["tpe", "halving"], default="tpe", help="how to search the candidates")
+    parser.add_argument("--surrogate", help="path of a surrogate judge to pre-screen judge calls with")
+    args = parser.parse_args()
+    params = {**PARAMS, "search": args.search, "surrogate": args.surrogate}
+
+    store = ExperimentStore()
+    if args.resume:
+        run_id = args.resume
+        if store.get_run(run_id)["params"] != params:
+            logger.warning(f"Resuming run {run_id} with different params than it started with.")
+        store.update_run(run_id, status="running")
+    else:
+        run_id = store.start_run(params)
+    checkpoint_path = os.path.join(CHECKPOINTS_PATH, str(run_id))
+    candidates_path = os.path.join(checkpoint_path, "candidates.json")
+    os.makedirs(checkpoint_path, exist_ok=True)
+    logger.info(f"Run {run_id}, checkpoints in {checkpoint_path}")
+
+    use_verdict_store(store, run_id)
+    if args.surrogate:
+        use_surrogate(SurrogateJudge.load(args.surrogate))
+    start = datetime.now()
+
+    try:
+        use_snapshot(SNAPSHOT_PATH)
+        student = PropertiesFinder()
+        lms = {"prompt": PROMPT_LM, "metric": METRIC_LM, "task": student.lm}
+        optimizer = CheckpointedMIPRO(
+            metric=metric,
+            prompt_model=PROMPT_LM,
+            task_model=student.lm,
+            num_candidates=NUM_CANDIDATES,
+            init_temperature=INIT_TEMPERATURE,
+            verbose=True,
+        )
+
+        if os.path.exists(candidates_path):
+            with open(candidates_path) as f:
+                candidates = json.load(f)
+        else:
+            with phase(store, run_id, "propose", lms):
+                candidates = optimizer.propose(
+                    student,
+                    trainset,
+                    max_bootstrapped_demos=MAX_BOOTSTRAPPED_DEMOS,
+                    max_labeled_demos=MAX_LABELED_DEMOS,
+                )
+            with open(candidates_path, "w") as f:
+                json.dump(candidates, f)
+
+        judge_calls = len(METRIC_LM.history)
+
+        def on_trial(trial_num, trial_params, score, program, wall_clock, metrics=None):
+            nonlocal judge_calls
+            program_path = os.path.join(checkpoint_path, f"trial_{trial_num}.json")
+            program.save(program_path)
+            metrics = {**(metrics or {}), "judge_calls": len(METRIC_LM.history) - judge_calls}
+            judge_calls = len(METRIC_LM.history)
+            store.add_trial(run_id, trial_num, trial_params, score, program_path, wall_clock, metrics)
+
+        with phase(store, run_id, "search", lms):
+            evaluate = Evaluate(devset=trainset, metric=metric, num_threads=NUM_THREADS, display_progress=True)
+            trials = store.get_trials(run_id)
+            if args.search == "halving":
+                compiled_program, _ = optimizer.search_halving(
+                    student,
+                    candidates,
+                    evaluate,
+                    trainset,
+                    NUM_TRIALS,
+                    trials,
+                    on_trial,
+                    budget=JUDGE_CALL_BUDGET,
+                    count_calls=lambda: len(METRIC_LM.history),
+                    calls_per_example=len(QUESTIONS),
+                    eta=HALVING_ETA,
+                    min_examples=HALVING_MIN_EXAMPLES,
+                )
+            else:
+                compiled_program, _ = optimizer.search(student, candidates, evaluate, NUM_TRIALS, trials, on_trial)
+        compiled_program.save(MODEL_PATH)
+
+        with phase(store, run_id, "evaluate", lms):
+            evaluate = Evaluate(devset=devset, metric=metric, num_threads=NUM_THREADS, display_progress=True)
+            baseline_score = evaluate(PropertiesFinder())
+            compiled_score = evaluate(compiled_program)
+    except BaseException:
+        store.update_run(run_id, status="failed")
+        logger.error(f"Run {run_id} failed, resume it with --resume {run_id}")
+        raise
+
+    store.update_run(
+        run_id,
+        status="finished",
+        model_path=MODEL_PATH,
+        baseline_score=baseline_score,
+        compiled_score=compiled_score,
+        metrics={"wall_clock": (datetime.now() - start).total_seconds(), "surrogate": get_surrogate_stats()},
     )
-    compiled_program.save(MODEL_PATH)
-
-    evaluate = Evaluate(devset=devset, metric=metric, num_threads=NUM_THREADS, display_progress=True)
-    LOG_DF.loc[len(LOG_DF)] = [
-        EXAMPLES_PATH,
-        NUM_THREADS,
-        NUM_CANDIDATES,
-        INIT_TEMPERATURE,
-        NUM_TRIALS,
-        MAX_BOOTSTRAPPED_DEMOS,
-        MAX_LABELED_DEMOS,
-        PROMPT_MODEL,
-        METRIC_MODEL,
-        MODEL_PATH,
-        TRAIN_TEST_SPLIT,
-        evaluate(PropertiesFinder()),
-        evaluate(compiled_program),
-        datetime.utcnow(),
-    ]
-    LOG_DF.to_csv(LOGGING_PATH, index=False)
 
 
 if __name__ == "__main__":
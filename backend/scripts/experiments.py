@@ -0,0 +1,198 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from dsp.modules.lm import LM
+
+# Store params
+EXPERIMENTS_PATH = "logs/experiments.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    model_path TEXT,
+    baseline_score REAL,
+    compiled_score REAL,
+    metrics TEXT
+);
+CREATE TABLE IF NOT EXISTS trials (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    trial_num INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    score REAL NOT NULL,
+    program_path TEXT NOT NULL,
+    wall_clock REAL NOT NULL,
+    finished TEXT NOT NULL,
+    metrics TEXT,
+    PRIMARY KEY (run_id, trial_num)
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    started TEXT NOT NULL,
+    wall_clock REAL NOT NULL,
+    lm_calls TEXT NOT NULL,
+    metrics TEXT
+);
+CREATE TABLE IF NOT EXISTS verdicts (
+    key TEXT PRIMARY KEY,
+    run_id INTEGER REFERENCES runs (id),
+    input TEXT NOT NULL,
+    answer INTEGER NOT NULL,
+    created TEXT NOT NULL
+);
+"""
+
+
+class ExperimentStore:
+    """SQLite store of compile runs, their trials, per-phase timings and judge verdicts."""
+
+    def __init__(self, path: str = EXPERIMENTS_PATH):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()  # verdicts are added from the evaluation threads
+
+    def start_run(self, params: dict) -> int:
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (status, params, started) VALUES (?, ?, ?)",
+                ("running", json.dumps(params), datetime.utcnow().isoformat()),
+            )
+        return cursor.lastrowid
+
+    def get_run(self, run_id: int) -> dict:
+        row = self.conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Run {run_id} not found")
+        return _load_row(row)
+
+    def update_run(self, run_id: int, **fields):
+        if "metrics" in fields:
+            fields["metrics"] = json.dumps(fields["metrics"])
+        if fields.get("status") in ("finished", "failed"):
+            fields["finished"] = datetime.utcnow().isoformat()
+        with self.conn:
+            self.conn.execute(
+                f"UPDATE runs SET {', '.join(f'{key} = ?' for key in fields)} WHERE id = ?",  # noqa: S608
+                (*fields.values(), run_id),
+            )
+
+    def add_trial(
+        self,
+        run_id: int,
+        trial_num: int,
+        params: dict,
+        score: float,
+        program_path: str,
+        wall_clock: float,
+        metrics: dict | None = None,
+    ):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id,
+                    trial_num,
+                    json.dumps(params),
+                    score,
+                    program_path,
+                    wall_clock,
+                    datetime.utcnow().isoformat(),
+                    json.dumps(metrics) if metrics is not None else None,
+                ),
+            )
+
+    def get_trials(self, run_id: int) -> list[dict]:
+        rows = self.conn.execute("SELECT * FROM trials WHERE run_id = ? ORDER BY trial_num", (run_id,)).fetchall()
+        return [_load_row(row) for row in rows]
+
+    @contextmanager
+    def phase(self, run_id: int, name: str, lms: dict[str, LM]):
+        """
+        Record the wall-clock and LM calls of a phase; yields a dict for extra metrics.
+
+        A phase that raises is recorded too, with the exception in its `error` metric.
+        """
+        calls = {key: len(lm.history) for key, lm in lms.items()}
+        metrics = {}
+        started, start = datetime.utcnow().isoformat(), time.perf_counter()
+        try:
+            yield metrics
+        except BaseException as e:
+            metrics["error"] = repr(e)
+            raise
+        finally:
+            calls = {key: len(lm.history) - calls[key] for key, lm in lms.items()}
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?)",
+                    (run_id, name, started, time.perf_counter() - start, json.dumps(calls), json.dumps(metrics)),
+                )
+
+    def get_phases(self, run_id: int) -> list[dict]:
+        rows = self.conn.execute("SELECT * FROM phases WHERE run_id = ? ORDER BY started", (run_id,)).fetchall()
+        return [_load_row(row) for row in rows]
+
+    def add_verdict(self, run_id: int | None, judge_input: dict, answer: bool):
+        """Log a judge verdict, keeping one per input regardless of its date."""
+        key = hashlib.sha256(
+            json.dumps(
+                {k: v for k, v in judge_input.items() if k != "current_date"}, sort_keys=True, default=str
+            ).encode()
+        ).hexdigest()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)",
+                (key, run_id, json.dumps(judge_input, default=str), answer, datetime.utcnow().isoformat()),
+            )
+
+    def get_verdicts(self) -> list[dict]:
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM verdicts ORDER BY created").fetchall()
+        return [dict(row) for row in rows]
+
+
+def _load_row(row: sqlite3.Row) -> dict:
+    return {
+        key: json.loads(row[key]) if key in ("params", "lm_calls", "metrics") and row[key] is not None else row[key]
+        for key in row.keys()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show compile runs.")
+    parser.add_argument("run_id", type=int, nargs="?", help="show the trials and phases of a run")
+    args = parser.parse_args()
+
+    store = ExperimentStore()
+    if args.run_id is None:
+        for row in store.conn.execute("SELECT * FROM runs ORDER BY id").fetchall():
+            run = _load_row(row)
+            print(
+                f"{run['id']}\t{run['status']}\t{run['started']}\t"
+                f"baseline={run['baseline_score']}\tcompiled={run['compiled_score']}\t{run['model_path']}"
+            )
+        return
+
+    print(json.dumps(store.get_run(args.run_id), indent=2))
+    for phase in store.get_phases(args.run_id):
+        print(f"phase {phase['name']}: {phase['wall_clock']:.1f}s, LM calls {phase['lm_calls']}, {phase['metrics']}")
+    for trial in store.get_trials(args.run_id):
+        print(
+            f"trial {trial['trial_num']}: score {trial['score']}, {trial['wall_clock']:.1f}s, "
+            f"{trial['params']}, {trial['metrics']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
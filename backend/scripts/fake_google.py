@@ -0,0 +1,163 @@
+import argparse
+import json
+import secrets
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Server params
+HOST = "127.0.0.1"
+PORT = 8001
+TOKEN_EXPIRES_IN = 3599  # seconds, like Google's access tokens
+
+
+class FakeGoogle(ThreadingHTTPServer):
+    """
+    Local stand-in for Google's OAuth consent, token and userinfo endpoints.
+
+    `users` maps emails to their userinfo. Codes from `add_code` or the
+    consent redirect and the refresh tokens it issued are exchanged for
+    access tokens, and every request is counted by path in `calls`.
+    Connections are kept alive, and counted in `connections`.
+    """
+
+    def __init__(self, host: str = HOST, port: int = 0):
+        super().__init__((host, port), FakeGoogleHandler)
+        self.users = {}
+        self.codes = {}
+        self.access_tokens = {}
+        self.refresh_tokens = {}
+        self.calls = Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def add_user(self, email: str, given_name: str = "Test", family_name: str = "User") -> None:
+        self.users[email] = {
+            "email": email,
+            "verified_email": True,
+            "given_name": given_name,
+            "family_name": family_name,
+            "picture": f"https://example.com/{email}.png",
+        }
+
+    def add_code(self, email: str) -> str:
+        code = secrets.token_urlsafe(8)
+        self.codes[code] = email
+        return code
+
+    def issue_access_token(self, email: str) -> str:
+        access_token = f"ya29.{secrets.token_urlsafe(16)}"
+        self.access_tokens[access_token] = email
+        return access_token
+
+    def start(self) -> "FakeGoogle":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    """Request handler of FakeGoogle."""
+
+    server: FakeGoogle
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        with self.server.lock:
+            self.server.calls[path] += 1
+        if path != "/token":
+            return self.send_json(404, {"error": "not_found"})
+
+        length = int(self.headers.get("Content-Length", 0))
+        data = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        if data.get("grant_type") == "authorization_code":
+            email = self.server.codes.pop(data.get("code"), None)
+            refresh_token = f"1//{secrets.token_urlsafe(16)}" if email else None
+            if refresh_token:
+                self.server.refresh_tokens[refresh_token] = email
+        elif data.get("grant_type") == "refresh_token":
+            email, refresh_token = self.server.refresh_tokens.get(data.get("refresh_token")), None
+        else:
+            email = None
+        if email is None:
+            return self.send_json(400, {"error": "invalid_grant"})
+
+        response = {
+            "access_token": self.server.issue_access_token(email),
+            "expires_in": TOKEN_EXPIRES_IN,
+            "token_type": "Bearer",
+        }
+        if refresh_token:
+            response["refresh_token"] = refresh_token
+        self.send_json(200, response)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        with self.server.lock:
+            self.server.calls[path] += 1
+        if path == "/auth":  # consent screen: signs in as login_hint, or the first user
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            email = params.get("login_hint") or next(iter(self.server.users), None)
+            if email not in self.server.users:
+                return self.send_json(400, {"error": "unknown_user"})
+            code = self.server.add_code(email)
+            self.send_response(302)
+            self.send_header("Location", f"{params['redirect_uri']}?code={code}&state={params.get('state', '')}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if path != "/userinfo":
+            return self.send_json(404, {"error": "not_found"})
+
+        access_token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        email = self.server.access_tokens.get(access_token)
+        if email is None or email not in self.server.users:
+            return self.send_json(401, {"error": {"code": 401, "status": "UNAUTHENTICATED"}})
+        self.send_json(200, self.server.users[email])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stand-in for Google's OAuth endpoints.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--user", action="append", default=[], help="email of a user to serve, repeatable")
+    args = parser.parse_args()
+
+    server = FakeGoogle(port=args.port)
+    for email in args.user:
+        server.add_user(email)
+    print(
+        f"Set GOOGLE_AUTH_URL={server.url}/auth, GOOGLE_TOKEN_URL={server.url}/token "
+        f"and GOOGLE_USERINFO_URL={server.url}/userinfo"
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
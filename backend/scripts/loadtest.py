@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import email
+import os
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+import httpx
+from aiosmtpd.controller import Controller
+from sqlmodel import SQLModel
+
+from app import database
+from app.config import get_settings
+from app.database import create_async_database_engine, create_database_engine
+from app.dependencies import emails, users
+from app.dependencies.cache import LocalCache, SharedCache
+from app.dependencies.emails import EmailSender
+from app.dependencies.http import HTTPClient
+from app.dependencies.passwords import PASSWORD_HASH_ROUNDS, PASSWORD_HASH_WORKERS, PasswordHasher
+from app.dependencies.ratelimit import RateLimiter
+from app.dependencies.security import API_KEY
+from app.main import app
+from app.routers import users as users_router
+from scripts.benchmark import probe_loop_lag
+from scripts.fake_google import FakeGoogle
+
+# Load test params
+SETTINGS = get_settings()
+PASSWORD = "Password123!"
+CODE_PATTERN = re.compile(r"^## (\w+)\r?$", re.MULTILINE)  # the line of the code, in every template
+EMAIL_TIMEOUT = 30.0  # seconds a scenario waits for its code
+INBOX_POLL_INTERVAL = 0.005
+QUANTILES = (50, 95, 99)
+
+
+class Inbox:
+    """aiosmtpd handler that keeps the code of the last email to each recipient, like their inbox."""
+
+    def __init__(self):
+        self.codes = {}
+        self.lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        message = email.message_from_bytes(envelope.content)
+        for part in message.walk():
+            if part.get_content_type() == "text/plain":
+                match = CODE_PATTERN.search(part.get_payload(decode=True).decode())
+                if match:
+                    with self.lock:
+                        for recipient in envelope.rcpt_tos:
+                            self.codes[recipient] = match.group(1)
+        return "250 OK"
+
+    async def wait_for_code(self, recipient: str, timeout: float = EMAIL_TIMEOUT) -> str:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                code = self.codes.pop(recipient, None)
+            if code is not None:
+                return code
+            await asyncio.sleep(INBOX_POLL_INTERVAL)
+        raise TimeoutError(f"No email to {recipient} after {timeout:.0f}s")
+
+
+class ScenarioError(Exception):
+    """Raised when a step of a scenario fails."""
+
+
+class LoadRecorder:
+    """Latencies and errors of each endpoint, and failures of each scenario step."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.failures = Counter()  # "<endpoint> <status>" of the step that ended a scenario
+
+    async def request(self, client: httpx.AsyncClient, method: str, path: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        response = await client.request(method, path, **kwargs)
+        self.latencies[f"{method} {path}"].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[f"{method} {path}"] += 1
+            raise ScenarioError(f"{method} {path} {response.status_code}")
+        return response
+
+
+def patch_app(engine, smtp_port: int, google: FakeGoogle, rounds: int, workers: int, tmp_dir: str, set_attr=setattr):
+    """
+    Point the app at the database, the fake SMTP and Google servers, with tokens and codes that outlive the run.
+
+    Rate limits are off, since the load comes from one client.
+
+    Parameters
+    ----------
+    engine : Engine
+        Engine of the database the routes use
+    smtp_port : int
+        Port of the fake SMTP server, on localhost
+    google : FakeGoogle
+        Fake Google server
+    rounds : int
+        bcrypt work factor
+    workers : int
+        Password hashing processes
+    tmp_dir : str
+        Directory of the caches
+    set_attr : optional
+        Setter of the module globals, e.g. `monkeypatch.setattr` in tests
+
+    Returns
+    -------
+    tuple[EmailSender, PasswordHasher]
+        Sender of the outbox, and hasher of the routes, both to stop after the run
+    """
+    set_attr(database, "engine", engine)
+    for module in (users, users_router):
+        set_attr(module, "ACCESS_TOKEN_EXPIRES", timedelta(hours=1))
+        set_attr(module, "VERIFY_CODE_EXPIRES", timedelta(hours=1))
+        set_attr(module, "RECOVERY_CODE_EXPIRES", timedelta(hours=1))
+    set_attr(users, "REFRESH_TOKEN_EXPIRES", timedelta(days=1))
+    cache_path = os.path.join(tmp_dir, "cache.db")
+    set_attr(users, "USER_CACHE", LocalCache("user", SETTINGS.user_cache_ttl, SETTINGS.user_cache_size, cache_path))
+    set_attr(users, "GOOGLE_TOKEN_CACHE", SharedCache("google_token_email", cache_path))
+    set_attr(users, "GOOGLE_TOKEN_URL", f"{google.url}/token")
+    set_attr(users, "GOOGLE_USERINFO_URL", f"{google.url}/userinfo")
+    set_attr(users, "GOOGLE_CLIENT", HTTPClient("google"))
+    hasher = PasswordHasher(rounds, workers=workers)
+    set_attr(users, "PASSWORD_HASHER", hasher)
+    set_attr(users_router, "PASSWORD_HASHER", hasher)
+    set_attr(users_router, "RATE_LIMITER", RateLimiter(enabled=False))  # every scenario comes from one IP
+    set_attr(emails, "SMTP_SSL_LOGIN", "noreply@example.com")
+    sender = EmailSender(engine, "127.0.0.1", smtp_port, starttls=False)
+    set_attr(emails, "EMAIL_SENDER", sender)  # woken by commits that queue emails
+    return sender, hasher
+
+
+async def run_native_scenario(client: httpx.AsyncClient, recorder: LoadRecorder, inbox: Inbox, i: int) -> None:
+    """Verify an email, sign up with the emailed code, log in again, refresh, read the profile and log out."""
+    credentials = {"email": f"load{i}@example.com", "password": PASSWORD}
+    await recorder.request(client, "POST", "/auth/verify-email", json={**credentials, "confirm_password": PASSWORD})
+    start = time.perf_counter()
+    code = await inbox.wait_for_code(credentials["email"])
+    recorder.latencies["email delivery"].append(time.perf_counter() - start)
+    signup = {**credentials, "confirm_password": PASSWORD, "code": code}
+    await recorder.request(client, "POST", "/auth/signup", json=signup)
+    client.cookies.clear()
+    await recorder.request(client, "POST", "/auth/login", json=credentials)
+    await run_session_steps(client, recorder)
+
+
+async def run_google_scenario(client: httpx.AsyncClient, recorder: LoadRecorder, google: FakeGoogle, i: int) -> None:
+    """Sign up with Google, refresh, read the profile and log out."""
+    email = f"google{i}@example.com"
+    google.add_user(email)
+    auth = {"code": google.add_code(email), "state": "signup"}
+    await recorder.request(client, "POST", "/auth/google", json=auth)
+    await run_session_steps(client, recorder)
+
+
+async def run_session_steps(client: httpx.AsyncClient, recorder: LoadRecorder) -> None:
+    client.cookies.delete("access_token")  # expired, so the refresh token is rotated
+    await recorder.request(client, "POST", "/auth/token/refresh")
+    await recorder.request(client, "GET", "/user/profile")
+    await recorder.request(client, "POST", "/auth/logout")
+
+
+async def run_scenarios(
+    inbox: Inbox, google: FakeGoogle, num_scenarios: int, concurrency: int, google_share: float, seed: int = 0
+) -> dict:
+    """
+    Run scenarios against the app, `concurrency` at a time, each with its own cookies.
+
+    Parameters
+    ----------
+    inbox : Inbox
+        Handler of the fake SMTP server
+    google : FakeGoogle
+        Fake Google server
+    num_scenarios : int
+        Number of scenarios, each with a new user
+    concurrency : int
+        Scenarios running at once
+    google_share : float
+        Share of scenarios that sign up with Google
+    seed : int, optional
+        Seed of the scenario mix, by default 0
+
+    Returns
+    -------
+    dict
+        Elapsed seconds, completed scenarios, recorder and event loop lags
+    """
+    rng = random.Random(seed)
+    recorder, lags, stop = LoadRecorder(), [], asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    completed = 0
+
+    async def run_scenario(i: int, is_google: bool):
+        nonlocal completed
+        async with semaphore, httpx.AsyncClient(
+            transport=transport, base_url="https://testserver", headers={"X-API-Key": API_KEY}
+        ) as client:
+            try:
+                if is_google:
+                    await run_google_scenario(client, recorder, google, i)
+                else:
+                    await run_native_scenario(client, recorder, inbox, i)
+                completed += 1
+            except (ScenarioError, TimeoutError) as e:
+                recorder.failures[str(e).split(" after ")[0]] += 1
+
+    probe = asyncio.create_task(probe_loop_lag(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(run_scenario(i, rng.random() < google_share) for i in range(num_scenarios)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    await users.GOOGLE_CLIENT.aclose()
+    return {"elapsed": elapsed, "completed": completed, "recorder": recorder, "lags": lags}
+
+
+def format_quantiles(latencies: list[float]) -> str:
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return ", ".join(f"p{q} {quantiles[q - 1] * 1000:.1f}ms" for q in QUANTILES)
+
+
+def print_report(result: dict, num_scenarios: int) -> None:
+    recorder, elapsed = result["recorder"], result["elapsed"]
+    print(
+        f"{result['completed']}/{num_scenarios} scenarios in {elapsed:.1f}s, "
+        f"{result['completed'] / elapsed:.1f} scenarios/s"
+    )
+    for name, latencies in recorder.latencies.items():
+        errors = recorder.errors[name]
+        print(f"{name}: {len(latencies) / elapsed:.1f}/s, {errors} errors, {format_quantiles(latencies)}")
+    if result["lags"]:
+        print(f"Event loop lag: {format_quantiles(result['lags'])}, max {max(result['lags']) * 1000:.1f}ms")
+    for failure, count in recorder.failures.most_common():
+        print(f"Failed at {failure}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the authentication flows against fake SMTP and Google.")
+    parser.add_argument("--database-uri", help="empty database, by default a temporary SQLite file")
+    parser.add_argument("--db-async", action="store_true", help="use the async engine, like DB_ASYNC")
+    parser.add_argument("--num-scenarios", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--google-share", type=float, default=0.2, help="share of scenarios that sign up with Google")
+    parser.add_argument("--rounds", type=int, default=PASSWORD_HASH_ROUNDS, help="bcrypt work factor")
+    parser.add_argument("--workers", type=int, default=PASSWORD_HASH_WORKERS, help="password hashing processes")
+    parser.add_argument("--smtp-port", type=int, default=8025)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    database_uri = args.database_uri or f"sqlite:///{os.path.join(tmp_dir, 'load.db')}"
+    engine = create_database_engine(database_uri)
+    SQLModel.metadata.create_all(engine)
+    inbox = Inbox()
+    controller = Controller(inbox, hostname="127.0.0.1", port=args.smtp_port)
+    controller.start()
+    google = FakeGoogle().start()
+    sender, hasher = patch_app(engine, args.smtp_port, google, args.rounds, args.workers, tmp_dir)
+    database.async_engine = create_async_database_engine(database_uri) if args.db_async else None
+    sender.start()
+
+    async def run() -> dict:
+        try:
+            return await run_scenarios(inbox, google, args.num_scenarios, args.concurrency, args.google_share)
+        finally:
+            if database.async_engine is not None:
+                await database.async_engine.dispose()
+
+    print(
+        f"{args.num_scenarios} scenarios at concurrency {args.concurrency} on {engine.dialect.name}"
+        f"{' (async)' if args.db_async else ''}, bcrypt work factor {args.rounds} on {args.workers} processes"
+    )
+    try:
+        result = asyncio.run(run())
+    finally:
+        sender.stop()
+        sender.close()
+        hasher.shutdown()
+        google.stop()
+        controller.stop()
+    print_report(result, args.num_scenarios)
+    print(f"Emails: {sender.counts['sent']} sent over {sender.counts['connections']} SMTP connections")
+
+
+if __name__ == "__main__":
+    main()
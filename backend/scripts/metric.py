@@ -0,0 +1,178 @@
+import random
+import threading
+from datetime import datetime
+
+import dspy
+from pydantic import BaseModel, Field
+
+from app.dependencies.items import serialize_properties
+from app.dependencies.lm import LM_METRICS, get_lm
+
+# Judge params
+METRIC_MODEL = "gpt-3.5-turbo"
+METRIC_LM = get_lm(METRIC_MODEL)
+MAX_PROPERTIES_TOKENS = 1500
+AUDIT_RATE = 0.1  # share of confident surrogate verdicts also sent to the judge to measure agreement
+
+# Set by use_verdict_store and use_surrogate
+verdict_store = None
+verdict_run_id = None
+surrogate = None
+surrogate_stats = {"verdicts": 0, "surrogate": 0, "escalated": 0, "audited": 0, "agreed": 0}
+stats_lock = threading.Lock()
+audit_rng = random.Random(0)
+
+
+# Define metric
+class Input(BaseModel):
+    """Input model."""
+
+    query: str = Field()
+    current_date: datetime = Field(default_factory=datetime.utcnow)
+
+    location: str = Field(description="location of the properties")
+    listing_type: str = Field(description="type of listing")
+    radius: float | None = Field(description="radius in miles")
+    mls_only: bool | None = Field(description="whether to include only MLS listings")
+    past_days: int | None = Field(description="number of days in the past")
+    date_from: str | None = Field(description="start date")
+    date_to: str | None = Field(description="end date")
+    foreclosure: bool | None = Field(description="whether to include foreclosures")
+    properties: str = Field(description="table of the properties found, one per line")
+
+    assessment_question: str = Field(description="question to assess the relevancy of properties")
+
+
+class Output(BaseModel):
+    """Output model."""
+
+    assessment_answer: str = Field(description="yes or no")
+
+
+class Assess(dspy.Signature):
+    """Assess the relevancy of properties along the specified dimension."""
+
+    input: Input = dspy.InputField()
+    output: Output = dspy.OutputField()
+
+
+# Defining the assessment questions
+QUESTIONS = [
+    "Is the location relevant to the query?",
+    "Is the listing type relevant to the query?",
+    "Is the radius relevant to the query, if specified? If not, return yes.",
+    "Is the MLS Only relevant to the query, if specified? If not, return yes.",
+    "Is the past days relevant to the query, if specified? If not, return yes.",
+    "Is the date from relevant to the query, if specified? If not, return yes.",
+    "Is the date to relevant to the query, if specified? If not, return yes.",
+    "Is the foreclosure relevant to the query, if specified? If not, return yes.",
+    "Are the properties relevant to the query?",
+]
+
+
+def get_inputs(gold, pred) -> list[Input]:
+    """Get the judge input for each assessment question, rendering the properties once."""
+    query, location, listing_type, radius, mls_only, past_days, date_from, date_to, foreclosure, properties = (
+        gold.query,
+        pred.location,
+        pred.listing_type,
+        pred.radius,
+        pred.mls_only,
+        pred.past_days,
+        pred.date_from,
+        pred.date_to,
+        pred.foreclosure,
+        pred.properties,
+    )
+
+    # Framing the base question for the assessment
+    str_properties = serialize_properties(properties, max_tokens=MAX_PROPERTIES_TOKENS).text
+    base_question = f"""
+    The query is: {query}
+
+    The generated search parameters are:
+    Location: {location}
+    Listing Type: {listing_type}
+    Radius: {radius}
+    MLS Only: {mls_only}
+    Past Days: {past_days}
+    Date From: {date_from}
+    Date To: {date_to}
+    Foreclosure: {foreclosure}
+
+    Based on the search, the properties found are listed in the input.
+    """
+
+    return [
+        Input(
+            query=query,
+            location=location,
+            listing_type=listing_type,
+            radius=radius,
+            mls_only=mls_only,
+            past_days=past_days,
+            date_from=date_from,
+            date_to=date_to,
+            foreclosure=foreclosure,
+            properties=str_properties,
+            assessment_question=base_question + "\n" + question,
+        )
+        for question in QUESTIONS
+    ]
+
+
+def use_verdict_store(store, run_id: int | None = None):
+    """Log every judge verdict to an ExperimentStore, to train the surrogate judge on."""
+    global verdict_store, verdict_run_id
+    verdict_store, verdict_run_id = store, run_id
+
+
+def use_surrogate(judge):
+    """Answer with a SurrogateJudge where it's confident, escalating the rest to the judge."""
+    global surrogate
+    surrogate = judge
+
+
+def get_surrogate_stats(since: dict | None = None) -> dict[str, float | None]:
+    """Counts of surrogate and judge verdicts, with the agreement and escalation rates; since a snapshot if given."""
+    with stats_lock:
+        stats = dict(surrogate_stats)
+    if since:
+        stats = {key: count - since[key] for key, count in stats.items()}
+    stats["agreement"] = stats["agreed"] / stats["audited"] if stats["audited"] else None
+    stats["escalation"] = stats["escalated"] / stats["verdicts"] if stats["verdicts"] else None
+    return stats
+
+
+def assess(judge_input: Input) -> bool:
+    """Answer an assessment question, with the surrogate judge if it's confident."""
+    verdict = surrogate.predict(judge_input) if surrogate else None
+    with stats_lock:
+        surrogate_stats["verdicts"] += 1
+        audit = verdict is not None and audit_rng.random() < AUDIT_RATE
+        if verdict is not None and not audit:
+            surrogate_stats["surrogate"] += 1
+            return verdict
+
+    with dspy.context(lm=METRIC_LM), LM_METRICS.track("Assess"):
+        answer = dspy.TypedPredictor(Assess)(input=judge_input).output.assessment_answer.lower() == "yes"
+    with stats_lock:
+        if audit:
+            surrogate_stats["audited"] += 1
+            surrogate_stats["agreed"] += verdict == answer
+        elif surrogate:
+            surrogate_stats["escalated"] += 1
+    if verdict_store:
+        verdict_store.add_verdict(verdict_run_id, judge_input.model_dump(mode="json"), answer)
+    return answer
+
+
+def metric(gold, pred, trace=None):
+    # Answer the questions and calculate the score
+    results = [assess(judge_input) for judge_input in get_inputs(gold, pred)]
+    score = sum(results)
+
+    # Final evaluation logic
+    if trace is not None:  # Provide detailed feedback if trace is enabled
+        return score >= len(QUESTIONS)  # True if all questions are affirmed
+    return score / len(QUESTIONS)  # Otherwise, return the proportion of positive responses as the score
@@ -0,0 +1,262 @@
+import itertools
+import json
+import math
+import random
+import time
+
+import dspy
+import optuna
+from dspy.teleprompt import MIPRO, BootstrapFewShot
+from pydantic import BaseModel
+
+
+class CheckpointedMIPRO(MIPRO):
+    """
+    MIPRO split into a propose and a search phase that can be checkpointed.
+
+    Candidates and trial parameters are keyed by predictor index instead of
+    `id(predictor)`, so they can be saved, reloaded in a new process and fed
+    back to the sampler to resume a run.
+    """
+
+    def propose(
+        self,
+        student: dspy.Program,
+        trainset: list[dspy.Example],
+        max_bootstrapped_demos: int,
+        max_labeled_demos: int,
+        view_data: bool = True,
+        view_examples: bool = True,
+    ) -> dict:
+        """Generate instruction and demo candidates for each predictor."""
+        module = student.deepcopy()
+
+        # In the case where the bootstrapped and labeled demos are set to 0, we'll still bootstrap examples to use in our meta prompt
+        use_demos = max_bootstrapped_demos or max_labeled_demos
+        demo_candidates = {id(p): [[]] for p in module.predictors()}  # empty set of demos as default for index 0
+        for i in range(1, self.num_candidates):
+            if self.verbose:
+                print(f"Creating basic bootstrap: {i}/{self.num_candidates-1}")
+            shuffled_trainset = trainset[:]
+            random.Random(i).shuffle(shuffled_trainset)
+            tp = BootstrapFewShot(
+                metric=self.metric,
+                max_bootstrapped_demos=max_bootstrapped_demos if use_demos else 1,
+                max_labeled_demos=max_labeled_demos if use_demos else 1,
+                teacher_settings=self.teacher_settings,
+            )
+            candidate_program = tp.compile(student=module.deepcopy(), trainset=shuffled_trainset)
+            for module_p, candidate_p in zip(module.predictors(), candidate_program.predictors(), strict=True):
+                demo_candidates[id(module_p)].append(candidate_p.demos)
+
+        instruction_candidates, _ = self._generate_first_N_candidates(
+            module, self.num_candidates, view_data, view_examples, demo_candidates, trainset
+        )
+
+        predictors = module.predictors()
+        return {
+            "instructions": [
+                [
+                    [c.proposed_instruction.strip('"').strip(), c.proposed_prefix_for_output_field.strip('"').strip()]
+                    for c in instruction_candidates[id(p)]
+                ]
+                for p in predictors
+            ],
+            "demos": [[[_dump_demo(demo) for demo in demos] for demos in demo_candidates[id(p)]] for p in predictors]
+            if use_demos
+            else None,
+        }
+
+    def build(self, student: dspy.Program, candidates: dict, params: dict) -> dspy.Program:
+        """Build the program for a set of trial parameters."""
+        program = student.deepcopy()
+        for i, predictor in enumerate(program.predictors()):
+            instruction, prefix = candidates["instructions"][i][params[f"{i}_predictor_instruction"]]
+            *_, last_field = self._get_signature(predictor).fields.keys()
+            self._set_signature(
+                predictor,
+                self._get_signature(predictor)
+                .with_instructions(instruction)
+                .with_updated_fields(last_field, prefix=prefix),
+            )
+            if candidates["demos"]:
+                predictor.demos = [
+                    _load_demo(demo, self._get_signature(predictor))
+                    for demo in candidates["demos"][i][params[f"{i}_predictor_demos"]]
+                ]
+        return program
+
+    def search(
+        self,
+        student: dspy.Program,
+        candidates: dict,
+        evaluate,
+        num_trials: int,
+        trials: list[dict],
+        on_trial,
+        seed: int = 42,
+    ) -> tuple[dspy.Program, float]:
+        """
+        Search the candidates with TPE, resuming from completed trials.
+
+        `on_trial(trial_num, params, score, program, wall_clock)` is called after each new trial.
+        """
+        distributions = self._get_distributions(candidates)
+        study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler(seed=seed))
+        for trial in trials:
+            study.add_trial(
+                optuna.trial.create_trial(params=trial["params"], distributions=distributions, value=trial["score"])
+            )
+
+        def objective(trial: optuna.Trial) -> float:
+            trial_num = trial.number
+            print(f"Starting trial #{trial_num}")
+            params = {name: trial.suggest_categorical(name, d.choices) for name, d in distributions.items()}
+            program = self.build(student, candidates, params)
+            if self.verbose:
+                print("Evaling the following program:")
+                self._print_full_program(program)
+
+            start = time.perf_counter()
+            score = evaluate(program)
+            on_trial(trial_num, params, score, program, time.perf_counter() - start)
+            return score
+
+        if len(trials) < num_trials:
+            study.optimize(objective, n_trials=num_trials - len(trials))
+        return self.build(student, candidates, study.best_params), study.best_value
+
+    def search_halving(
+        self,
+        student: dspy.Program,
+        candidates: dict,
+        evaluate,
+        trainset: list[dspy.Example],
+        num_trials: int,
+        trials: list[dict],
+        on_trial,
+        budget: int,
+        count_calls,
+        calls_per_example: int,
+        eta: int = 3,
+        min_examples: int = 5,
+        seed: int = 42,
+    ) -> tuple[dspy.Program, float]:
+        """
+        Search the candidates with successive halving, resuming from completed trials.
+
+        `num_trials` parameter sets are scored on the first `min_examples` of
+        a shuffled trainset, and the top `1 / eta` move on to `eta` times as
+        many examples until the full trainset. Each rung only evaluates the
+        examples added since the previous one and averages in the earlier
+        score. Evaluations are charged the metric calls `count_calls()` went
+        up by, and none starts once its examples at the calls per example
+        measured so far (`calls_per_example` before any) would take the
+        total past `budget`; the best parameter set of the highest rung
+        reached wins. Trials of other search modes are ignored.
+
+        `on_trial(trial_num, params, score, program, wall_clock, metrics)` is
+        called after each new evaluation, with the rung, its number of
+        examples and the calls spent in `metrics`.
+        """
+        rng = random.Random(seed)
+        distributions = self._get_distributions(candidates)
+        num_configs = min(num_trials, math.prod(len(d.choices) for d in distributions.values()))
+        configs = []
+        while len(configs) < num_configs:
+            config = {name: rng.choice(d.choices) for name, d in distributions.items()}
+            if config not in configs:
+                configs.append(config)
+        examples = trainset[:]
+        rng.shuffle(examples)
+
+        def rung_size(rung: int) -> int:
+            return min(len(examples), min_examples * eta**rung) if rung >= 0 else 0
+
+        done = {
+            (trial["metrics"]["rung"], trial["metrics"]["config"]): trial
+            for trial in trials
+            if trial["metrics"] and "rung" in trial["metrics"]
+        }
+        trial_num = max((trial["trial_num"] + 1 for trial in trials), default=0)
+        spent = sum(trial["metrics"]["calls"] for trial in done.values())
+        evaluated = sum(rung_size(rung) - rung_size(rung - 1) for rung, _ in done)
+
+        survivors = list(range(len(configs)))
+        scores, num_examples = {}, 0
+        for rung in itertools.count():
+            rung_examples = rung_size(rung)
+            new_examples = examples[num_examples:rung_examples]
+            rung_scores = {}
+            for config in survivors:
+                if (rung, config) in done:
+                    rung_scores[config] = done[(rung, config)]["score"]
+                    continue
+                estimate = len(new_examples) * (spent / evaluated if evaluated else calls_per_example)
+                if spent + estimate > budget:
+                    break
+                program = self.build(student, candidates, configs[config])
+                start, start_calls = time.perf_counter(), count_calls()
+                score = evaluate(program, devset=new_examples)
+                score = (scores.get(config, 0.0) * num_examples + score * len(new_examples)) / rung_examples
+                calls = count_calls() - start_calls
+                spent += calls
+                evaluated += len(new_examples)
+                rung_scores[config] = score
+                on_trial(
+                    trial_num,
+                    configs[config],
+                    score,
+                    program,
+                    time.perf_counter() - start,
+                    {"rung": rung, "config": config, "num_examples": rung_examples, "calls": calls},
+                )
+                trial_num += 1
+
+            if not rung_scores:
+                break
+            scores, num_examples = rung_scores, rung_examples
+            print(f"Rung {rung}: {len(scores)} candidates on {num_examples} examples, {spent}/{budget} calls")
+            if len(rung_scores) < len(survivors) or num_examples == len(examples) or len(scores) == 1:
+                break
+            survivors = sorted(scores, key=scores.get, reverse=True)[: math.ceil(len(scores) / eta)]
+
+        if not scores:
+            raise ValueError(f"A budget of {budget} calls doesn't cover the first rung.")
+        best = max(scores, key=scores.get)
+        return self.build(student, candidates, configs[best]), scores[best]
+
+    def _get_distributions(self, candidates: dict) -> dict[str, optuna.distributions.CategoricalDistribution]:
+        distributions = {}
+        for i, instructions in enumerate(candidates["instructions"]):
+            distributions[f"{i}_predictor_instruction"] = optuna.distributions.CategoricalDistribution(
+                range(len(instructions))
+            )
+            if candidates["demos"]:
+                distributions[f"{i}_predictor_demos"] = optuna.distributions.CategoricalDistribution(
+                    range(len(candidates["demos"][i]))
+                )
+        return distributions
+
+
+def _dump_demo(demo: dspy.Example) -> dict:
+    return json.loads(json.dumps(demo.toDict(), default=_dump_value))
+
+
+def _dump_value(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    return str(value)
+
+
+def _load_demo(demo: dict, signature: type[dspy.Signature]) -> dspy.Example:
+    """Load a checkpointed demo, validating the values of model-typed fields back into their models."""
+    values = {}
+    for key, value in demo.items():
+        annotation = signature.fields[key].annotation if key in signature.fields else None
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            value = (
+                annotation.model_validate_json(value) if isinstance(value, str) else annotation.model_validate(value)
+            )
+        values[key] = value
+    return dspy.Example(**values)
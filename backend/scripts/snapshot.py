@@ -0,0 +1,79 @@
+import argparse
+import glob
+import json
+import logging
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from app.dependencies.items import (
+    SNAPSHOT_MANIFEST,
+    SNAPSHOT_VERSION_PATTERN,
+    get_latest_snapshot_path,
+    get_scrape_key,
+    scrape,
+    use_snapshot,
+)
+from app.models.items import SearchRequest
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Dataset params
+EXAMPLES_PATH = max(glob.glob("data/*.csv"))
+
+
+def resolve_requests(df: pd.DataFrame) -> list[SearchRequest]:
+    """Resolve dataset rows to unique search requests."""
+    columns = [column for column in df.columns if column in SearchRequest.model_fields]
+    requests = {}
+    for row in df[columns].to_dict(orient="records"):
+        params = {key: value for key, value in row.items() if not pd.isna(value)}
+        if not params.get("location"):
+            logger.warning(f"Skipping row without location: {row}")
+            continue
+        request = SearchRequest(**params)
+        requests[get_scrape_key(request)] = request
+    return list(requests.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrape each example once and store the frames as Parquet.")
+    parser.add_argument("--examples-path", default=EXAMPLES_PATH)
+    args = parser.parse_args()
+
+    latest_path = get_latest_snapshot_path(args.examples_path)
+    version = int(SNAPSHOT_VERSION_PATTERN.match(os.path.basename(latest_path)).group(1)) + 1 if latest_path else 1
+    snapshot_path = os.path.join(os.path.splitext(args.examples_path)[0], f"v{version}")
+    os.makedirs(snapshot_path)
+
+    use_snapshot(None)  # always scrape live
+    frames = {}
+    for request in resolve_requests(pd.read_csv(args.examples_path)):
+        key = get_scrape_key(request)
+        properties = scrape(request)
+        properties.to_parquet(os.path.join(snapshot_path, f"{key}.parquet"), index=False)
+        frames[key] = {
+            "file": f"{key}.parquet",
+            "params": request.model_dump(mode="json"),
+            "rows": len(properties),
+        }
+        logger.info(f"Scraped {len(properties)} properties for {request.location}")
+
+    with open(os.path.join(snapshot_path, SNAPSHOT_MANIFEST), "w") as f:
+        json.dump(
+            {
+                "version": version,
+                "examples_path": args.examples_path,
+                "created": datetime.utcnow().isoformat(),
+                "frames": frames,
+            },
+            f,
+            indent=2,
+        )
+    logger.info(f"Wrote {len(frames)} frames to {snapshot_path}")
+
+
+if __name__ == "__main__":
+    main()
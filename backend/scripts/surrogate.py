@@ -0,0 +1,132 @@
+import argparse
+import random
+import re
+import zlib
+
+import numpy as np
+
+from scripts.experiments import ExperimentStore
+from scripts.metric import Input
+
+# Surrogate params
+SURROGATE_PATH = "models/surrogate.npz"
+NUM_FEATURES = 2**18
+CONFIDENCE = 0.9  # verdicts less certain than this are escalated to the real judge
+EPOCHS = 10
+LEARNING_RATE = 0.5
+L2 = 1e-6
+VALIDATION_SPLIT = 0.2
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9.]+")
+
+
+def featurize(judge_input: Input, num_features: int = NUM_FEATURES) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Hash the word uni- and bigrams of a judge input into a sparse, L2-normalized vector.
+
+    Every n-gram is hashed once on its own and once crossed with the
+    assessment question, so a linear model can weigh it per question.
+    """
+    question = judge_input.assessment_question.strip().splitlines()[-1].strip()
+    text = " ".join(
+        f"{name} {value}"
+        for name, value in judge_input.model_dump(exclude={"assessment_question", "current_date"}).items()
+    )
+    tokens = TOKEN_PATTERN.findall(text.lower())
+    ngrams = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:], strict=False)] + ["<bias>"]
+
+    counts = {}
+    for ngram in ngrams:
+        for key in (ngram, f"{question}|{ngram}"):
+            digest = zlib.crc32(key.encode())
+            index, sign = digest % num_features, 1.0 if digest & 0x80000000 else -1.0
+            counts[index] = counts.get(index, 0.0) + sign
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+    return indices, values / (np.linalg.norm(values) or 1.0)
+
+
+class SurrogateJudge:
+    """Logistic regression over hashed n-grams that predicts the judge's yes/no verdicts."""
+
+    def __init__(self, num_features: int = NUM_FEATURES, confidence: float = CONFIDENCE):
+        self.weights = np.zeros(num_features)
+        self.confidence = confidence
+
+    def fit(self, inputs: list[Input], answers: list[bool], epochs: int = EPOCHS, seed: int = 42) -> "SurrogateJudge":
+        """Fit with SGD on the log loss."""
+        rng = random.Random(seed)
+        samples = [
+            (*featurize(judge_input, len(self.weights)), answer)
+            for judge_input, answer in zip(inputs, answers, strict=True)
+        ]
+        for epoch in range(epochs):
+            rng.shuffle(samples)
+            rate = LEARNING_RATE / (1 + epoch)
+            for indices, values, answer in samples:
+                gradient = _sigmoid(self.weights[indices] @ values) - answer
+                self.weights[indices] -= rate * (gradient * values + L2 * self.weights[indices])
+        return self
+
+    def predict_proba(self, judge_input: Input) -> float:
+        """Probability that the judge answers yes."""
+        indices, values = featurize(judge_input, len(self.weights))
+        return float(_sigmoid(self.weights[indices] @ values))
+
+    def predict(self, judge_input: Input) -> bool | None:
+        """The verdict, or None when it isn't confident enough and should be escalated."""
+        proba = self.predict_proba(judge_input)
+        if max(proba, 1 - proba) < self.confidence:
+            return None
+        return proba >= 0.5
+
+    def save(self, path: str):
+        np.savez_compressed(path, weights=self.weights, confidence=self.confidence)
+
+    @classmethod
+    def load(cls, path: str) -> "SurrogateJudge":
+        data = np.load(path)
+        judge = cls(len(data["weights"]), float(data["confidence"]))
+        judge.weights = data["weights"]
+        return judge
+
+
+def _sigmoid(x: float) -> float:
+    return 1 / (1 + np.exp(-np.clip(x, -30, 30)))
+
+
+def evaluate_surrogate(judge: SurrogateJudge, inputs: list[Input], answers: list[bool]) -> dict[str, float | None]:
+    """Agreement with the judge on confident verdicts, and the share of verdicts escalated, None without any."""
+    verdicts = [judge.predict(judge_input) for judge_input in inputs]
+    confident = [(verdict, answer) for verdict, answer in zip(verdicts, answers, strict=True) if verdict is not None]
+    return {
+        "agreement": sum(verdict == answer for verdict, answer in confident) / len(confident) if confident else None,
+        "escalation": 1 - len(confident) / len(verdicts) if verdicts else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the surrogate judge on the logged judge verdicts.")
+    parser.add_argument("--output", default=SURROGATE_PATH)
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE)
+    args = parser.parse_args()
+
+    verdicts = ExperimentStore().get_verdicts()
+    if not verdicts:
+        raise SystemExit("No logged verdicts, run scripts/compile.py first.")
+    random.Random(42).shuffle(verdicts)
+    inputs = [Input.model_validate_json(verdict["input"]) for verdict in verdicts]
+    answers = [bool(verdict["answer"]) for verdict in verdicts]
+    split = int((1 - VALIDATION_SPLIT) * len(verdicts))
+
+    judge = SurrogateJudge(confidence=args.confidence).fit(inputs[:split], answers[:split])
+    metrics = evaluate_surrogate(judge, inputs[split:], answers[split:])
+    print(f"Validation on {len(verdicts) - split} of {len(verdicts)} verdicts: {metrics}")
+
+    judge = SurrogateJudge(confidence=args.confidence).fit(inputs, answers)
+    judge.save(args.output)
+    print(f"Saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Shared test fixtures."""
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+from fastapi.testclient import TestClient
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from app import database
+from app.database import create_database_engine
+from app.dependencies import users
+from app.dependencies.cache import LocalCache, SharedCache
+from app.dependencies.http import HTTPClient
+from app.dependencies.security import API_KEY
+from app.main import app
+from scripts.fake_google import FakeGoogle
+
+
+@pytest.fixture(name="session")
+def session_fixture():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.fixture(name="engine")
+def engine_fixture(tmp_path, monkeypatch: pytest.MonkeyPatch) -> Engine:
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "async_engine", None)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(name="admin_client")
+def admin_client_fixture(engine: Engine) -> TestClient:
+    return TestClient(app, headers={"X-API-Key": API_KEY})
+
+
+@pytest.fixture(name="shared_cache_path")
+def shared_cache_path_fixture(tmp_path) -> str:
+    return str(tmp_path / "cache.db")
+
+
+@pytest.fixture(name="user_cache", autouse=True)
+def user_cache_fixture(monkeypatch: pytest.MonkeyPatch, shared_cache_path: str) -> LocalCache:
+    cache = LocalCache("user", 60, 100, shared_cache_path)
+    monkeypatch.setattr(users, "USER_CACHE", cache)
+    return cache
+
+
+@pytest.fixture(name="fake_google")
+def fake_google_fixture(monkeypatch: pytest.MonkeyPatch, shared_cache_path: str):
+    server = FakeGoogle().start()
+    monkeypatch.setattr(users, "GOOGLE_AUTH_URL", f"{server.url}/auth")
+    monkeypatch.setattr(users, "GOOGLE_TOKEN_URL", f"{server.url}/token")
+    monkeypatch.setattr(users, "GOOGLE_USERINFO_URL", f"{server.url}/userinfo")
+    monkeypatch.setattr(users, "GOOGLE_TOKEN_CACHE", SharedCache("google_token_email", shared_cache_path))
+    monkeypatch.setattr(users, "GOOGLE_CLIENT", HTTPClient("google"))
+    yield server
+    server.stop()
+
+
+class SMTPRecorder:
+    """aiosmtpd handler that keeps the messages it receives."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.messages.append(envelope)
+        return "250 OK"
+
+
+@pytest.fixture(name="smtp_port")
+def smtp_port_fixture() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(name="smtp_server")
+def smtp_server_fixture(smtp_port: int):
+    controller = Controller(SMTPRecorder(), hostname="127.0.0.1", port=smtp_port)
+    controller.start()
+    yield controller
+    controller.stop()
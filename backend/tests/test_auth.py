@@ -0,0 +1,126 @@
+"""Test the auth codes, refresh sessions and authentication flows."""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from aiosmtpd.controller import Controller
+from fastapi import HTTPException, Request
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel, select
+
+from app import database
+from app.database import ThreadedSession, create_database_engine
+from app.dependencies import users
+from app.dependencies.sweeper import AuthCodeSweeper
+from app.dependencies.users import (
+    create_refresh_token,
+    get_auth_code,
+    revoke_refresh_token,
+    revoke_user_refresh_tokens,
+    rotate_refresh_token,
+)
+from app.models.users import AuthCode, RefreshSession, User
+from scripts.fake_google import FakeGoogle
+from scripts.loadtest import Inbox, patch_app, run_scenarios
+
+
+def test_auth_codes(session: Session) -> None:
+    """Test that the latest pending code is found, and that the sweeper expires and purges codes in batches."""
+    now = datetime.utcnow()
+    for days_ago in [40, 35, 1, 0]:
+        request_date = now - timedelta(days=days_ago, minutes=10)
+        session.add(
+            AuthCode(
+                email="codes@example.com",
+                code=f"code{days_ago}",
+                request_type="verify",
+                request_date=request_date,
+                expire_date=request_date + timedelta(minutes=5 if days_ago else 30),
+            )
+        )
+    session.commit()
+    assert asyncio.run(get_auth_code(ThreadedSession(session), "codes@example.com", "verify")).code == "code0"
+    assert asyncio.run(get_auth_code(ThreadedSession(session), "codes@example.com", "recovery")) is None
+
+    sweeper = AuthCodeSweeper(session.get_bind(), batch_size=1, retention=timedelta(days=30))
+    assert sweeper.run_once() == {"expired": 3, "purged": 2, "sessions_purged": 0, "emails_purged": 0}
+    session.expire_all()
+    codes = session.exec(select(AuthCode).order_by(AuthCode.request_date)).all()
+    assert [(code.code, code.status) for code in codes] == [("code1", "expired"), ("code0", "pending")]
+
+
+def test_refresh_sessions(session: Session, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that refresh tokens rotate and revoke by token id, without rewriting the user."""
+    monkeypatch.setattr(users, "REFRESH_TOKEN_EXPIRES", timedelta(days=1))
+    user = User(email="sessions@example.com", provider="dilemma")
+    session.add(user)
+    session.commit()
+    request = Request({"type": "http", "headers": [(b"user-agent", b"pytest")], "client": ("10.0.0.1", 1234)})
+    db_session = ThreadedSession(session)
+
+    async def run():
+        statements = []
+        event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+        laptop = create_refresh_token(db_session, user, "dilemma", request)
+        phone = create_refresh_token(db_session, user, "dilemma", request)
+        await db_session.commit()
+        assert not any(statement.startswith("UPDATE user") for statement in statements)
+
+        statements.clear()
+        rotated_user, rotated = await rotate_refresh_token(db_session, laptop, "dilemma", request)
+        await db_session.commit()
+        assert rotated_user.email == user.email
+        assert len([statement for statement in statements if "refreshsession" in statement]) == 1
+        for token, provider in [(laptop, "dilemma"), (rotated, "google"), ("invalid", "dilemma")]:
+            with pytest.raises(HTTPException):
+                await rotate_refresh_token(db_session, token, provider, request)
+
+        assert await revoke_refresh_token(db_session, rotated)
+        assert not await revoke_refresh_token(db_session, rotated)
+        with pytest.raises(HTTPException):
+            await rotate_refresh_token(db_session, rotated, "dilemma", request)
+        _, phone = await rotate_refresh_token(db_session, phone, "dilemma", request)
+        await db_session.commit()
+        assert await revoke_user_refresh_tokens(db_session, user.uuid) == 1
+        with pytest.raises(HTTPException):
+            await rotate_refresh_token(db_session, phone, "dilemma", request)
+
+    asyncio.run(run())
+    refresh_sessions = session.exec(select(RefreshSession)).all()
+    assert [(s.user_agent, s.ip_address) for s in refresh_sessions] == [("pytest", "10.0.0.1")] * 2
+    assert all(s.revoked_date for s in refresh_sessions)
+
+    for refresh_session in refresh_sessions:
+        refresh_session.expire_date = datetime.utcnow() - timedelta(days=31)
+        session.add(refresh_session)
+    session.commit()
+    sweeper = AuthCodeSweeper(session.get_bind(), retention=timedelta(days=30))
+    assert sweeper.run_once()["sessions_purged"] == 2
+
+
+def test_auth_flows(tmp_path, monkeypatch: pytest.MonkeyPatch, fake_google: FakeGoogle, smtp_port: int) -> None:
+    """Test that concurrent users get through signup with an emailed code or Google, login, refresh and logout."""
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'load.db'}")
+    SQLModel.metadata.create_all(engine)
+    monkeypatch.setattr(database, "async_engine", None)
+    inbox = Inbox()
+    controller = Controller(inbox, hostname="127.0.0.1", port=smtp_port)
+    controller.start()
+    sender, hasher = patch_app(engine, smtp_port, fake_google, 4, 1, str(tmp_path), set_attr=monkeypatch.setattr)
+    sender.start()
+    try:
+        result = asyncio.run(run_scenarios(inbox, fake_google, 6, 3, google_share=0.5))
+    finally:
+        sender.stop()
+        hasher.shutdown()
+        controller.stop()
+
+    recorder = result["recorder"]
+    assert result["completed"] == 6
+    assert not recorder.failures
+    assert len(recorder.latencies["POST /auth/token/refresh"]) == len(recorder.latencies["POST /auth/logout"]) == 6
+    assert 0 < sender.counts["sent"] == len(recorder.latencies["POST /auth/signup"]) < 6
+    with Session(engine) as session:
+        sessions = session.exec(select(RefreshSession)).all()
+    assert len(sessions) == 6 + len(recorder.latencies["POST /auth/login"])
+    assert sum(refresh_session.revoked_date is not None for refresh_session in sessions) == 6  # one logout each
@@ -0,0 +1,84 @@
+"""Test the bulk user export and import."""
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, func, select
+
+from app.dependencies import bulk
+from app.dependencies.cache import LocalCache
+from app.dependencies.users import get_user_cache_key
+from app.models.users import User
+
+
+def test_export_import(
+    engine: Engine, admin_client: TestClient, monkeypatch: pytest.MonkeyPatch, user_cache: LocalCache
+) -> None:
+    """Test that imports upsert by email in batches, idempotently, and that exports stream every user back."""
+    monkeypatch.setattr(bulk, "IMPORT_BATCH_SIZE", 7)
+    monkeypatch.setattr(bulk, "EXPORT_BATCH_SIZE", 4)
+    hashed_password = "$2b$04$" + "x" * 53
+    with Session(engine) as session:
+        session.add(User(email="user3@example.com", first_name="Old", hashed_password=hashed_password))
+        session.commit()
+    user_cache.set(
+        get_user_cache_key("user3@example.com", "dilemma"), {"email": "user3@example.com"}, user_cache.sync()
+    )
+
+    rows = [{"email": f"user{i}@example.com", "first_name": f"First{i}"} for i in range(20)]
+    body = "\n".join(
+        [*map(json.dumps, rows[:10]), "not json", json.dumps({"first_name": "No email"}), *map(json.dumps, rows[10:])]
+    )
+    summary = admin_client.post("/admin/users/import", content=body).json()
+    assert (summary["inserted"], summary["updated"], summary["invalid"]) == (19, 1, 2)
+    assert summary["errors"][0].startswith("line 11: ")
+    assert user_cache.get(get_user_cache_key("user3@example.com", "dilemma")) is None
+
+    small_worker = LocalCache("user", 60, 2, user_cache.path)
+    seq = small_worker.sync()
+    assert admin_client.post("/admin/users/import", content=body).json()["updated"] == 20  # idempotent
+    assert small_worker.sync() > seq and len(small_worker.invalidated) == 2  # bounded however many users change
+    small_worker.set(get_user_cache_key("user0@example.com", "dilemma"), {"email": "user0@example.com"}, seq)
+    assert small_worker.get(get_user_cache_key("user0@example.com", "dilemma")) is None
+    with Session(engine) as session:
+        assert session.exec(select(func.count()).select_from(User)).one() == 20
+        user = session.exec(select(User).where(User.email == "user3@example.com")).one()
+        assert (user.first_name, user.hashed_password) == ("First3", hashed_password)  # unset fields are kept
+
+    response = admin_client.get("/admin/users/export")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [user["email"] for user in exported] == [
+        "user3@example.com",
+        *(f"user{i}@example.com" for i in range(20) if i != 3),
+    ]
+    assert "hashed_password" not in exported[0]
+
+    csv_export = admin_client.get("/admin/users/export", params={"format": "csv"}).text
+    assert csv_export.splitlines()[0].startswith("join_date,provider,")
+    csv_export = csv_export.replace("First", "Renamed")
+    summary = admin_client.post("/admin/users/import", params={"format": "csv"}, content=csv_export).json()
+    assert (summary["inserted"], summary["updated"], summary["invalid"]) == (0, 20, 0)
+    assert admin_client.get("/admin/users/export").text == response.text.replace("First", "Renamed")
+
+
+def test_import_providers(engine: Engine, admin_client: TestClient) -> None:
+    """Test that imports match users by email and provider, and read quoted CSV fields over several lines."""
+    with Session(engine) as session:
+        session.add(User(email="user@example.com", provider="google", first_name="Google"))
+        session.add(User(email="user@example.com", provider="dilemma", first_name="Dilemma"))
+        session.commit()
+
+    body = 'email,provider,first_name,last_name\r\nuser@example.com,dilemma,"Two\r\nLines","Say ""hi"""\r\n\r\n'
+    body += "other@example.com,google,Other,\r\n"
+    chunks = [body[i : i + 5].encode() for i in range(0, len(body), 5)]
+    summary = admin_client.post("/admin/users/import", params={"format": "csv"}, content=iter(chunks)).json()
+    assert (summary["inserted"], summary["updated"], summary["invalid"]) == (1, 1, 0)
+    with Session(engine) as session:
+        names = {(user.email, user.provider): (user.first_name, user.last_name) for user in session.exec(select(User))}
+    assert names == {
+        ("user@example.com", "google"): ("Google", None),
+        ("user@example.com", "dilemma"): ("Two\r\nLines", 'Say "hi"'),
+        ("other@example.com", "google"): ("Other", None),
+    }
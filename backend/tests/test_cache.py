@@ -0,0 +1,103 @@
+"""Test the user cache."""
+import asyncio
+import sqlite3
+from datetime import timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import ThreadedSession, create_async_database_engine
+from app.dependencies import users
+from app.dependencies.cache import LocalCache
+from app.dependencies.users import create_token, get_user_cache_key, get_user_from_token
+from app.models.users import User
+
+
+def test_user_cache(session: Session, user_cache: LocalCache, shared_cache_path: str) -> None:
+    """Test that cached users make no queries, and that updates invalidate them in every worker."""
+    email = "cached@example.com"
+    session.add(User(email=email, provider="dilemma", first_name="Old"))
+    session.commit()
+    token = create_token({"email": email}, timedelta(hours=1))
+    other_worker = LocalCache("user", 60, 100, shared_cache_path)
+
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token)).first_name == "Old"
+    users.USER_CACHE = other_worker
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token)).first_name == "Old"
+    users.USER_CACHE = user_cache
+    queries = len(statements)
+    user = asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token))
+    assert len(statements) == queries
+
+    # An update through any session invalidates the user for both workers
+    user.first_name = "New"
+    session.add(user)
+    session.commit()
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token)).first_name == "New"
+    users.USER_CACHE = other_worker
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token)).first_name == "New"
+
+    # So does an email change, under the old email
+    user.email = "renamed@example.com"
+    session.add(user)
+    session.commit()
+    with pytest.raises(HTTPException):
+        asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token))
+
+
+def test_user_cache_sync(session: Session, monkeypatch: pytest.MonkeyPatch, shared_cache_path: str) -> None:
+    """Test that password hashes aren't cached, and that other workers' invalidations apply within the sync interval."""
+    email, hashed_password = "synced@example.com", "hash"
+    session.add(User(email=email, provider="dilemma", hashed_password=hashed_password))
+    session.commit()
+    token = create_token({"email": email}, timedelta(hours=1))
+    key = get_user_cache_key(email, "dilemma")
+    cache = LocalCache("user", 60, 100, shared_cache_path, sync_interval=60)
+    monkeypatch.setattr(users, "USER_CACHE", cache)
+
+    asyncio.run(get_user_from_token(ThreadedSession(session), "dilemma", token))
+    assert "hashed_password" not in cache.get(key)
+    with Session(session.get_bind()) as other_session:
+        user = asyncio.run(get_user_from_token(ThreadedSession(other_session), "dilemma", token))
+        assert user.hashed_password == hashed_password  # loaded on access
+
+    LocalCache("user", 60, 100, shared_cache_path).invalidate(key)  # by another worker
+    assert cache.get(key) is not None
+    cache.synced -= 60
+    assert cache.get(key) is None
+
+
+def test_user_cache_locked(tmp_path, shared_cache_path: str) -> None:
+    """Test that an async session waits for a locked cache file in a thread, so other requests go on."""
+    lock = sqlite3.connect(shared_cache_path, isolation_level=None)
+
+    async def run():
+        engine = create_async_database_engine(f"sqlite:///{tmp_path / 'async.db'}")
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                user = User(email="locked@example.com", provider="dilemma", first_name="Old")
+                session.add(user)
+                await session.commit()
+
+                user.first_name = "New"
+                session.add(user)
+                lock.execute("BEGIN IMMEDIATE")  # another worker writing
+                commit = asyncio.create_task(session.commit())
+                for _ in range(10):
+                    await asyncio.sleep(0.01)
+                assert not commit.done()
+                lock.execute("COMMIT")
+                await commit
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+    lock.close()
+    assert users.USER_CACHE.invalidated.keys() == {get_user_cache_key("locked@example.com", "dilemma")}
@@ -0,0 +1,153 @@
+"""Test the checkpointing, search and judging of compile runs."""
+import json
+from types import SimpleNamespace
+
+import dspy
+import pytest
+
+from app.dependencies.lm import FakeLM
+from app.dependencies.query import Input, Output, ParseQuery
+from app.models.items import SearchRequest
+from scripts import metric
+from scripts.experiments import ExperimentStore
+from scripts.optimize import CheckpointedMIPRO, _dump_demo
+from scripts.surrogate import SurrogateJudge, evaluate_surrogate
+
+
+class Parser(dspy.Module):
+    """Program with one typed predictor to build candidates on."""
+
+    def __init__(self):
+        super().__init__()
+        self.generate = dspy.TypedPredictor(ParseQuery)
+
+
+def get_optimizer() -> CheckpointedMIPRO:
+    return CheckpointedMIPRO(metric=lambda gold, pred, trace=None: 1.0, prompt_model=dspy.settings.lm)
+
+
+def test_checkpointed_demos() -> None:
+    """Test that demos reloaded from a checkpoint get their models back."""
+    demo = dspy.Example(
+        input=Input(query="3 bed in Austin", parsed='{"min_beds": 3}', remainder="austin"),
+        output=Output(request=SearchRequest(location="Austin, TX", min_beds=3)),
+        augmented=True,
+    )
+    candidates = json.loads(
+        json.dumps({"instructions": [[["Parse the query.", "Output:"]]], "demos": [[[], [_dump_demo(demo)]]]})
+    )
+    program = get_optimizer().build(Parser(), candidates, {"0_predictor_instruction": 0, "0_predictor_demos": 1})
+
+    [loaded] = program.predictors()[0].demos
+    assert loaded.input == demo.input
+    assert loaded.output == demo.output
+    assert loaded.augmented is True
+
+
+def test_failed_phase(tmp_path) -> None:
+    """Test that a phase that raises is recorded with its error."""
+    store = ExperimentStore(str(tmp_path / "experiments.db"))
+    run_id = store.start_run({})
+    lm = SimpleNamespace(history=[])
+    with pytest.raises(KeyboardInterrupt), store.phase(run_id, "search", {"task": lm}) as metrics:
+        metrics["trials"] = 1
+        lm.history.append({})
+        raise KeyboardInterrupt
+
+    [phase] = store.get_phases(run_id)
+    assert phase["name"] == "search"
+    assert phase["lm_calls"] == {"task": 1}
+    assert phase["metrics"] == {"trials": 1, "error": "KeyboardInterrupt()"}
+
+
+def test_halving_search_budget() -> None:
+    """Test that successive halving skips other modes' trials and charges the metric calls it measured."""
+    candidates = {"instructions": [[[f"Instruction {i}", "Output:"] for i in range(4)]], "demos": None}
+    trainset = [dspy.Example(query=f"query {i}").with_inputs("query") for i in range(15)]
+    calls = []
+
+    def evaluate(program: dspy.Program, devset: list[dspy.Example]) -> float:
+        calls.extend([1, 1] * len(devset))  # two metric calls per example, not the nine estimated
+        return int(program.predictors()[0].signature.instructions[-1]) / 10
+
+    trials = []
+    tpe_trial = {"trial_num": 0, "params": {"0_predictor_instruction": 0}, "score": 0.0, "metrics": {"judge_calls": 9}}
+    program, score = get_optimizer().search_halving(
+        Parser(),
+        candidates,
+        evaluate,
+        trainset,
+        num_trials=4,
+        trials=[tpe_trial],
+        on_trial=lambda *args: trials.append(args),
+        budget=60,
+        count_calls=lambda: len(calls),
+        calls_per_example=9,
+    )
+
+    assert [trial[0] for trial in trials] == [1, 2, 3, 4, 5]
+    assert [trial[-1]["calls"] for trial in trials] == [10, 10, 10, 10, 20]  # the last rung covers 10 more examples
+    assert len(calls) == 60
+    assert score == 0.3
+    assert program.predictors()[0].signature.instructions == "Instruction 3"
+
+
+def get_judge_input(location: str) -> metric.Input:
+    return metric.Input(
+        query="3 bed houses in Austin",
+        location=location,
+        listing_type="for_sale",
+        radius=None,
+        mls_only=None,
+        past_days=None,
+        date_from=None,
+        date_to=None,
+        foreclosure=None,
+        properties="",
+        assessment_question=metric.QUESTIONS[0],
+    )
+
+
+def test_surrogate_judge() -> None:
+    """Test that the surrogate learns the judge's verdicts, and has no rates without verdicts."""
+    inputs = [get_judge_input(location) for location in ["Austin, TX", "Paris, France"] * 20]
+    answers = [judge_input.location == "Austin, TX" for judge_input in inputs]
+    judge = SurrogateJudge(num_features=2**12, confidence=0.6).fit(inputs, answers)
+
+    assert judge.predict(get_judge_input("Austin, TX")) is True
+    assert judge.predict(get_judge_input("Paris, France")) is False
+    assert evaluate_surrogate(judge, inputs, answers) == {"agreement": 1.0, "escalation": 0.0}
+    assert evaluate_surrogate(judge, [], []) == {"agreement": None, "escalation": None}
+
+
+def test_assess_with_surrogate(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that confident verdicts skip the judge, and that audits and escalations return the judge's answer."""
+    lm = FakeLM()
+    monkeypatch.setattr(lm, "complete", lambda prompt: '{"assessment_answer": "no"}')
+    monkeypatch.setattr(metric, "METRIC_LM", lm)
+    monkeypatch.setattr(metric, "surrogate_stats", dict.fromkeys(metric.surrogate_stats, 0))
+    surrogate = SimpleNamespace(predict=lambda judge_input: True)
+    monkeypatch.setattr(metric, "surrogate", surrogate)
+    judge_input = get_judge_input("Austin, TX")
+
+    monkeypatch.setattr(metric, "AUDIT_RATE", 0.0)
+    assert metric.assess(judge_input) is True
+    assert not lm.history
+    before = metric.get_surrogate_stats()
+
+    monkeypatch.setattr(metric, "AUDIT_RATE", 1.0)
+    assert metric.assess(judge_input) is False  # the judge's answer, not the surrogate's
+    surrogate.predict = lambda judge_input: None
+    assert metric.assess(judge_input) is False
+
+    stats = metric.get_surrogate_stats(since=before)
+    assert stats == {
+        "verdicts": 2,
+        "surrogate": 0,
+        "escalated": 1,
+        "audited": 1,
+        "agreed": 0,
+        "agreement": 0.0,
+        "escalation": 0.5,
+    }
+    assert metric.get_surrogate_stats()["verdicts"] == 3
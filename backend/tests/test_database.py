@@ -0,0 +1,102 @@
+"""Test the database engines."""
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import exc, text
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import database
+from app.database import (
+    InstrumentedQueuePool,
+    create_async_database_engine,
+    create_database_engine,
+    dispose_pools,
+    get_pool_metrics,
+)
+from app.dependencies.cache import LocalCache
+from app.dependencies.users import create_token, get_auth_code, get_user_from_token, verify_code
+from app.models.users import AuthCode, User
+
+
+def test_pool_metrics(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that checkouts, timeouts and new connections are counted, and that pools are dropped after fork."""
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=0, pool_timeout=0.05)
+    monkeypatch.setattr(database, "engine", engine)
+    assert isinstance(engine.pool, InstrumentedQueuePool)
+
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+        metrics = get_pool_metrics()["sync"]
+        assert metrics["checked_out"] == 1
+        assert metrics["timeouts"] == 1
+        assert metrics["wait"]["count"] == 2
+        assert metrics["wait"]["p99"] >= 0.01
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+    metrics = get_pool_metrics()["sync"]
+    assert (metrics["checkouts"], metrics["connects"], metrics["checked_out"]) == (2, 1, 0)
+
+    threaded_engine = create_database_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=2, max_overflow=0)
+
+    def check_out():
+        for _ in range(200):
+            with threaded_engine.connect():
+                pass
+
+    threads = [threading.Thread(target=check_out) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert threaded_engine.pool.metrics()["checkouts"] == 4 * 200  # counted from every thread
+
+    pool = engine.pool
+    dispose_pools()
+    assert engine.pool is not pool
+    assert isinstance(engine.pool, InstrumentedQueuePool)
+    assert get_pool_metrics()["sync"]["checkouts"] == 0
+
+
+def test_async_session(tmp_path, user_cache: LocalCache) -> None:
+    """Test the user lookups, code checks and cache invalidation on an async session."""
+    email = "async@example.com"
+    token = create_token({"email": email}, timedelta(hours=1))
+
+    async def run():
+        engine = create_async_database_engine(f"sqlite:///{tmp_path / 'async.db'}")
+        async with engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                session.add(User(email=email, provider="dilemma", first_name="Old"))
+                session.add(
+                    AuthCode(
+                        email=email,
+                        code="123456",
+                        request_type="verify",
+                        expire_date=datetime.utcnow() + timedelta(minutes=5),
+                    )
+                )
+                await session.commit()
+
+                assert await verify_code(session, "123456", email, "verify")
+                assert (await get_auth_code(session, email, "verify", status="verified")).code == "123456"
+                with pytest.raises(HTTPException):
+                    await verify_code(session, "123456", email, "verify")
+
+                user = await get_user_from_token(session, "dilemma", token)
+                assert user.first_name == "Old"
+                user.first_name = "New"
+                session.add(user)
+                await session.commit()
+                assert (await get_user_from_token(session, "dilemma", token)).first_name == "New"
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
@@ -0,0 +1,59 @@
+"""Test the email outbox."""
+
+from datetime import datetime, timedelta
+
+import pytest
+from aiosmtpd.controller import Controller
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from app.dependencies import emails
+from app.dependencies.emails import EmailSender, queue_email
+from app.dependencies.sweeper import AuthCodeSweeper
+from app.models.emails import OutboxEmail
+
+
+def test_email_outbox(tmp_path, monkeypatch: pytest.MonkeyPatch, smtp_server: Controller) -> None:
+    """Test that queued emails are sent in batches over one connection, and retried when SMTP is down."""
+    monkeypatch.setattr(emails, "SMTP_SSL_LOGIN", "noreply@example.com")
+    engine = create_engine(f"sqlite:///{tmp_path / 'outbox.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        for i in range(3):
+            queue_email(session, f"user{i}@example.com", "verify", code=f"c0de{i}")
+        session.commit()
+
+    sender = EmailSender(engine, smtp_server.hostname, smtp_server.port, starttls=False, batch_size=2)
+    assert sender.run_once() == 2
+    assert sender.run_once() == 1
+    assert sender.run_once() == 0
+    sender.close()
+    messages = smtp_server.handler.messages
+    assert [message.rcpt_tos for message in messages] == [[f"user{i}@example.com"] for i in range(3)]
+    assert "<h2>c0de0</h2>" in messages[0].content.decode()
+    assert sender.counts["connections"] == 1
+
+    # With SMTP down, the email is retried later
+    down = EmailSender(engine, "127.0.0.1", 1, starttls=False, retry_delay=60)
+    with Session(engine) as session:
+        queue_email(session, "later@example.com", "recovery", code="abc123")
+        session.commit()
+    assert down.run_once() == 1
+    with Session(engine) as session:
+        outbox_email = session.exec(select(OutboxEmail).where(OutboxEmail.email == "later@example.com")).one()
+        assert outbox_email.status == "pending" and outbox_email.attempts == 1
+        assert outbox_email.next_attempt_date > datetime.utcnow()
+        assert outbox_email.claim is None
+    assert down.run_once() == 0
+    assert len(session.exec(select(OutboxEmail).where(OutboxEmail.status == "sent")).all()) == 3
+
+    # Sent emails keep no codes, and are purged after the retention
+    with Session(engine) as session:
+        sent = session.exec(select(OutboxEmail).where(OutboxEmail.status == "sent")).all()
+        assert {outbox_email.context for outbox_email in sent} == {"{}"}
+        for outbox_email in sent:
+            outbox_email.request_date = datetime.utcnow() - timedelta(days=31)
+            session.add(outbox_email)
+        session.commit()
+    assert AuthCodeSweeper(engine, retention=timedelta(days=30)).run_once()["emails_purged"] == 3
+    with Session(engine) as session:
+        assert [outbox_email.email for outbox_email in session.exec(select(OutboxEmail))] == ["later@example.com"]
@@ -0,0 +1,123 @@
+"""Test the calls to Google and their caching."""
+import asyncio
+import sqlite3
+from uuid import uuid4
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session
+
+from app.database import ThreadedSession
+from app.dependencies import users
+from app.dependencies.cache import SharedCache
+from app.dependencies.http import CircuitBreaker, HTTPClient
+from app.dependencies.users import encode_refresh_token, get_user_from_token
+from app.models.users import User
+from scripts.fake_google import FakeGoogle
+
+
+def test_google_token_cache(session: Session, fake_google: FakeGoogle, shared_cache_path: str) -> None:
+    """Test that cached Google tokens make no outbound calls, in any worker."""
+    email = "google@example.com"
+    fake_google.add_user(email)
+    session.add(User(email=email, provider="google"))
+    session.commit()
+    access_token = fake_google.issue_access_token(email)
+
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "google", access_token)).email == email
+    assert fake_google.calls["/userinfo"] == 1
+
+    calls = sum(fake_google.calls.values())
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "google", access_token)).email == email
+    users.GOOGLE_TOKEN_CACHE = SharedCache("google_token_email", shared_cache_path)  # another worker
+    assert asyncio.run(get_user_from_token(ThreadedSession(session), "google", access_token)).email == email
+    assert sum(fake_google.calls.values()) == calls
+
+    # Refresh tokens only work through their refresh session, not as access tokens
+    fake_google.refresh_tokens["1//refresh"] = email
+    refresh_token = encode_refresh_token(uuid4().hex, "1//refresh")
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(get_user_from_token(ThreadedSession(session), "google", refresh_token))
+    assert e.value.status_code == 401
+    assert "/token" not in fake_google.calls
+
+
+def test_google_token_negative_cache(session: Session, fake_google: FakeGoogle) -> None:
+    """Test that invalid Google tokens are remembered briefly."""
+    for _ in range(3):
+        with pytest.raises(HTTPException):
+            asyncio.run(get_user_from_token(ThreadedSession(session), "google", "invalid"))
+    assert fake_google.calls["/userinfo"] == 1
+
+
+def test_google_client(session: Session, fake_google: FakeGoogle) -> None:
+    """Test that Google calls reuse connections, and fail fast once Google is down."""
+    emails = [f"google{i}@example.com" for i in range(5)]
+    for email in emails:
+        fake_google.add_user(email)
+        session.add(User(email=email, provider="google"))
+    session.commit()
+
+    async def run():
+        for email in emails:
+            assert (
+                await get_user_from_token(ThreadedSession(session), "google", fake_google.issue_access_token(email))
+            ).email == email
+        await users.GOOGLE_CLIENT.aclose()
+
+    asyncio.run(run())
+    assert fake_google.calls["/userinfo"] == len(emails)
+    assert fake_google.connections == 1
+
+    users.GOOGLE_CLIENT = HTTPClient("google", max_retries=1, breaker=CircuitBreaker(failure_threshold=2))
+    fake_google.stop()
+    for status_code in [503, 503, 503]:
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(get_user_from_token(ThreadedSession(session), "google", "unreachable"))
+        assert e.value.status_code == status_code
+    assert users.GOOGLE_CLIENT.metrics()["short_circuited"] == 1
+    assert users.GOOGLE_CLIENT.metrics()["circuit"] == "open"
+    assert not users.GOOGLE_TOKEN_CACHE.get(users.get_token_fingerprint("unreachable"))[0]
+
+
+def test_circuit_probe_cancelled() -> None:
+    """Test that a half-open probe that is cancelled lets a later call probe."""
+    client = HTTPClient("google", max_retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.0))
+    client.breaker.record_failure()
+    assert client.breaker.state == "half-open"
+
+    async def run():
+        probe = asyncio.create_task(client.get("http://192.0.2.1/"))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        await client.aclose()
+
+    asyncio.run(run())
+    assert client.breaker.allow()
+
+
+def test_google_token_cache_locked(session: Session, fake_google: FakeGoogle, shared_cache_path: str) -> None:
+    """Test that a locked token cache file makes its request wait in a thread, not the other requests."""
+    email = "locked@example.com"
+    fake_google.add_user(email)
+    session.add(User(email=email, provider="google"))
+    session.commit()
+    lock = sqlite3.connect(shared_cache_path, isolation_level=None)
+
+    async def run():
+        lock.execute("BEGIN IMMEDIATE")  # another worker writing
+        lookup = asyncio.create_task(
+            get_user_from_token(ThreadedSession(session), "google", fake_google.issue_access_token(email))
+        )
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+        assert not lookup.done()
+        lock.execute("COMMIT")
+        assert (await lookup).email == email
+        await users.GOOGLE_CLIENT.aclose()
+
+    asyncio.run(run())
+    lock.close()
+    assert fake_google.calls["/userinfo"] == 1
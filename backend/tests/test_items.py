@@ -0,0 +1,163 @@
+"""Test the items dependencies."""
+import json
+from unittest.mock import patch
+
+import dspy
+import openai
+import pandas as pd
+import pytest
+
+from app.dependencies import items
+from app.dependencies.items import (
+    SNAPSHOT_MANIFEST,
+    Input,
+    ReplaceLocation,
+    get_latest_snapshot_path,
+    get_scrape_key,
+    serialize_properties,
+    use_snapshot,
+)
+from app.dependencies.limiter import AdaptiveLimiter
+from app.dependencies.lm import LM_METRICS, FakeLM, LimitedFakeLM
+from app.dependencies.query import parse_query
+from app.models.items import Property, SearchRequest
+from scripts.benchmark import QUERIES
+
+
+def test_search_from_snapshot(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that snapshotted searches don't scrape live."""
+    request = SearchRequest(location="Austin, TX")
+    snapshot_path = tmp_path / "examples" / "v1"
+    snapshot_path.mkdir(parents=True)
+    key = get_scrape_key(request)
+    pd.DataFrame([{"city": "Austin", "state": "TX", "beds": 3, "list_price": 500000.0}]).to_parquet(
+        snapshot_path / f"{key}.parquet"
+    )
+    (snapshot_path / SNAPSHOT_MANIFEST).write_text(json.dumps({"frames": {key: {"file": f"{key}.parquet"}}}))
+    (tmp_path / "examples" / "v1-backup").mkdir()
+    (tmp_path / "examples" / "v1-backup" / SNAPSHOT_MANIFEST).write_text("{}")  # not a version
+
+    def scrape_property(**kwargs):
+        raise AssertionError("scraped live")
+
+    monkeypatch.setattr(items, "scrape_property", scrape_property)
+    assert get_latest_snapshot_path(str(tmp_path / "examples.csv")) == str(snapshot_path)
+    use_snapshot(str(snapshot_path))
+    try:
+        result = items.search_properties(request)
+    finally:
+        use_snapshot(None)
+
+    assert len(result.properties) == 1
+    assert result.properties[0].city == "Austin"
+    assert result.properties[0].beds == 3
+
+
+def test_fake_lm_typed_outputs() -> None:
+    """Test that the fake LM is deterministic and parses as typed outputs."""
+    predictions = []
+    for _ in range(2):
+        lm = FakeLM()
+        with dspy.context(lm=lm):
+            prediction = dspy.TypedChainOfThought(ReplaceLocation)(
+                input=Input(context=[], location="12345", current_date="2024-01-01T00:00:00")
+            )
+        predictions.append(prediction.output.replacements)
+
+    assert isinstance(predictions[0], list)
+    assert predictions[0] == predictions[1]
+    assert lm.history[-1]["response"]["usage"]["total_tokens"] > 0
+
+
+def test_serialize_properties_budget() -> None:
+    """Test that serialized properties stay within the token budget."""
+    properties = [
+        Property(street=f"{i} Main St", city="Austin", beds=3, list_price=500000.0, alt_photos=["https://p/1.jpg"])
+        for i in range(100)
+    ]
+
+    full = serialize_properties(properties, max_tokens=10000)
+    assert full.num_shown == 100
+    assert "alt_photos" not in full.text
+    assert "500000.0" not in full.text and "500000" in full.text
+
+    budgeted = serialize_properties(properties, max_tokens=200)
+    assert budgeted.tokens <= 200 < budgeted.full_tokens
+    assert 0 < budgeted.num_shown < 100
+    assert "Summary: list_price 500000-500000" in budgeted.text
+
+
+def test_limiter_backs_off_on_throttling() -> None:
+    """Test that the limiter retries throttled calls and cuts its limit."""
+    limiter = AdaptiveLimiter(8, 16, throttle_errors=(TimeoutError,), max_retries=1)
+    calls = []
+
+    def throttled_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise TimeoutError
+        return "ok"
+
+    with patch("app.dependencies.limiter.time.sleep"):
+        assert limiter.call(throttled_once) == "ok"
+    assert len(calls) == 2
+    assert limiter.metrics()["throttled"] == 1
+    assert limiter.limit < 8
+
+
+def test_limited_lm_copy() -> None:
+    """Test that copies of an LM keep its limiter, and that only the limiter retries throttled requests."""
+    limiter = AdaptiveLimiter(1, 1, throttle_errors=(openai.RateLimitError,), max_retries=1)
+    lm = LimitedFakeLM(error_rate=1.0, limiter=limiter).copy(temperature=1.0)
+    assert lm.limiter is limiter
+    assert lm.kwargs["temperature"] == 1.0
+    with patch("app.dependencies.limiter.time.sleep"), pytest.raises(openai.RateLimitError):
+        lm("prompt")
+    assert limiter.metrics()["throttled"] == 2  # not retried again by DSPy's backoff
+
+
+def test_lm_metrics_per_signature() -> None:
+    """Test that LM calls are attributed to their signature, with retries and parse failures."""
+    lm = LimitedFakeLM(metrics=LM_METRICS)
+    before = LM_METRICS.snapshot().get(
+        "ReplaceLocation", {"predictions": 0, "calls": 0, "retries": 0, "parse_failures": 0}
+    )
+    with dspy.context(lm=lm):
+        with LM_METRICS.track("ReplaceLocation"):
+            dspy.TypedPredictor(ReplaceLocation)(input=Input(context=[], location="12345"))
+        with (
+            patch.object(lm, "complete", return_value="not json"),
+            pytest.raises(ValueError, match="Too many retries"),
+            LM_METRICS.track("ReplaceLocation"),
+        ):
+            dspy.TypedPredictor(ReplaceLocation, max_retries=3)(input=Input(context=[], location="12345"))
+        with pytest.raises(ValueError), LM_METRICS.track("ReplaceLocation"):
+            raise ValueError("not a prediction")  # no LM answer, so not a parse failure
+
+    stats = LM_METRICS.snapshot()["ReplaceLocation"]
+    assert stats["predictions"] - before["predictions"] == 3
+    assert stats["calls"] - before["calls"] >= 4  # failed parses may ask the LM to explain the error
+    assert stats["retries"] - before["retries"] >= 2
+    assert stats["parse_failures"] - before["parse_failures"] == 1
+    assert stats["prompt_tokens"] > 0
+    assert stats["latency"]["count"] >= 4
+
+
+def test_parser_benchmark_labels() -> None:
+    """Test that the parser benchmark's built-in queries parse to their labels."""
+    for query, labels in QUERIES:
+        assert parse_query(query).fields == labels, query
+
+
+def test_parse_query_fast_path() -> None:
+    """Test that common query patterns parse without the LM, and the rest is left over."""
+    parsed = parse_query("3 bed under 500k in Austin, TX sold in the last 30 days")
+    assert parsed.complete
+    assert parsed.to_request() == SearchRequest(
+        location="Austin, TX", listing_type="sold", min_beds=3, max_beds=3, max_price=500000.0, past_days=30
+    )
+
+    parsed = parse_query("condos in Austin with a pool")
+    assert not parsed.complete
+    assert parsed.fields == {"style": "CONDOS", "location": "Austin"}
+    assert parsed.remainder == "pool"
@@ -0,0 +1,85 @@
+"""Test the request metrics and their Prometheus exposition."""
+import multiprocessing
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.dependencies import metrics
+from app.dependencies.metrics import MetricsRegistry
+from app.internal import admin
+
+
+def register(registry: MetricsRegistry) -> tuple:
+    return (
+        registry.counter("jobs_total", "Jobs", ("kind",)),
+        registry.gauge("jobs_running", "Jobs running"),
+        registry.histogram("job_duration_seconds", "Job latency", ("kind",), (0.1, 1.0)),
+    )
+
+
+def test_multiprocess_aggregation(tmp_path) -> None:
+    """Test that totals sum the live workers, and keep the counters but not the gauges of exited ones."""
+    path = str(tmp_path / "metrics.db")
+    registry = MetricsRegistry(path)
+    jobs, running, durations = register(registry)
+    jobs.inc(2, kind="export")
+    jobs.inc(kind='say "hi"\n')
+    running.inc(3)
+    durations.observe(0.05, kind="export")
+    durations.observe(5, kind="export")
+
+    def worker() -> None:
+        other = MetricsRegistry(path)
+        other_jobs, other_running, other_durations = register(other)
+        other_jobs.inc(kind="export")
+        other_running.inc()
+        other_durations.observe(0.5, kind="export")
+        other.flush()
+
+    for _ in range(2):  # exited workers are folded into the same rows
+        process = multiprocessing.get_context("fork").Process(target=worker)
+        process.start()
+        process.join()
+    assert process.exitcode == 0
+
+    lines = registry.render().splitlines()
+    assert lines[:4] == [
+        "# HELP jobs_total Jobs",
+        "# TYPE jobs_total counter",
+        'jobs_total{kind="export"} 4',
+        'jobs_total{kind="say \\"hi\\"\\n"} 1',
+    ]
+    assert "jobs_running 3" in lines  # the exited workers' gauges are gone
+    assert lines[-5:] == [
+        'job_duration_seconds_bucket{kind="export",le="0.1"} 1',
+        'job_duration_seconds_bucket{kind="export",le="1"} 3',
+        'job_duration_seconds_bucket{kind="export",le="+Inf"} 4',
+        'job_duration_seconds_sum{kind="export"} 6.05',
+        'job_duration_seconds_count{kind="export"} 4',
+    ]
+    assert MetricsRegistry(path).collect() == registry.collect()  # any worker serves the same totals
+
+
+def test_request_metrics(admin_client: TestClient, monkeypatch: pytest.MonkeyPatch, tmp_path) -> None:
+    """Test that requests are counted per route template, and served in the Prometheus format."""
+    registry = MetricsRegistry(str(tmp_path / "metrics.db"))
+    for family in metrics.METRICS.families.values():
+        registry.families[family.name] = family
+    monkeypatch.setattr(admin, "METRICS", registry)
+
+    assert admin_client.get("/").status_code == 200
+    assert admin_client.get("/no/such/route").status_code == 404
+    assert admin_client.get("/admin/users/search", params={"q": "a"}).status_code == 200
+    response = admin_client.get("/admin/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+
+    def value(sample: str) -> float:
+        return next(float(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(sample + " "))
+
+    assert value('http_requests_total{method="GET",route="/",status="200"}') >= 1
+    assert value('http_requests_total{method="GET",route="unmatched",status="404"}') >= 1
+    assert value('http_response_size_bytes_count{method="GET",route="/admin/users/search"}') >= 1
+    assert value('http_requests_in_progress{method="GET",route="/admin/users/search"}') == 0
+    assert value('http_requests_in_progress{method="GET",route="/admin/metrics"}') == 1  # this one
+    assert value('operation_duration_seconds_count{operation="db"}') >= 1
@@ -0,0 +1,31 @@
+"""Test the password hasher."""
+import asyncio
+
+from fastapi import HTTPException
+
+from app.dependencies.passwords import PasswordHasher
+
+
+def test_password_hasher() -> None:
+    """Test hashing in the process pool, rehashing on a new work factor, and rejection past the queue."""
+
+    async def run():
+        old_hasher, hasher = PasswordHasher(rounds=4, workers=1, max_queue=0), PasswordHasher(rounds=5, workers=1)
+        try:
+            hashed_password = await old_hasher.hash("password")
+            assert await old_hasher.verify("password", hashed_password) == (True, None)
+            assert await hasher.verify("wrong", hashed_password) == (False, None)
+            verified, new_hash = await hasher.verify("password", hashed_password)
+            assert verified and new_hash.startswith("$2b$05$")
+            assert await hasher.verify("password", new_hash) == (True, None)
+
+            results = await asyncio.gather(*(old_hasher.hash("password") for _ in range(2)), return_exceptions=True)
+            assert sum(isinstance(result, HTTPException) and result.status_code == 503 for result in results) == 1
+            metrics = old_hasher.metrics()
+            assert (metrics["hashes"], metrics["rejected"]) == (2, 1)  # rejected hashes aren't counted as hashes
+            assert hasher.metrics()["rehashes"] == 1
+        finally:
+            old_hasher.shutdown()
+            hasher.shutdown()
+
+    asyncio.run(run())
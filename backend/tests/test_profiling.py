@@ -0,0 +1,51 @@
+"""Test the on-demand request profiling."""
+import json
+import pstats
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.dependencies import profiling
+from app.dependencies.profiling import RequestProfiler
+from app.internal import admin
+
+
+def test_request_profiling(admin_client: TestClient, tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that only requests asking with the API key are profiled, and that the latest profiles are served."""
+    profiler = RequestProfiler(str(tmp_path / "profiles.db"), interval=0.001, buffer_size=2)
+    monkeypatch.setattr(profiling, "PROFILER", profiler)
+    monkeypatch.setattr(admin, "PROFILER", profiler)
+
+    assert "X-Profile-Id" not in admin_client.get("/").headers
+    assert "X-Profile-Id" not in admin_client.get("/", headers={"X-Profile": "1", "X-API-Key": "wrong"}).headers
+    body = "\n".join(json.dumps({"email": f"user{i}@example.com", "first_name": f"First{i}"}) for i in range(3000))
+    response = admin_client.post("/admin/users/import", content=body, headers={"X-Profile": "1"})
+    profile_id = response.headers["X-Profile-Id"]
+
+    [listed] = admin_client.get("/admin/profiles").json()
+    assert (listed["id"], listed["method"], listed["path"], listed["status"]) == (
+        profile_id,
+        "POST",
+        "/admin/users/import",
+        200,
+    )
+    assert listed["samples"] > 0
+    folded = admin_client.get(f"/admin/profiles/{profile_id}").text
+    assert all(line.rpartition(" ")[2].isdigit() for line in folded.splitlines())
+    assert "import_users" in folded
+    assert "[await]" in folded  # batches upserted in the thread pool
+
+    (tmp_path / "profile.pstats").write_bytes(
+        admin_client.get(f"/admin/profiles/{profile_id}", params={"format": "pstats"}).content
+    )
+    stats = pstats.Stats(str(tmp_path / "profile.pstats"))
+    import_users = next(value for key, value in stats.stats.items() if key[2] == "import_users")
+    assert 0 < import_users[3] <= listed["duration"] + 1e-9  # sample times add up to the duration
+
+    for _ in range(2):
+        admin_client.get("/", headers={"X-Profile": "1"})
+    assert [profile["path"] for profile in admin_client.get("/admin/profiles").json()] == [
+        "/",
+        "/",
+    ]  # the oldest is dropped
+    assert admin_client.get(f"/admin/profiles/{profile_id}").status_code == 404
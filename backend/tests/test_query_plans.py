@@ -0,0 +1,41 @@
+"""Test the query plan audit."""
+from argparse import Namespace
+
+from sqlmodel import Session, select
+
+from app.database import create_database_engine
+from app.models.users import AuthCode, User
+from scripts.audit_queries import QueryAudit, render_migration, seed
+
+
+def test_query_audit(tmp_path) -> None:
+    """Test that full scans on hot routes fail the audit, and that an index is proposed for them."""
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'audit.db'}")
+    seed(engine, Namespace(num_users=200, num_codes=2000, num_sessions=200, num_emails=200))
+    audit = QueryAudit(engine)
+
+    with Session(engine) as session:
+        with audit.audit("GET /indexed"):
+            session.exec(select(User).where(User.email == "user1@example.com")).first()
+        with audit.audit("POST /unindexed"):
+            session.exec(
+                select(AuthCode)
+                .where(AuthCode.code == "00000a")
+                .where(AuthCode.request_date > AuthCode.expire_date)
+                .order_by(AuthCode.request_date)
+            ).first()
+        with audit.audit("background job", hot=False):
+            session.exec(select(User).where(User.hashed_password.is_(None))).first()
+
+    assert [audited.routes for audited in audit.failures] == [{"POST /unindexed"}]
+    assert audit.failures[0].scans == ["authcode"]
+    assert all(audited.durations for audited in audit.statements.values())
+    proposals = audit.propose_indexes()
+    assert proposals == {
+        ("authcode", ("code", "request_date")): {"POST /unindexed"},
+        ("user", ("hashed_password",)): {"background job"},
+    }
+
+    migration = render_migration(proposals)
+    assert 'op.create_index("ix_authcode_code_request_date", "authcode", ["code", "request_date"]' in migration
+    assert 'op.drop_index("ix_user_hashed_password", table_name="user")' in migration
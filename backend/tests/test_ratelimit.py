@@ -0,0 +1,86 @@
+"""Test the rate limiter."""
+import threading
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.dependencies.ratelimit import LocalRateStore, RateLimiter, SharedRateStore, get_client_ip
+from app.routers import users as users_router
+
+
+def test_sliding_window() -> None:
+    """Test that requests over a limit wait until the sliding window lets one more in, and aren't counted."""
+    now = [0.0]
+    limiter = RateLimiter(LocalRateStore(), {"ip": 2, "email": 0}, window=10.0, clock=lambda: now[0])
+    assert limiter.hit("login", ip="1.2.3.4", email="a@example.com") == 0
+    assert limiter.hit("login", ip="1.2.3.4") == 0
+    assert limiter.hit("login", ip="1.2.3.4") == pytest.approx(15.0)  # 2 * (1 - 5 / 10) + 1 fits at 15s
+    assert limiter.hit("login", ip="5.6.7.8") == 0
+    assert limiter.hit("verify_email", ip="1.2.3.4") == 0
+
+    now[0] = 14.9
+    assert limiter.hit("login", ip="1.2.3.4") == pytest.approx(0.1)
+    now[0] = 15.0
+    assert limiter.hit("login", ip="1.2.3.4") == 0
+    assert limiter.hit("login", ip="1.2.3.4") == pytest.approx(5.0)  # the previous window slides out
+    now[0] = 40.0
+    assert limiter.hit("login", ip="1.2.3.4") == 0
+    assert limiter.metrics()["scopes"] == {
+        "login": {"allowed": 5, "limited": 3},
+        "verify_email": {"allowed": 1, "limited": 0},
+    }
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_concurrent_hits(tmp_path, shared: bool) -> None:
+    """Test that concurrent requests, from threads of two workers when shared, get exactly the limit."""
+    if shared:
+        limiters = [RateLimiter(SharedRateStore(str(tmp_path / "cache.db")), {"ip": 10, "email": 3}) for _ in range(2)]
+    else:
+        limiters = [RateLimiter(LocalRateStore(), {"ip": 10, "email": 3})] * 2
+    allowed, barrier = [], threading.Barrier(40)
+
+    def request(i: int):
+        barrier.wait()
+        for _ in range(5):
+            email = f"user{i % 2}@example.com" if i < 20 else None
+            allowed.append((email, limiters[i % 2].hit("login", ip="1.2.3.4", email=email) == 0))
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(ok for _, ok in allowed) == 10
+    for email in ["user0@example.com", "user1@example.com"]:
+        assert sum(ok for hit_email, ok in allowed if hit_email == email) <= 3
+
+
+def test_rate_limited_route(admin_client: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a route over its limit answers 429 with Retry-After, before touching the database."""
+    monkeypatch.setattr(users_router, "RATE_LIMITER", RateLimiter(LocalRateStore(), {"ip": 10, "email": 2}))
+
+    responses = [admin_client.post("/account/password/forgot", json={"email": "someone@example.com"}) for _ in range(3)]
+    assert [response.status_code for response in responses] == [200, 200, 429]
+    assert 30 <= int(responses[-1].headers["Retry-After"]) <= 90  # the rest of the window, then half of the next
+    assert admin_client.post("/account/password/forgot", json={"email": "other@example.com"}).status_code == 200
+    assert users_router.RATE_LIMITER.metrics()["scopes"]["forgot_password"] == {"allowed": 3, "limited": 1}
+
+
+def test_forwarded_client_ip(admin_client: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that users behind the frontend, which shares one IP and API key, are limited by their own IPs."""
+    monkeypatch.setattr(users_router, "RATE_LIMITER", RateLimiter(LocalRateStore(), {"ip": 2, "email": 5}))
+
+    def forgot(ip: str, email: str) -> int:
+        headers = {"X-Forwarded-For": ip}
+        return admin_client.post("/account/password/forgot", json={"email": email}, headers=headers).status_code
+
+    assert [forgot("1.1.1.1", "a@example.com") for _ in range(2)] == [200, 200]
+    assert [forgot("2.2.2.2", "b@example.com") for _ in range(2)] == [200, 200]
+    assert forgot("1.1.1.1", "c@example.com") == 429
+    assert forgot("2.2.2.2, 1.1.1.1", "c@example.com") == 429  # a spoofed leftmost entry doesn't change the key
+    assert forgot("10.0.0.1, 3.3.3.3", "c@example.com") == 200  # the address the frontend added
+
+    request = SimpleNamespace(headers={"X-Forwarded-For": "4.4.4.4"}, client=SimpleNamespace(host="5.5.5.5"))
+    assert get_client_ip(request) == "5.5.5.5"
@@ -0,0 +1,60 @@
+"""Test the admin user search."""
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from app.dependencies.search import build_user_search
+from app.models.users import User
+
+
+def test_search_users(engine: Engine, admin_client: TestClient) -> None:
+    """Test matching, filters and keyset pages that cover every match once, and that prefixes use the indexes."""
+    now = datetime.utcnow()
+    names = ["Joan", "John", "Mary", "Jo_y"]
+    with Session(engine) as session:
+        session.add_all(
+            User(
+                email=f"user{i}@example.com",
+                first_name=names[i % 4],
+                last_name="Johnson" if i % 10 == 0 else "Smith",
+                provider="google" if i % 3 == 0 else "dilemma",
+                disabled=i % 5 == 0,
+                join_date=now - timedelta(days=100 - i),
+            )
+            for i in range(100)
+        )
+        session.commit()
+
+    def search(**params) -> list[str]:
+        emails, cursor = [], {}
+        while True:
+            page = admin_client.get("/admin/users/search", params={**params, **cursor, "limit": 7}).json()
+            emails += [user["email"] for user in page["users"]]
+            if page["next_after"] is None:
+                return emails
+            cursor = {"after": page["next_after"]}
+
+    def expected(condition) -> list[str]:
+        return [f"user{i}@example.com" for i in range(100) if condition(i)]
+
+    assert search(q="jo") == expected(lambda i: i % 4 != 2 or i % 10 == 0)  # first or last name, any case
+    assert search(q="jo_") == expected(lambda i: i % 4 == 3)  # not a wildcard
+    assert search(q="USER4") == expected(lambda i: str(i).startswith("4"))
+    assert search(q="hns", match="contains") == expected(lambda i: i % 10 == 0)
+    assert search(provider="google", disabled=False) == expected(lambda i: i % 3 == 0 and i % 5 != 0)
+    joined = {
+        "joined_after": (now - timedelta(days=60)).isoformat(),
+        "joined_before": (now - timedelta(days=50)).isoformat(),
+    }
+    assert search(**joined) == expected(lambda i: 40 <= i < 50)
+    assert admin_client.get("/admin/users/search", params={"limit": 1000}).status_code == 422
+
+    with engine.connect() as conn:
+        statement = build_user_search(query="jo").compile(
+            dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}
+        )
+        plan = " ".join(row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}"))
+    assert "SCAN" not in plan
@@ -1,6 +1,6 @@
 "use server";
 
-import { cookies } from "next/headers";
+import { cookies, headers } from "next/headers";
 
 // Helper vars and functions
 
@@ -21,13 +21,23 @@ const apiUrlBase = removeTrailingSlash(process.env.API_URL);
 const apiUrlPort = process.env.API_PORT ? `:${process.env.API_PORT}` : "";
 const apiUrl = `${apiUrlBase}${apiUrlPort}`;
 
+// IP of the browser, so the API rate limits each user rather than this server.
+// Only addresses the proxy in front of this server sets are trusted: the
+// browser can send any X-Forwarded-For, so only the hop the proxy added counts.
+const getClientIp = () =>
+  headers().get("x-real-ip") ||
+  headers().get("x-forwarded-for")?.split(",").pop()?.trim() ||
+  "";
+
 const sendRequest = async (route: string, method: string, data: any = null) => {
+  const clientIp = getClientIp();
   let request: RequestInit = {
     method: method,
     headers: {
       "Content-Type": "application/json",
       "X-API-Key": process.env.API_KEY || "",
       Cookie: cookies().toString(),
+      ...(clientIp && { "X-Forwarded-For": clientIp }),
     },
     credentials: "include",
   };